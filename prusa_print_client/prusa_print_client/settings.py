@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'site_apps.printers.metrics.QueryCountMiddleware',
 ]
 
 ROOT_URLCONF = 'prusa_print_client.urls'
@@ -121,6 +122,98 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [ os.path.join(BASE_DIR, "static"), ]
 
+# Printer farm
+# (connect, read) timeout in seconds for every call made to a printer
+PRINTER_REQUEST_TIMEOUT = (2.0, 3.0)
+# upper bound in seconds for a whole farm status sweep, slow printers get reported as offline
+PRINTER_STATUS_DEADLINE = 4.0
+# (connect, read) timeout for uploads, the read part covers the printer writing to USB
+PRINTER_UPLOAD_TIMEOUT = (3.0, 300.0)
+# GET/HEAD calls are retried this many times with exponential backoff (seconds factor)
+PRINTER_REQUEST_RETRIES = 2
+PRINTER_REQUEST_BACKOFF = 0.25
+# keep-alive connections kept open to each printer
+PRINTER_POOL_SIZE = 4
+# how many printers we talk to concurrently
+PRINTER_POLL_WORKERS = 16
+# circuit breaker: after this many failed calls in a row a printer counts as
+# down and is only probed again after a backoff (seconds, doubling per failed probe)
+PRINTER_BREAKER_THRESHOLD = 3
+PRINTER_BREAKER_BACKOFF = 5.0
+PRINTER_BREAKER_MAX_BACKOFF = 300.0
+# seconds each printer gets to carry out a pause/resume/stop, bulk commands included
+PRINTER_COMMAND_TIMEOUT = 10.0
+# `poll_printers --daemon`: seconds between polls of a healthy printer, and the cap
+# on the exponential backoff for unreachable ones
+PRINTER_POLL_INTERVAL = 5.0
+PRINTER_POLL_MAX_BACKOFF = 300.0
+# the status collector sweeps the farm this often (seconds), views only read its cache
+PRINTER_STATUS_INTERVAL = 2.0
+# cached statuses older than this (seconds) are flagged as stale
+PRINTER_STATUS_STALE_AFTER = 10.0
+# start the collector thread on the first API read, turn off when `poll_printers --daemon`
+# feeds a shared cache instead
+PRINTER_STATUS_AUTOSTART = True
+# open status streams check the cache for changes this often (seconds)
+PRINTER_STREAM_TICK = 0.5
+# close status streams after this many seconds, browsers reconnect on their own
+PRINTER_STREAM_MAX_AGE = 300
+
+# Telemetry retention: raw samples, then 1 minute and 1 hour rollups
+TELEMETRY_RAW_RETENTION_HOURS = 6
+TELEMETRY_MINUTE_RETENTION_DAYS = 7
+TELEMETRY_HOUR_RETENTION_DAYS = 365
+
+# /api/metrics/ is open to these addresses (and to superusers from anywhere), so are the
+# --metrics-port exporters of poll_printers and run_upload_worker
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+
+# seconds the rendered printer list on the dashboard is cached, saving a printer
+# clears it right away in the process that saved it, this catches the other workers
+PRINTER_LIST_CACHE_TIMEOUT = 300
+
+# Upload queue
+# files wait here until the upload worker has sent them to the printer
+UPLOAD_SPOOL_DIR = BASE_DIR / "spool"
+# transfers running at once, in total and per printer
+UPLOAD_WORKERS = 4
+UPLOAD_MAX_PER_PRINTER = 1
+# seconds before the first retry of a failed transfer, doubles on each attempt
+UPLOAD_RETRY_BACKOFF = 15
+# run the worker inside the web process, turn off when using `manage.py run_upload_worker`
+UPLOAD_WORKER_AUTOSTART = True
+
+# Resumable uploads from the browser (upload_sessions.py), chunks go to UPLOAD_SPOOL_DIR too
+# unfinished sessions nobody sent a chunk to within this long are dropped
+UPLOAD_SESSION_TTL_HOURS = 24
+# chunk size the browser is told to use, bytes
+UPLOAD_SESSION_CHUNK_SIZE = 8 * 1024 ** 2
+
+# Thumbnails of uploaded files (thumbnails.py), kept by content hash
+THUMBNAIL_DIR = BASE_DIR / "thumbnails"
+# the least recently served ones go once the cache is bigger than this
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 ** 2
+
+# Dispatch of uploads queued for a printer model or pool (dispatch.py)
+# seconds between dispatcher runs, new uploads trigger one right away
+DISPATCH_INTERVAL = 5.0
+# a job goes to a printer once that printer is free within this many seconds
+DISPATCH_LOOKAHEAD = 600
+# assumed length of a print whose file has no time estimate, seconds
+DISPATCH_DEFAULT_PRINT_TIME = 3600
+# a file sent to a printer that nobody started within this long stops reserving it
+DISPATCH_ASSIGNED_TTL_HOURS = 12
+
+# Cache
+# the printer status cache lives here, swap for a shared backend (file/redis)
+# when running several workers so they all share one collector
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'prusa-print-client',
+    }
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
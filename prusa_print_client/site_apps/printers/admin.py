@@ -1,9 +1,35 @@
 from django.contrib import admin
 
-from . models import Printers
+from . models import DispatchJob, PendingJobUsage, PrinterPool, Printers
 
 
 @admin.register(Printers)
 class PrintersAdmin(admin.ModelAdmin):
     search_fields = ['name']
-    prepopulated_fields = {'slug': ('name',)}
\ No newline at end of file
+    prepopulated_fields = {'slug': ('name',)}
+
+
+@admin.register(PendingJobUsage)
+class PendingJobUsageAdmin(admin.ModelAdmin):
+    list_display = ['remote_path', 'printer', 'filament_g', 'created_at']
+    list_filter = ['printer']
+    # __str__ and the printer column would fetch each row's printer otherwise
+    list_select_related = ['printer']
+    search_fields = ['remote_path', 'printer__slug']
+    raw_id_fields = ['printer']
+
+
+@admin.register(PrinterPool)
+class PrinterPoolAdmin(admin.ModelAdmin):
+    search_fields = ['name']
+    prepopulated_fields = {'slug': ('name',)}
+    filter_horizontal = ['printers']
+
+
+@admin.register(DispatchJob)
+class DispatchJobAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'target_model', 'pool', 'priority', 'status', 'printer', 'created_at']
+    list_filter = ['status', 'target_model', 'pool']
+    list_select_related = ['pool', 'printer']
+    search_fields = ['filename']
+    raw_id_fields = ['content', 'upload_job', 'print_job']
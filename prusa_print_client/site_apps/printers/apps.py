@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class PrintersConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'site_apps.printers'
+
+    def ready(self):
+        from . import clients  # noqa: F401, hooks up the client cache invalidation
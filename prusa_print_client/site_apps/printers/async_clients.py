@@ -0,0 +1,378 @@
+"""
+Async PrusaLink clients, one per printer, for the async views.
+
+PrinterClient (clients.py) holds a thread for as long as a call is in
+flight. AsyncPrinterClient speaks HTTP/1.1 itself over asyncio streams, so
+any number of printer calls share one event loop. PrusaLink only needs plain
+HTTP with an X-Api-Key header and Content-Length bodies, not worth a new
+dependency.
+
+It keeps PrinterClient's timeouts, retries, metrics and interface, and uses
+the very same PrinterHealth: both kinds of client share what they learn about
+a printer. Failures are raised as requests exceptions so every existing
+"printer is offline" path handles them as is.
+
+Keep-alive connections are only reused inside the event loop that opened
+them, and closed when that loop winds down: the dev server (and anything
+going through async_to_sync) runs every async view in a loop of its own.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+import requests
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import clients, metrics
+from .clients import _endpoint
+from .health import PrinterHealth, PrinterUnavailable
+
+
+# answers we retry idempotent calls on, like PrinterClient's Retry
+RETRY_STATUSES = (502, 503, 504)
+# never read more than this from a printer into memory
+MAX_RESPONSE_BYTES = 16 * 1024 ** 2
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class AsyncResponse:
+    """
+    What's left of requests.Response that we use: status_code, headers,
+    content, text, ok, json() and raise_for_status().
+    """
+
+    def __init__(self, method, url, status_code, reason, headers, content):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers  # lowercased names
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} {self.reason} for url: {self.url}", response=self)
+
+
+class AsyncUploadBody(clients.UploadBody):
+    """
+    clients.UploadBody for async iterables too.
+    """
+
+    async def __aiter__(self):
+        try:
+            async for chunk in _iter_body(self.body):
+                yield chunk
+        except Exception as e:
+            self.error = e
+            raise
+
+
+class _StaleConnection(Exception):
+    """A reused keep-alive connection was closed by the printer before it answered."""
+
+
+class AsyncPrinterClient:
+
+    def __init__(self, host, api_key, port=None, health=None, label=None):
+        self.host = str(host)
+        self.port = port or clients.PRUSALINK_PORT
+        self.base_url = f"http://{self.host}:{self.port}"
+        self.headers = {"X-Api-Key": str(api_key)}
+        self.label = label or self.host
+        self.health = health or PrinterHealth()
+        # event loop -> (idle (reader, writer) pairs, semaphore capping connections, closer task)
+        self._pools = {}
+
+    async def request(self, method, path, body=b"", headers=None, timeout=None, length=None):
+        if not self.health.allow_request():
+            metrics.printer_request_errors.inc(printer=self.label, type="circuit_open")
+            raise PrinterUnavailable(self.health)
+
+        connect_timeout, read_timeout = timeout or clients.PRINTER_REQUEST_TIMEOUT
+        retries = clients.PRINTER_REQUEST_RETRIES if method in ("GET", "HEAD") else 0
+        started = time.perf_counter()
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    await asyncio.sleep(clients.PRINTER_REQUEST_BACKOFF * 2 ** (attempt - 1))
+                try:
+                    resp = await self._send(method, path, body, headers or {}, connect_timeout, read_timeout, length)
+                except requests.RequestException:
+                    if attempt == retries:
+                        raise
+                    continue
+                if resp.status_code not in RETRY_STATUSES or attempt == retries:
+                    break
+        except requests.RequestException as e:
+            clients.record_call_failure(self, e, body)
+            raise
+        except BaseException:
+            self.health.release()
+            raise
+        finally:
+            metrics.printer_request_seconds.observe(
+                time.perf_counter() - started, printer=self.label, method=method, endpoint=_endpoint(path),
+            )
+
+        self.health.record_success()
+        if resp.status_code >= 500:
+            metrics.printer_request_errors.inc(printer=self.label, type=f"http_{resp.status_code // 100}xx")
+        return resp
+
+    def _pool(self):
+        """
+        The running loop's pool. Its closer task waits for the loop to wind
+        down: asyncio.run() (async_to_sync too) cancels it before closing the
+        loop, and it closes the idle connections on the way out.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            # loops closed without cancelling their tasks, their sockets go with the garbage
+            for closed in [other for other in list(self._pools) if other.is_closed()]:
+                self._pools.pop(closed, None)
+            pool = ([], asyncio.Semaphore(clients.PRINTER_POOL_SIZE), loop.create_task(self._close_pool(loop)))
+            self._pools[loop] = pool
+        return pool
+
+    async def _close_pool(self, loop):
+        try:
+            await loop.create_future()
+        finally:
+            idle, _, _ = self._pools.pop(loop, ([], None, None))
+            for _, writer in idle:
+                writer.close()
+            idle.clear()
+
+    async def _connect(self, idle, connect_timeout, reuse=True):
+        while idle and reuse:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), connect_timeout)
+        except asyncio.TimeoutError:
+            raise requests.ConnectTimeout(f"Connecting to {self.base_url} timed out")
+        except OSError as e:
+            raise requests.ConnectionError(f"Can't connect to {self.base_url}: {e}")
+        return reader, writer, False
+
+    async def _send(self, method, path, body, headers, connect_timeout, read_timeout, length):
+        pool = self._pool()
+        idle, slot, _ = pool
+        async with slot:
+            for _ in range(2):
+                # a streamed body can't be sent twice, so it never risks a stale connection
+                reader, writer, reused = await self._connect(idle, connect_timeout, reuse=isinstance(body, (bytes, bytearray)))
+                try:
+                    resp, keep_alive = await self._exchange(
+                        reader, writer, method, path, body, headers, read_timeout, length, reused,
+                    )
+                except _StaleConnection:
+                    writer.close()
+                    continue  # once more on a fresh connection
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive and self._pools.get(asyncio.get_running_loop()) is pool:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return resp
+        raise requests.ConnectionError(f"{self.base_url} keeps closing the connection")
+
+    async def _exchange(self, reader, writer, method, path, body, headers, read_timeout, length, reused):
+        if isinstance(body, (bytes, bytearray)):
+            length = len(body)
+        elif length is None:
+            length = len(body)
+
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        if length or method not in ("GET", "HEAD"):
+            head.append(f"Content-Length: {length}")
+        head += [f"{name}: {value}" for name, value in {**self.headers, **headers}.items()]
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            if isinstance(body, (bytes, bytearray)):
+                writer.write(body)
+                await asyncio.wait_for(writer.drain(), read_timeout)
+            else:
+                await asyncio.wait_for(writer.drain(), read_timeout)
+                async for chunk in _iter_body(body):
+                    writer.write(chunk)
+                    await asyncio.wait_for(writer.drain(), read_timeout)
+
+            status_line = await asyncio.wait_for(reader.readline(), read_timeout)
+            if not status_line:
+                raise asyncio.IncompleteReadError(b"", None)
+            _, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+            resp_headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), read_timeout)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                resp_headers[name.strip().lower()] = value.strip()
+
+            status = int(status)
+            content = b""
+            keep_alive = resp_headers.get("connection", "").lower() != "close"
+            if method != "HEAD" and status not in (204, 304) and status >= 200:
+                if resp_headers.get("transfer-encoding", "").lower() == "chunked":
+                    content = await self._read_chunked(reader, read_timeout)
+                elif "content-length" in resp_headers:
+                    size = int(resp_headers["content-length"])
+                    if size > MAX_RESPONSE_BYTES:
+                        raise requests.ConnectionError(f"{self.base_url} sent {size} bytes, too big")
+                    content = await asyncio.wait_for(reader.readexactly(size), read_timeout)
+                else:
+                    content = await asyncio.wait_for(reader.read(MAX_RESPONSE_BYTES), read_timeout)
+                    keep_alive = False
+        except requests.RequestException:
+            raise
+        except asyncio.TimeoutError:
+            raise requests.ReadTimeout(f"{self.base_url}{path} didn't answer in {read_timeout}s")
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            if reused and isinstance(e, asyncio.IncompleteReadError) and not e.partial:
+                raise _StaleConnection()
+            raise requests.ConnectionError(f"{self.base_url}{path}: connection dropped")
+        except (OSError, ValueError) as e:
+            raise requests.ConnectionError(f"{self.base_url}{path}: {e}")
+
+        return AsyncResponse(method, self.base_url + path, status, reason, resp_headers, content), keep_alive
+
+    async def _read_chunked(self, reader, read_timeout):
+        content = bytearray()
+        while True:
+            size = int((await asyncio.wait_for(reader.readline(), read_timeout)).split(b";")[0], 16)
+            if not size:
+                await asyncio.wait_for(reader.readline(), read_timeout)
+                return bytes(content)
+            if len(content) + size > MAX_RESPONSE_BYTES:
+                raise requests.ConnectionError(f"{self.base_url} sent too much")
+            content += await asyncio.wait_for(reader.readexactly(size + 2), read_timeout)
+            del content[-2:]
+
+    async def aclose(self):
+        pool = self._pools.get(asyncio.get_running_loop())
+        if pool is not None:
+            pool[2].cancel()
+            await asyncio.gather(pool[2], return_exceptions=True)
+
+    async def get_job(self):
+        return await self.request("GET", "/api/v1/job")
+
+    async def get_status(self):
+        return await self.request("GET", "/api/v1/status")
+
+    async def get_files(self, remoteDir="/"):
+        return await self.request("GET", "/api/v1/files/usb" + remoteDir)
+
+    async def put_stream(self, body, remoteDir, printAfterUpload=False, overwrite=False, length=None):
+        """
+        Like PrinterClient.put_stream(). `body` is bytes, an open file, or an
+        (async) iterable of bytes with a len() (or pass `length`).
+        """
+        headers = {}
+        if overwrite:
+            headers["Overwrite"] = "?1"
+        if printAfterUpload:
+            headers["Print-After-Upload"] = "?1"
+
+        if length is None:
+            length = len(body) if hasattr(body, "__len__") else os.fstat(body.fileno()).st_size
+        if not isinstance(body, (bytes, bytearray)):
+            body = AsyncUploadBody(body, length)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            resp = await self.request(
+                "PUT", "/api/v1/files/usb/" + remoteDir,
+                body=body, headers=headers, timeout=clients.PRINTER_UPLOAD_TIMEOUT, length=length,
+            )
+            outcome = "ok" if resp.ok else "rejected"
+            return resp
+        finally:
+            metrics.printer_upload_seconds.observe(time.perf_counter() - started, printer=self.label, outcome=outcome)
+            if outcome == "ok":
+                metrics.printer_upload_bytes.inc(length, printer=self.label)
+
+    async def exists_gcode(self, remoteDir):
+        return (await self.request("HEAD", "/api/v1/files/usb/" + remoteDir)).status_code == 200
+
+    async def delete(self, filePathRemote):
+        return await self.request("DELETE", "/api/v1/files/usb" + filePathRemote)
+
+    async def _job_command(self, method, suffix=""):
+        # None if there's no active job, same as PrinterClient
+        job_info = await self.get_job()
+        if "{" not in job_info.text or "id" not in job_info.json():
+            return None
+        return await self.request(method, f"/api/v1/job/{job_info.json()['id']}{suffix}")
+
+    async def pause_print(self):
+        return await self._job_command("PUT", "/pause")
+
+    async def resume_print(self):
+        return await self._job_command("PUT", "/resume")
+
+    async def stop_print(self):
+        return await self._job_command("DELETE")
+
+
+async def _iter_body(body):
+    if hasattr(body, "__aiter__"):
+        async for chunk in body:
+            yield chunk
+    elif hasattr(body, "read"):
+        while chunk := body.read(UPLOAD_CHUNK_SIZE):
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_async_client(printer) -> AsyncPrinterClient:
+    """
+    get_client() for async code: the shared AsyncPrinterClient of a Printers
+    row, rebuilt when its host, api_key or the PrusaLink port changed.
+    """
+    fingerprint = (str(printer.host), str(printer.api_key), clients.PRUSALINK_PORT)
+
+    with _clients_lock:
+        cached = _clients.get(printer.pk)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+    # same breaker as the sync client of this printer
+    health = clients.get_client(printer).health
+    client = AsyncPrinterClient(printer.host, printer.api_key, port=fingerprint[2], health=health, label=printer.slug)
+    with _clients_lock:
+        _clients[printer.pk] = (fingerprint, client)
+    return client
+
+
+@receiver(post_delete, sender="printers.Printers")
+def _drop_deleted_printer_async_client(sender, instance, **kwargs):
+    with _clients_lock:
+        _clients.pop(instance.pk, None)
@@ -0,0 +1,369 @@
+"""
+Reads the print metadata (filament usage, estimated time, ...) out of sliced
+Prusa files without loading or decompressing the gcode itself.
+
+.bgcode is a binary block format (libbgcode spec):
+
+  file header   "GCDE" | version u32 | checksum type u16
+  block header  type u16 | compression u16 | uncompressed size u32 [| compressed size u32]
+  block params  2 bytes (encoding), 6 bytes for thumbnails (format, width, height)
+  payload       compressed size (or uncompressed size) bytes
+  checksum      4 bytes if the file uses CRC32
+
+Metadata and thumbnail blocks always come before the first gcode block, so we
+walk the headers, read the metadata and thumbnail blocks and stop as soon as
+the gcode starts. Plain .gcode has its summary at the end, so that gets read
+from the tail instead, and its thumbnails (base64 in comments) from the head.
+"""
+import base64
+import io
+import re
+import struct
+import zlib
+
+
+MAGIC = b"GCDE"
+
+# block types
+FILE_METADATA = 0
+GCODE = 1
+SLICER_METADATA = 2
+PRINTER_METADATA = 3
+PRINT_METADATA = 4
+THUMBNAIL = 5
+
+METADATA_BLOCKS = (FILE_METADATA, SLICER_METADATA, PRINTER_METADATA, PRINT_METADATA)
+
+# compression types, only these two are readable without extra libraries
+COMPRESSION_NONE = 0
+COMPRESSION_DEFLATE = 1
+
+# never buffer a single metadata block bigger than this
+MAX_METADATA_BLOCK = 1024 * 1024
+# same for thumbnails, and we keep at most this many of them
+MAX_THUMBNAIL_BLOCK = 1024 * 1024
+MAX_THUMBNAILS = 8
+THUMBNAIL_FORMATS = {0: "png", 1: "jpg", 2: "qoi"}
+# how much of a plain .gcode file we look at from the end (and start)
+GCODE_SCAN_BYTES = 64 * 1024
+# thumbnails sit at the very top of a .gcode, but can be big
+GCODE_THUMBNAIL_SCAN_BYTES = 1024 * 1024
+READ_SIZE = 16 * 1024
+
+FILAMENT_RE = re.compile(r"^filament used \[([^\]]+)\]$")
+GCODE_COMMENT_RE = re.compile(r"^;\s*([^=]+?)\s*=\s*(.*)$")
+DURATION_RE = re.compile(r"(\d+)\s*([dhms])")
+DURATION_UNITS = {"d": 86400, "h": 3600, "m": 60, "s": 1}
+GCODE_THUMBNAIL_RE = re.compile(
+    rb"^; thumbnail(?:_(QOI|JPG|PNG))? begin (\d+)x(\d+) \d+\s*$(.*?)^; thumbnail(?:_\w+)? end",
+    re.M | re.S,
+)
+GCODE_THUMBNAIL_MARKER_RE = re.compile(rb"; thumbnail(?:_\w+)? (begin|end)")
+
+
+class MetadataReader:
+    """
+    Push parser, feed it the file in chunks of any size and ask for result().
+    Memory stays bounded: skipped blocks are only counted, never buffered.
+
+    A driver that can seek should call take_skip() before each read and jump
+    over that many bytes instead of feeding them.
+    """
+
+    def __init__(self):
+        self.format = None  # "bgcode" | "gcode"
+        self.done = False
+        self.metadata = {}
+        # {"format": "png"|"jpg"|"qoi", "width", "height", "data": bytes}, not part of result()
+        self.thumbnails = []
+
+        self._buf = bytearray()
+        self._skip = 0
+        self._checksum_size = 0
+        self._block = None  # (type, compression, params size, payload size) being read
+
+        # plain gcode: the top (up to GCODE_THUMBNAIL_SCAN_BYTES) and last GCODE_SCAN_BYTES
+        self._head = bytearray()
+        self._head_done = False
+        self._tail = bytearray()
+
+    def feed(self, data):
+        if self.done or not data:
+            return
+
+        data = memoryview(data)
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+
+        if self.format == "gcode":
+            self._feed_gcode(data)
+            return
+
+        self._buf += data
+        self._process()
+
+    def take_skip(self) -> int:
+        skip, self._skip = self._skip, 0
+        return skip
+
+    def wants_head(self) -> bool:
+        """
+        Plain gcode: whether the top of the file may still have thumbnails
+        coming. A seeking driver keeps reading until this is False, then
+        calls jump() and goes on at the tail.
+        """
+        if self._head_done or len(self._head) >= GCODE_THUMBNAIL_SCAN_BYTES:
+            return False
+        if len(self._head) < GCODE_SCAN_BYTES:
+            return True
+        # past the usual comment header, only a thumbnail that's still open keeps us reading
+        end = len(self._head)
+        while (end := self._head.rfind(b"\n; thumbnail", 0, end)) != -1:
+            m = GCODE_THUMBNAIL_MARKER_RE.match(self._head, end + 1)
+            if m:
+                return m.group(1) == b"begin"
+        return False
+
+    def jump(self):
+        """
+        The driver skipped part of a plain gcode file, what comes next belongs
+        to the tail and isn't glued onto what came before.
+        """
+        self._head_done = True
+        self._tail = bytearray()
+
+    def close(self):
+        """
+        No more data coming. For plain gcode this is when the summary gets parsed.
+        """
+        if self.format == "gcode" and not self.done:
+            self._parse_gcode_text(bytes(self._tail))
+            if not self.filament:
+                self._parse_gcode_text(bytes(self._head[:GCODE_SCAN_BYTES]))
+            self._parse_gcode_thumbnails(bytes(self._head))
+        self.done = True
+
+    @property
+    def filament(self) -> dict:
+        usage = {}
+        for key, value in self.metadata.items():
+            m = FILAMENT_RE.match(key)
+            if m:
+                amount = _parse_number(value)
+                if amount is not None:
+                    usage[m.group(1).strip()] = amount
+        return usage
+
+    @property
+    def estimated_time(self):
+        value = self.metadata.get("estimated printing time (normal mode)")
+        return _parse_duration(value) if value else None
+
+    def result(self) -> dict:
+        """
+        Returns a dict like:
+          {
+            "format": "bgcode",
+            "filament": {"mm": 12345.67, "g": 98.7, "cm3": 12.34},
+            "estimated_time": 5025,  # seconds, or None
+            "metadata": {...every key=value we found...},
+          }
+        """
+        return {
+            "format": self.format,
+            "filament": self.filament,
+            "estimated_time": self.estimated_time,
+            "metadata": dict(self.metadata),
+        }
+
+    ### bgcode
+
+    def _process(self):
+        while not self.done:
+            if self.format is None:
+                if len(self._buf) < 10:
+                    if len(self._buf) >= 4 and self._buf[:4] != MAGIC:
+                        self._switch_to_gcode()
+                    return
+                if self._buf[:4] != MAGIC:
+                    self._switch_to_gcode()
+                    return
+
+                _, checksum_type = struct.unpack_from("<IH", self._buf, 4)
+                self._checksum_size = 4 if checksum_type == 1 else 0
+                self.format = "bgcode"
+                del self._buf[:10]
+
+            elif self._block is None:
+                if len(self._buf) < 8:
+                    return
+                block_type, compression, size = struct.unpack_from("<HHI", self._buf)
+                header_size = 8
+                if compression != COMPRESSION_NONE:
+                    if len(self._buf) < 12:
+                        return
+                    (size,) = struct.unpack_from("<I", self._buf, 8)
+                    header_size = 12
+
+                if block_type == GCODE:
+                    # everything after this is gcode, we have what we came for
+                    self.done = True
+                    self._buf.clear()
+                    return
+
+                params_size = 6 if block_type == THUMBNAIL else 2
+                del self._buf[:header_size]
+
+                if block_type in METADATA_BLOCKS and size <= MAX_METADATA_BLOCK:
+                    self._block = (block_type, compression, params_size, size)
+                elif (block_type == THUMBNAIL and compression == COMPRESSION_NONE
+                        and size <= MAX_THUMBNAIL_BLOCK and len(self.thumbnails) < MAX_THUMBNAILS):
+                    self._block = (block_type, compression, params_size, size)
+                else:
+                    self._skip_bytes(params_size + size + self._checksum_size)
+
+            else:
+                block_type, compression, params_size, size = self._block
+                total = params_size + size + self._checksum_size
+                if len(self._buf) < total:
+                    return
+                params = bytes(self._buf[:params_size])
+                payload = bytes(self._buf[params_size:params_size + size])
+                del self._buf[:total]
+                self._block = None
+                if block_type == THUMBNAIL:
+                    self._read_thumbnail_block(params, payload)
+                else:
+                    self._read_metadata_block(block_type, compression, payload)
+
+    def _skip_bytes(self, count):
+        buffered = min(count, len(self._buf))
+        del self._buf[:buffered]
+        self._skip += count - buffered
+
+    def _read_metadata_block(self, block_type, compression, payload):
+        if compression == COMPRESSION_DEFLATE:
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error:
+                return
+        elif compression != COMPRESSION_NONE:
+            # heatshrink, not worth a dependency for metadata we can live without
+            return
+
+        for line in payload.decode("utf-8", errors="ignore").splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                # print metadata wins over printer metadata for duplicate keys
+                if block_type == PRINT_METADATA or key.strip() not in self.metadata:
+                    self.metadata[key.strip()] = value.strip()
+
+    def _read_thumbnail_block(self, params, payload):
+        image_format, width, height = struct.unpack("<HHH", params)
+        if image_format in THUMBNAIL_FORMATS:
+            self.thumbnails.append(
+                {"format": THUMBNAIL_FORMATS[image_format], "width": width, "height": height, "data": payload}
+            )
+
+    ### plain gcode
+
+    def _switch_to_gcode(self):
+        self.format = "gcode"
+        data, self._buf = bytes(self._buf), bytearray()
+        self._feed_gcode(memoryview(data))
+
+    def _feed_gcode(self, data):
+        if not self._head_done and len(self._head) < GCODE_THUMBNAIL_SCAN_BYTES:
+            self._head += data[:GCODE_THUMBNAIL_SCAN_BYTES - len(self._head)]
+        self._tail += data
+        if len(self._tail) > GCODE_SCAN_BYTES:
+            del self._tail[:len(self._tail) - GCODE_SCAN_BYTES]
+
+    def _parse_gcode_text(self, data):
+        for line in data.decode("utf-8", errors="ignore").splitlines():
+            m = GCODE_COMMENT_RE.match(line.strip())
+            if m:
+                self.metadata.setdefault(m.group(1), m.group(2).strip())
+
+    def _parse_gcode_thumbnails(self, data):
+        for m in GCODE_THUMBNAIL_RE.finditer(data):
+            if len(self.thumbnails) >= MAX_THUMBNAILS:
+                break
+            encoded = b"".join(line.lstrip(b";").strip() for line in m.group(4).splitlines())
+            try:
+                image = base64.b64decode(encoded, validate=True)
+            except ValueError:
+                continue
+            self.thumbnails.append({
+                "format": (m.group(1) or b"PNG").decode().lower(),
+                "width": int(m.group(2)),
+                "height": int(m.group(3)),
+                "data": image,
+            })
+
+
+def read_print_metadata(file_obj) -> dict:
+    """
+    Given a sliced .bgcode or .gcode file object, returns what
+    MetadataReader.result() describes. Seeks past everything it doesn't need
+    when the file allows it, and rewinds the file when done.
+    """
+    reader = MetadataReader()
+    seekable = _is_seekable(file_obj)
+
+    try:
+        reader.feed(file_obj.read(10))
+
+        if reader.format == "gcode" and seekable:
+            # thumbnails are at the top and the summary at the end, don't read the middle at all
+            while reader.wants_head():
+                chunk = file_obj.read(READ_SIZE)
+                if not chunk:
+                    break
+                reader.feed(chunk)
+            head_end = file_obj.tell()
+            tail_start = max(file_obj.seek(0, io.SEEK_END) - GCODE_SCAN_BYTES, head_end)
+            file_obj.seek(tail_start)
+            if tail_start > head_end:
+                reader.jump()
+        while not reader.done:
+            skip = reader.take_skip() if seekable else 0
+            if skip:
+                file_obj.seek(skip, io.SEEK_CUR)
+
+            chunk = file_obj.read(READ_SIZE)
+            if not chunk:
+                break
+            reader.feed(chunk)
+        reader.close()
+    finally:
+        # rewind so later code can re-read the file if needed
+        if seekable:
+            file_obj.seek(0)
+
+    return reader.result()
+
+
+def _is_seekable(file_obj):
+    try:
+        return file_obj.seekable()
+    except AttributeError:
+        return hasattr(file_obj, "seek")
+
+
+def _parse_number(value):
+    # multi-extruder files list one value per extruder, "12.3, 4.5"
+    try:
+        return sum(float(part) for part in value.split(",") if part.strip())
+    except ValueError:
+        return None
+
+
+def _parse_duration(value):
+    # PrusaSlicer writes durations like "1d 2h 3m 4s"
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(int(amount) * DURATION_UNITS[unit] for amount, unit in parts)
@@ -0,0 +1,123 @@
+"""
+One upload, many printers.
+
+The file comes in once, gets spooled (hashed and parsed on the way, or its
+metadata reused if we know the content), then goes out to every target
+printer at the same time. Printers we already put it on only get a HEAD to
+see it's still there, in the same pool. Bookkeeping for all printers that
+got it is written in bulk at the end.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import uuid
+
+import requests
+from django.db import transaction
+
+from .clients import get_client
+from .content import ContentMismatch, lookup_content, needs_parsing, remember_upload
+from .models import PendingJobUsage, PrinterFile
+from .upload_queue import UPLOAD_SPOOL_DIR
+from .uploads import UploadStream
+from .utils import PRINTER_POLL_WORKERS
+
+
+def _send(printer, spool_path, remote_path):
+    """
+    Transfers the spooled file to one printer, returns (ok, error).
+    Runs in a worker thread, so no database access in here.
+    """
+    try:
+        with open(spool_path, "rb") as f:
+            # NO AUTOSTART, THEY MUST BE AT THE PRINTER
+            resp = get_client(printer).put_stream(f, remote_path, printAfterUpload=False, overwrite=True)
+    except (requests.RequestException, OSError) as e:
+        return False, str(e) or e.__class__.__name__
+    if not resp.ok:
+        return False, f"Printer answered {resp.status_code}: {resp.text[:500]}"
+    return True, None
+
+
+def _deliver(printer, spool_path, remote_path, placed):
+    """
+    One printer's share of a broadcast, returns its result. If we `placed`
+    this file there before, a HEAD first: when it's still there nothing gets
+    sent. Runs in a worker thread, so no database access in here.
+    """
+    if placed:
+        try:
+            if get_client(printer).exists_gcode(remote_path):
+                return {"ok": True, "deduplicated": True, "error": None}
+        except requests.RequestException:
+            # can't tell, send it again to be safe
+            pass
+    ok, error = _send(printer, spool_path, remote_path)
+    return {"ok": ok, "deduplicated": False, "error": error}
+
+
+def broadcast_upload(printers, filename, length, chunks, sha256=None) -> dict:
+    """
+    Sends one incoming file to every printer in `printers`.
+
+    Returns {"content": UploadedContent, "remote_path": ..., "results": {printer: {...}}}
+    where each result has ok / deduplicated / error. Raises ContentMismatch
+    if `sha256` was given and the bytes don't match it.
+    """
+    UPLOAD_SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    remote_name = Path(filename).name
+    remote_path = f"PRINT_QUEUE/{remote_name}"
+    spool_path = UPLOAD_SPOOL_DIR / f"{uuid.uuid4().hex}{Path(remote_name).suffix}"
+
+    try:
+        known = lookup_content(sha256)
+        body = UploadStream(chunks, length, parse=needs_parsing(known))
+        size = body.spool_to(spool_path)
+        if sha256 and body.sha256 != sha256:
+            raise ContentMismatch(f"Expected sha256 {sha256}, got {body.sha256}")
+        content = remember_upload(known, body, size, remote_name)
+
+        # where we put this exact file before, the HEAD checks run alongside the sends
+        placed = set(
+            PrinterFile.objects.filter(printer__in=printers, remote_path=remote_path, content=content)
+            .values_list("printer_id", flat=True)
+        )
+        results = {}
+        if printers:
+            with ThreadPoolExecutor(max_workers=min(len(printers), PRINTER_POLL_WORKERS)) as pool:
+                sent = pool.map(lambda printer: _deliver(printer, spool_path, remote_path, printer.pk in placed), printers)
+                results = dict(zip(printers, sent))
+    finally:
+        try:
+            os.unlink(spool_path)
+        except FileNotFoundError:
+            pass
+
+    delivered = [printer for printer, result in results.items() if result["ok"]]
+    lost = [printer for printer, result in results.items() if not result["ok"] and printer.pk in placed]
+    filament = content.as_metadata()["filament"]
+
+    with transaction.atomic():
+        # the copy we had there is gone or half overwritten
+        PrinterFile.objects.filter(printer__in=lost, remote_path=remote_path).delete()
+        PrinterFile.objects.bulk_create(
+            [PrinterFile(printer=printer, remote_path=remote_path, content=content) for printer in delivered],
+            update_conflicts=True,
+            unique_fields=["printer", "remote_path"],
+            update_fields=["content", "uploaded_at"],
+        )
+        if filament:
+            # same as content.record_pending_usage(), one row per printer and path
+            PendingJobUsage.objects.filter(printer__in=delivered, remote_path=remote_path).delete()
+            PendingJobUsage.objects.bulk_create([
+                PendingJobUsage(
+                    printer=printer,
+                    remote_path=remote_path,
+                    filament_mm=filament.get("mm"),
+                    filament_g=filament.get("g"),
+                    filament_cm3=filament.get("cm3"),
+                )
+                for printer in delivered
+            ])
+
+    return {"content": content, "remote_path": remote_path, "results": results}
@@ -0,0 +1,273 @@
+"""
+Process-wide registry of PrusaLink clients, one per printer.
+
+PrusaLinkPy calls requests.get() etc. directly, so every call opens a new TCP
+connection with no timeout. PrinterClient keeps the same interface but sends
+everything through one keep-alive requests.Session per printer, with a
+connection pool, (connect, read) timeouts and retry-with-backoff on reads.
+Each client also carries the printer's circuit breaker (health.py).
+"""
+import os
+import re
+import threading
+import time
+
+import PrusaLinkPy
+import requests
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+from .health import PrinterHealth, PrinterUnavailable, is_printer_failure
+
+
+# (connect, read) timeout in seconds for regular calls
+PRINTER_REQUEST_TIMEOUT = getattr(settings, "PRINTER_REQUEST_TIMEOUT", (2.0, 3.0))
+# (connect, read) timeout for uploads, read covers the printer writing the file to USB
+PRINTER_UPLOAD_TIMEOUT = getattr(settings, "PRINTER_UPLOAD_TIMEOUT", (3.0, 300.0))
+# retries for idempotent calls (GET/HEAD), with exponential backoff between them
+PRINTER_REQUEST_RETRIES = getattr(settings, "PRINTER_REQUEST_RETRIES", 2)
+PRINTER_REQUEST_BACKOFF = getattr(settings, "PRINTER_REQUEST_BACKOFF", 0.25)
+# keep-alive connections kept open per printer
+PRINTER_POOL_SIZE = getattr(settings, "PRINTER_POOL_SIZE", 4)
+PRUSALINK_PORT = getattr(settings, "PRUSALINK_PORT", 80)
+
+# bytes read at a time from a file given to put_stream()
+UPLOAD_READ_SIZE = 64 * 1024
+
+# file names and job ids would make a new metrics series per call
+ENDPOINT_RE = re.compile(r"^(/api/v1/files)/.*$|/\d+")
+
+
+def _endpoint(path):
+    return ENDPOINT_RE.sub(lambda m: m.group(1) or "/:id", path)
+
+
+class UploadBody:
+    """
+    put_stream() body that remembers when reading our side of it failed (a
+    browser aborting a streamed upload, a spool file going away). requests
+    turns that into a ConnectionError like any other, this is how
+    record_call_failure() tells it apart from the printer going away.
+    """
+
+    def __init__(self, body, length):
+        self.body = body
+        self.length = length
+        self.error = None
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        chunks = iter(lambda: self.body.read(UPLOAD_READ_SIZE), b"") if hasattr(self.body, "read") else self.body
+        try:
+            for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            self.error = e
+            raise
+
+
+def record_call_failure(client, error, body=None):
+    """
+    Books a failed call against the printer's circuit breaker if it was the
+    printer's fault, shared by PrinterClient and AsyncPrinterClient.
+    """
+    if getattr(body, "error", None) is not None:
+        # the upload broke on our side, the printer may be perfectly fine
+        client.health.release()
+        metrics.printer_request_errors.inc(printer=client.label, type="upload_source")
+        return
+    if is_printer_failure(error):
+        client.health.record_failure(metrics.error_type(error))
+    else:
+        client.health.release()
+    metrics.printer_request_errors.inc(printer=client.label, type=metrics.error_type(error))
+
+
+class PrinterClient(PrusaLinkPy.PrusaLinkPy):
+    """
+    Drop-in PrusaLinkPy replacement backed by a pooled session.
+    Only methods we actually use are overridden, all return a requests.Response.
+    """
+
+    def __init__(self, host: str, api_key: str, port=None) -> None:
+        super().__init__(host, api_key, port=port or PRUSALINK_PORT)
+        self.base_url = f"http://{self.host}:{self.port}"
+        # what metrics call this printer, get_client() sets it to the slug
+        self.label = host
+        self.health = PrinterHealth()
+
+        retry = Retry(
+            total=PRINTER_REQUEST_RETRIES,
+            backoff_factor=PRINTER_REQUEST_BACKOFF,
+            status_forcelist=(502, 503, 504),
+            # never replay a PUT/DELETE/POST, the printer might have acted on it
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PRINTER_POOL_SIZE, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, path, timeout=None, **kwargs):
+        if not self.health.allow_request():
+            # known to be down, don't wait out a timeout to find out again
+            metrics.printer_request_errors.inc(printer=self.label, type="circuit_open")
+            raise PrinterUnavailable(self.health)
+
+        started = time.perf_counter()
+        try:
+            resp = self.session.request(method, self.base_url + path, timeout=timeout or PRINTER_REQUEST_TIMEOUT, **kwargs)
+        except requests.RequestException as e:
+            record_call_failure(self, e, kwargs.get("data"))
+            raise
+        except BaseException:
+            self.health.release()
+            raise
+        finally:
+            metrics.printer_request_seconds.observe(
+                time.perf_counter() - started, printer=self.label, method=method, endpoint=_endpoint(path),
+            )
+
+        # it answered, whatever it said
+        self.health.record_success()
+        if resp.status_code >= 500:
+            metrics.printer_request_errors.inc(printer=self.label, type=metrics.error_type(resp))
+        return resp
+
+    def close(self):
+        self.session.close()
+
+    def get_version(self):
+        return self.request("GET", "/api/version")
+
+    def get_printer(self):
+        return self.request("GET", "/api/printer")
+
+    def get_job(self):
+        return self.request("GET", "/api/v1/job")
+
+    def delete_job(self, job):
+        return self.request("DELETE", f"/api/v1/job/{job}")
+
+    def get_status(self):
+        return self.request("GET", "/api/v1/status")
+
+    def get_storage(self):
+        return self.request("GET", "/api/v1/storage")
+
+    def get_files(self, remoteDir="/"):
+        return self.request("GET", "/api/v1/files/usb" + remoteDir)
+
+    def put_gcode(self, filePathLocal, remoteDir, printAfterUpload=False, overwrite=False):
+        with open(filePathLocal, "rb") as f:
+            return self.put_stream(f, remoteDir, printAfterUpload=printAfterUpload, overwrite=overwrite)
+
+    def put_stream(self, body, remoteDir, printAfterUpload=False, overwrite=False):
+        """
+        Like put_gcode() but sends `body` as-is: an open file, or any iterable
+        of bytes that also has a len() so we can send a Content-Length
+        (PrusaLink doesn't take chunked uploads).
+        """
+        headers = {}
+        if overwrite:
+            headers["Overwrite"] = "?1"
+        if printAfterUpload:
+            headers["Print-After-Upload"] = "?1"
+
+        size = len(body) if hasattr(body, "__len__") else os.fstat(body.fileno()).st_size
+        if not isinstance(body, (bytes, bytearray)):
+            body = UploadBody(body, size)
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            resp = self.request(
+                "PUT",
+                "/api/v1/files/usb/" + remoteDir,
+                headers=headers,
+                data=body,
+                timeout=PRINTER_UPLOAD_TIMEOUT,
+            )
+            outcome = "ok" if resp.ok else "rejected"
+            return resp
+        finally:
+            # bytes/s is rate(printer_upload_bytes_total) or bytes over printer_upload_seconds_sum
+            metrics.printer_upload_seconds.observe(time.perf_counter() - started, printer=self.label, outcome=outcome)
+            if outcome == "ok":
+                metrics.printer_upload_bytes.inc(size, printer=self.label)
+
+    def exists_gcode(self, remoteDir):
+        return self.request("HEAD", "/api/v1/files/usb/" + remoteDir).status_code == 200
+
+    def delete(self, filePathRemote):
+        return self.request("DELETE", "/api/v1/files/usb" + filePathRemote)
+
+    def _job_command(self, method, suffix=""):
+        # None if there's no active job, same as PrusaLinkPy
+        job_info = self.get_job()
+        if "{" not in job_info.text or "id" not in job_info.json():
+            return None
+        return self.request(method, f"/api/v1/job/{job_info.json()['id']}{suffix}")
+
+    def pause_print(self):
+        return self._job_command("PUT", "/pause")
+
+    def resume_print(self):
+        return self._job_command("PUT", "/resume")
+
+    def stop_print(self):
+        return self._job_command("DELETE")
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(printer) -> PrinterClient:
+    """
+    Returns the shared client for a Printers row, building a new one if the
+    row's host or api_key changed since we last saw it.
+    """
+    fingerprint = (str(printer.host), str(printer.api_key))
+
+    with _clients_lock:
+        cached = _clients.get(printer.pk)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        client = PrinterClient(*fingerprint)
+        client.label = printer.slug
+
+        if cached is not None:
+            cached[1].close()
+            if cached[0][0] == fingerprint[0]:
+                # same printer, new key: it's just as reachable as before
+                client.health = cached[1].health
+        _clients[printer.pk] = (fingerprint, client)
+        return client
+
+
+def get_health(printer) -> dict:
+    """
+    Circuit breaker state of a printer, see health.PrinterHealth.snapshot().
+    """
+    return get_client(printer).health.snapshot()
+
+
+def invalidate_client(pk):
+    with _clients_lock:
+        cached = _clients.pop(pk, None)
+    if cached is not None:
+        cached[1].close()
+
+
+@receiver(post_delete, sender="printers.Printers")
+def _drop_deleted_printer_client(sender, instance, **kwargs):
+    invalidate_client(instance.pk)
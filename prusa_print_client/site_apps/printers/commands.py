@@ -0,0 +1,73 @@
+"""
+Print commands (pause/resume/stop), for one printer or many at once.
+
+Every printer gets its command through its AsyncPrinterClient, all of them
+at the same time, each with its own PRINTER_COMMAND_TIMEOUT, so stopping the
+whole farm takes about as long as the slowest printer (and a dead one fails
+right away once its circuit is open). Each printer comes back as one
+outcome:
+
+  done         the printer took the command
+  no_job       nothing printing, nothing to do
+  rejected     the printer answered with an error (e.g. 409, already paused)
+  unavailable  couldn't reach it
+  timeout      it didn't finish within the timeout
+"""
+import asyncio
+
+import requests
+from django.conf import settings
+
+from . import metrics
+from .async_clients import get_async_client
+
+
+# seconds one printer gets to carry out a command (looking up its job included)
+PRINTER_COMMAND_TIMEOUT = getattr(settings, "PRINTER_COMMAND_TIMEOUT", 10.0)
+
+# action -> AsyncPrinterClient method
+ACTIONS = {
+    "pause": "pause_print",
+    "resume": "resume_print",
+    "stop": "stop_print",
+}
+
+DONE = "done"
+NO_JOB = "no_job"
+REJECTED = "rejected"
+UNAVAILABLE = "unavailable"
+TIMEOUT = "timeout"
+
+
+async def run_command(printer, action, timeout=None) -> dict:
+    """
+    Sends `action` to one printer. Returns {"outcome", "ok", "status_code", "error"}.
+    """
+    client = get_async_client(printer)
+    result = {"outcome": DONE, "ok": True, "status_code": None, "error": None}
+    try:
+        resp = await asyncio.wait_for(getattr(client, ACTIONS[action])(), timeout or PRINTER_COMMAND_TIMEOUT)
+    except asyncio.TimeoutError:
+        result.update(outcome=TIMEOUT, ok=False, error="Printer didn't answer in time")
+    except (requests.RequestException, ValueError) as e:
+        # ValueError: garbage instead of job json
+        result.update(outcome=UNAVAILABLE, ok=False, error=client.health.snapshot()["reason"] or str(e))
+    else:
+        if resp is None:
+            result.update(outcome=NO_JOB, ok=False, error="No active print")
+        else:
+            result["status_code"] = resp.status_code
+            if not resp.ok:
+                result.update(outcome=REJECTED, ok=False, error=resp.text or f"HTTP {resp.status_code}")
+
+    metrics.printer_commands.inc(action=action, outcome=result["outcome"])
+    return result
+
+
+async def run_bulk(printers, action, timeout=None) -> dict:
+    """
+    run_command() on every printer concurrently, {slug: result}.
+    """
+    printers = list(printers)
+    results = await asyncio.gather(*(run_command(printer, action, timeout) for printer in printers))
+    return {printer.slug: result for printer, result in zip(printers, results)}
@@ -0,0 +1,160 @@
+"""
+Upload deduplication by content hash.
+
+Every upload gets hashed (sha256) on its way through UploadStream. The first
+time we see some content its parsed metadata goes into UploadedContent, and
+every file we put on a printer is recorded as a PrinterFile. So:
+
+  same content again        -> metadata comes from UploadedContent, no parsing
+  same content, same path,
+  still on that printer     -> no transfer either, just a new PendingJobUsage
+
+Thumbnails are kept by the same hash, see thumbnails.py.
+
+The browser can send the hash up front (X-Content-SHA256, or ask
+upload_check_api first) so known content isn't parsed again. That hash is
+only a claim until the bytes are in: whether a printer already has a file
+is always decided on the hash we computed ourselves.
+"""
+import re
+
+import requests
+
+from .clients import get_client
+from .models import PendingJobUsage, PrinterFile, PrintJob, UploadedContent
+from .thumbnails import has_thumbnails, list_variants, store_thumbnails
+
+
+SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ContentMismatch(ValueError):
+    """The bytes we got don't hash to what the client said they would."""
+
+
+def parse_sha256(value):
+    """
+    Normalized hex digest from a header/query value, None if it's missing or malformed.
+    """
+    value = (value or "").strip().lower()
+    return value if SHA256_RE.match(value) else None
+
+
+def lookup_content(sha256):
+    if not sha256:
+        return None
+    return UploadedContent.objects.filter(sha256=sha256).first()
+
+
+def remember_content(sha256, size, filename, metadata) -> UploadedContent:
+    """
+    Stores what we parsed out of some content, or returns what we already had.
+    `metadata` is a bgcode.read_print_metadata() dict.
+    """
+    filament = metadata.get("filament") or {}
+    content, _ = UploadedContent.objects.get_or_create(
+        sha256=sha256,
+        defaults={
+            "size": size,
+            "filename": filename,
+            "format": metadata.get("format") or "",
+            "filament_mm": filament.get("mm"),
+            "filament_g": filament.get("g"),
+            "filament_cm3": filament.get("cm3"),
+            "estimated_time": metadata.get("estimated_time"),
+            "metadata": metadata.get("metadata") or {},
+        },
+    )
+    return content
+
+
+def needs_parsing(known) -> bool:
+    """
+    Whether an upload of `known` content (lookup_content(), may be None) has
+    to go through the metadata reader. Content from before thumbnails were
+    kept, or whose thumbnails got evicted, is read once more for them.
+    """
+    return known is None or not has_thumbnails(known.sha256)
+
+
+def remember_upload(known, body, size, filename) -> UploadedContent:
+    """
+    remember_content() for a consumed UploadStream, plus its thumbnails.
+    """
+    if not has_thumbnails(body.sha256):
+        store_thumbnails(body.sha256, body.thumbnails)
+    return known or remember_content(body.sha256, size, filename, body.metadata)
+
+
+def printer_has_content(printer, remote_path, content) -> bool:
+    """
+    Whether `remote_path` on the printer already holds `content`. Checks the
+    file is really still there (someone may have deleted it at the printer),
+    a HEAD is a lot cheaper than sending it again.
+    """
+    if content is None:
+        return False
+
+    known = PrinterFile.objects.filter(printer=printer, remote_path=remote_path, content=content)
+    if not known.exists():
+        return False
+
+    try:
+        if get_client(printer).exists_gcode(remote_path):
+            return True
+    except requests.RequestException:
+        # can't tell, send it again to be safe
+        return False
+
+    known.delete()
+    return False
+
+
+def record_printer_file(printer, remote_path, content):
+    PrinterFile.objects.update_or_create(printer=printer, remote_path=remote_path, defaults={"content": content})
+
+
+def record_pending_usage(printer, remote_path, filament):
+    """
+    The PendingJobUsage for a file that just landed on a printer, updating
+    the one already there for that path instead of piling up duplicates.
+    """
+    if filament.get("mm") is None and filament.get("g") is None and filament.get("cm3") is None:
+        return
+
+    usage = {f"filament_{unit}": filament.get(unit) for unit in ("mm", "g", "cm3")}
+    if not PendingJobUsage.objects.filter(printer=printer, remote_path=remote_path).update(**usage):
+        PendingJobUsage.objects.create(printer=printer, remote_path=remote_path, **usage)
+
+
+def printer_previews(printer_pks) -> dict:
+    """
+    {printer pk: (sha256, "printing"|"queued")} for the printers that have a
+    preview: the file they're printing if we put it there, otherwise the
+    last file we sent them. Two queries however many printers, the rest is
+    a directory listing per printer in the thumbnail cache.
+    """
+    printing = dict(
+        PrintJob.objects.filter(printer__in=printer_pks, state__in=PrintJob.ACTIVE_STATES)
+        .order_by("started_at")
+        .values_list("printer_id", "remote_path")
+    )
+    files = {}  # printer pk -> {remote_path: sha256}, newest first
+    latest = {}
+    for printer_id, remote_path, sha256 in (
+        PrinterFile.objects.filter(printer__in=printer_pks)
+        .order_by("-uploaded_at")
+        .values_list("printer_id", "remote_path", "content__sha256")
+    ):
+        files.setdefault(printer_id, {})[remote_path] = sha256
+        latest.setdefault(printer_id, sha256)
+
+    previews = {}
+    for printer_pk in printer_pks:
+        sha256 = files.get(printer_pk, {}).get(printing.get(printer_pk))
+        what = "printing"
+        if sha256 is None and printer_pk not in printing:
+            sha256, what = latest.get(printer_pk), "queued"
+        if sha256 is not None and list_variants(sha256):
+            previews[printer_pk] = (sha256, what)
+    return previews
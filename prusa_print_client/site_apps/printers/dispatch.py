@@ -0,0 +1,294 @@
+"""
+Farm-level print dispatch.
+
+An upload can target a printer model (Printers.PRINTERS) or a PrinterPool
+instead of one printer. It then waits as a DispatchJob until the dispatcher
+gives it to the printer of its target that will be free soonest:
+
+  free in = time_remaining of whatever it's printing (status cache)
+            + estimated_time of the jobs already assigned to it and not started
+
+Offline, errored and unknown printers don't take jobs. A job is only handed
+over once its printer is free within DISPATCH_LOOKAHEAD, so something with
+a higher priority that comes in later can still go first. Handing over
+means queueing an UploadJob; the upload worker does the transfer, nobody
+starts the print remotely.
+
+Waiting jobs live in memory in one heap per target, ordered by (-priority,
+created_at) and loaded incrementally by pk. A tick only looks at the head of
+each target's heap, so hundreds of waiting jobs cost nothing while their
+printers are busy. Every DISPATCH_RELOAD_EVERY the heaps are rebuilt from
+the database to pick up priority changes and cancellations.
+
+Dispatcher.maybe_tick() runs in the upload worker's loop.
+"""
+from collections import defaultdict
+from datetime import timedelta
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import DispatchJob, Printers, PrinterPool, UploadJob
+from .status_cache import get_statuses
+from .upload_queue import create_upload_job, spool_upload
+
+
+logger = logging.getLogger(__name__)
+
+# seconds between dispatcher ticks (new jobs also trigger one right away)
+DISPATCH_INTERVAL = getattr(settings, "DISPATCH_INTERVAL", 5.0)
+# hand a job over once its printer is free within this many seconds
+DISPATCH_LOOKAHEAD = getattr(settings, "DISPATCH_LOOKAHEAD", 10 * 60)
+# what a file without an estimate is assumed to take, seconds
+DISPATCH_DEFAULT_PRINT_TIME = getattr(settings, "DISPATCH_DEFAULT_PRINT_TIME", 60 * 60)
+# assigned jobs nobody started within this long stop holding their printer
+DISPATCH_ASSIGNED_TTL = timedelta(hours=getattr(settings, "DISPATCH_ASSIGNED_TTL_HOURS", 12))
+# rebuild the in-memory queue from the database this often, seconds
+DISPATCH_RELOAD_EVERY = 60.0
+
+# printer states (map_printer_status, plus the cache's own) that can't take a job
+UNAVAILABLE_STATES = {"offline", "error", "unknown"}
+
+
+def target_key(target_model, pool_id):
+    return f"pool:{pool_id}" if pool_id else f"model:{target_model}"
+
+
+def enqueue_dispatch(filename, length, chunks, target_model="", pool=None, priority=0, sha256=None) -> DispatchJob:
+    """
+    Spools the incoming file like enqueue_upload() and queues it for the
+    model or pool, see upload_queue.spool_upload() for `sha256`.
+    """
+    remote_name, spool_path, size, content = spool_upload(filename, length, chunks, sha256=sha256)
+    return create_dispatch_job(remote_name, spool_path, size, content, target_model, pool, priority)
+
+
+def create_dispatch_job(filename, spool_path, size, content, target_model="", pool=None, priority=0) -> DispatchJob:
+    job = DispatchJob.objects.create(
+        target_model=target_model if pool is None else "",
+        pool=pool,
+        priority=priority,
+        filename=filename,
+        remote_path=f"PRINT_QUEUE/{filename}",
+        spool_path=str(spool_path),
+        bytes_total=size,
+        content=content,
+        estimated_time=content.estimated_time if content is not None else None,
+    )
+    dispatcher.request_tick()
+    return job
+
+
+def assign(job_pk, printer, now=None):
+    """
+    Gives a waiting job to `printer` and queues its upload. Returns the
+    UploadJob, or None if the job isn't waiting anymore.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        if not DispatchJob.objects.filter(pk=job_pk, status=DispatchJob.WAITING).update(
+            status=DispatchJob.ASSIGNED, printer=printer, assigned_at=now, updated_at=now,
+        ):
+            return None
+        job = DispatchJob.objects.select_related("content").get(pk=job_pk)
+        upload = create_upload_job(printer, job.filename, job.spool_path, job.bytes_total, job.content)
+        DispatchJob.objects.filter(pk=job_pk).update(upload_job=upload)
+    return upload
+
+
+def fail_lost_uploads() -> int:
+    """
+    Assigned jobs whose upload gave up (the upload worker already retried it)
+    fail too, the spooled file is gone by then. The UploadJob has the details.
+    """
+    lost = DispatchJob.objects.filter(status=DispatchJob.ASSIGNED, upload_job__status=UploadJob.FAILED)
+    return lost.update(status=DispatchJob.FAILED, error="Upload failed", updated_at=timezone.now())
+
+
+def printer_free_in(printers, now=None) -> dict:
+    """
+    {printer.pk: seconds until it's free} for the printers that can take a
+    job, see the module docstring.
+    """
+    now = now or timezone.now()
+    statuses = get_statuses(printers)
+
+    free_in = {}
+    for printer in printers:
+        entry = statuses.get(printer.slug) or {}
+        if entry.get("status", "unknown") in UNAVAILABLE_STATES:
+            continue
+        busy_for = 0
+        if entry["status"] in ("printing", "paused", "busy"):
+            busy_for = (entry.get("job") or {}).get("time_remaining") or 0
+        free_in[printer.pk] = float(busy_for)
+
+    lined_up = (
+        DispatchJob.objects.filter(
+            printer__in=list(free_in), status=DispatchJob.ASSIGNED, assigned_at__gte=now - DISPATCH_ASSIGNED_TTL,
+        )
+        .values("printer")
+        .annotate(seconds=Sum(Coalesce(F("estimated_time"), Value(DISPATCH_DEFAULT_PRINT_TIME))))
+    )
+    for row in lined_up:
+        free_in[row["printer"]] += row["seconds"] or 0
+
+    return free_in
+
+
+class Dispatcher:
+
+    def __init__(self, lookahead=None):
+        self.lookahead = DISPATCH_LOOKAHEAD if lookahead is None else lookahead
+        # target key -> heap of (-priority, created_at, pk, estimated seconds)
+        self._queues = defaultdict(list)
+        self._loaded_up_to = 0  # highest pk in the heaps
+        self._reloaded_at = None
+        self._ticked_at = None
+        self._wanted = threading.Event()
+        self._lock = threading.Lock()
+
+    def request_tick(self):
+        """
+        Something new is waiting, don't wait out DISPATCH_INTERVAL.
+        """
+        self._wanted.set()
+
+    def maybe_tick(self):
+        now = time.monotonic()
+        if self._wanted.is_set() or self._ticked_at is None or now - self._ticked_at >= DISPATCH_INTERVAL:
+            self._wanted.clear()
+            self._ticked_at = now
+            return self.tick()
+        return []
+
+    def _load(self):
+        now = time.monotonic()
+        if self._reloaded_at is None or now - self._reloaded_at >= DISPATCH_RELOAD_EVERY:
+            self._queues.clear()
+            self._loaded_up_to = 0
+            self._reloaded_at = now
+
+        waiting = DispatchJob.objects.filter(status=DispatchJob.WAITING, pk__gt=self._loaded_up_to).values_list(
+            "pk", "priority", "created_at", "target_model", "pool_id", "estimated_time",
+        )
+        for pk, priority, created_at, target_model, pool_id, estimated_time in waiting:
+            heapq.heappush(
+                self._queues[target_key(target_model, pool_id)],
+                (-priority, created_at.timestamp(), pk, estimated_time or DISPATCH_DEFAULT_PRINT_TIME),
+            )
+            self._loaded_up_to = max(self._loaded_up_to, pk)
+
+    def _printers_by_target(self, keys):
+        models = {key.split(":", 1)[1] for key in keys if key.startswith("model:")}
+        pool_ids = {int(key.split(":", 1)[1]) for key in keys if key.startswith("pool:")}
+
+        members = list(
+            PrinterPool.printers.through.objects.filter(printerpool_id__in=pool_ids)
+            .values_list("printerpool_id", "printers_id")
+        ) if pool_ids else []
+        printers = {
+            printer.pk: printer
+            for printer in Printers.objects.filter(
+                Q(model__in=models) | Q(pk__in=[pk for _, pk in members])
+            ).only("pk", "slug", "host", "api_key", "model")
+        }
+
+        by_target = defaultdict(list)
+        for printer in printers.values():
+            by_target[f"model:{printer.model}"].append(printer.pk)
+        for pool_id, printer_pk in members:
+            by_target[f"pool:{pool_id}"].append(printer_pk)
+        return printers, by_target
+
+    def tick(self, now=None) -> list:
+        """
+        Assigns every waiting job whose target has a printer free within the
+        lookahead, best priority first. Returns [(DispatchJob pk, Printers pk)].
+        """
+        with self._lock:
+            fail_lost_uploads()
+            self._load()
+            keys = [key for key, queue in self._queues.items() if queue]
+            if not keys:
+                return []
+
+            now = now or timezone.now()
+            printers, by_target = self._printers_by_target(keys)
+            free_in = printer_free_in(list(printers.values()), now)
+
+            # per target, its printers by when they're free; entries go stale when a
+            # printer shared with another target gets a job and are fixed when seen
+            printer_heaps = {}
+            for key in keys:
+                heap = [(free_in[pk], pk) for pk in by_target.get(key, []) if pk in free_in]
+                heapq.heapify(heap)
+                printer_heaps[key] = heap
+
+            heads = [(self._queues[key][0], key) for key in keys]
+            heapq.heapify(heads)
+            assigned = []
+            failed = []
+
+            while heads:
+                (_, _, job_pk, seconds), key = heapq.heappop(heads)
+                printer_heap = printer_heaps[key]
+                while printer_heap and printer_heap[0][0] != free_in[printer_heap[0][1]]:
+                    _, pk = heapq.heappop(printer_heap)
+                    heapq.heappush(printer_heap, (free_in[pk], pk))
+
+                if not printer_heap or printer_heap[0][0] > self.lookahead:
+                    # nothing of this target frees up soon, its other jobs can wait too
+                    continue
+
+                job = heapq.heappop(self._queues[key])
+                printer_pk = printer_heap[0][1]
+                try:
+                    upload = assign(job_pk, printers[printer_pk], now)
+                except Exception:
+                    logger.exception("dispatching job %s failed", job_pk)
+                    # still waiting in the database, try it again next tick
+                    failed.append((key, job))
+                    upload = None
+                if upload is not None:
+                    free_in[printer_pk] += seconds
+                    assigned.append((job_pk, printer_pk))
+
+                if self._queues[key]:
+                    heapq.heappush(heads, (self._queues[key][0], key))
+
+            for key, job in failed:
+                heapq.heappush(self._queues[key], job)
+            return assigned
+
+    def position(self, job) -> int:
+        """
+        How many waiting jobs of the same target go before `job`, 0 when it's next.
+        """
+        ahead = DispatchJob.objects.filter(
+            status=DispatchJob.WAITING, target_model=job.target_model, pool_id=job.pool_id,
+        )
+        return (
+            ahead.filter(priority__gt=job.priority).count()
+            + ahead.filter(priority=job.priority, created_at__lt=job.created_at).count()
+        )
+
+
+dispatcher = Dispatcher()
+
+
+def mark_started(printer, remote_paths, print_job):
+    """
+    The poller saw `printer` start one of `remote_paths`: the assigned job for
+    it stops holding the printer.
+    """
+    return DispatchJob.objects.filter(
+        printer=printer, status=DispatchJob.ASSIGNED, remote_path__in=remote_paths,
+    ).update(status=DispatchJob.STARTED, print_job=print_job, updated_at=timezone.now())
@@ -0,0 +1,495 @@
+"""
+A farm of fake PrusaLink printers for tests and `manage.py bench_farm`.
+
+Each FakePrinter is a small HTTP server on its own loopback address
+(127.0.0.2, 127.0.0.3, ...) so the real clients.PrinterClient talks to it
+exactly like to a printer on the LAN. It answers the parts of the PrusaLink
+v1 API we use:
+
+  GET    /api/version, /api/v1/status, /api/v1/job
+  PUT    /api/v1/job/<id>/pause, /api/v1/job/<id>/resume
+  DELETE /api/v1/job/<id>
+  GET    /api/v1/files/usb/<dir>/            folder listing
+  HEAD / PUT / DELETE /api/v1/files/usb/<path>
+
+and can be made slow (latency), flaky (failure_rate: that share of requests
+get a 503), slow to upload to (bandwidth) or not there at all (mode "refuse":
+nothing listening, "hang": accepts and never answers).
+
+A print takes print_seconds of wall clock, then the printer shows FINISHED
+until the next one starts. Files uploaded with Print-After-Upload start one,
+tests can also use start_print() / finish_print().
+
+Binding 127.0.0.x other than .1 works out of the box on Linux, macOS needs
+an alias per address (ifconfig lo0 alias 127.0.0.2 up).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import itertools
+import json
+import random
+import threading
+import time
+from urllib.parse import unquote
+
+from . import clients
+
+
+# PrusaLink state names
+IDLE = "IDLE"
+PRINTING = "PRINTING"
+PAUSED = "PAUSED"
+FINISHED = "FINISHED"
+STOPPED = "STOPPED"
+
+UP = "up"
+REFUSE = "refuse"
+HANG = "hang"
+
+FIRST_HOST = ipaddress.IPv4Address("127.0.0.2")
+
+
+class FakePrinter:
+    """
+    State of one fake printer, shared by its request handler threads.
+    """
+
+    def __init__(self, host, port=0, api_key="fake-key", latency=0.0, failure_rate=0.0,
+                 bandwidth=None, print_seconds=60.0, mode=UP, seed=None):
+        self.host = host
+        self.port = port
+        self.api_key = api_key
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.bandwidth = bandwidth  # bytes/s for uploads, None for as fast as possible
+        self.print_seconds = print_seconds
+        self.mode = mode
+
+        self.state = IDLE
+        self.job = None  # dict while there's a job on the screen
+        self.files = {}  # remote path ("PRINT_QUEUE/foo.bgcode") -> file dict
+        self.folders = {""}  # stay around when emptied, like on a real USB stick
+        self.requests = 0
+        self.uploaded_bytes = 0
+
+        self._random = random.Random(seed)
+        self._job_ids = itertools.count(1)
+        self._short_names = itertools.count(1)
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+
+    # lifecycle
+
+    def start(self):
+        if self.mode == REFUSE:
+            return
+        self._server = ThreadingHTTPServer((self.host, self.port), _handler_for(self))
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"fake-printer-{self.host}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # files
+
+    def add_file(self, remote_path, size=1024, m_timestamp=None):
+        """
+        Puts a file on the fake USB stick, `remote_path` like "PRINT_QUEUE/foo.bgcode".
+        """
+        folder, _, display_name = remote_path.strip("/").rpartition("/")
+        stem = "".join(c for c in display_name.rsplit(".", 1)[0].upper() if c.isalnum())[:6] or "FILE"
+        with self._lock:
+            parts = folder.split("/") if folder else []
+            self.folders.update("/".join(parts[:i + 1]) for i in range(len(parts)))
+            self.files[remote_path.strip("/")] = {
+                "folder": folder,
+                "name": f"{stem}~{next(self._short_names)}.BGC",
+                "display_name": display_name,
+                "size": size,
+                "m_timestamp": int(m_timestamp if m_timestamp is not None else time.time()),
+            }
+
+    def find_file(self, path):
+        """
+        Looks a file up by long or short (8.3) path.
+        """
+        path = path.strip("/")
+        with self._lock:
+            if path in self.files:
+                return path, self.files[path]
+            for remote_path, file in self.files.items():
+                if f"{file['folder']}/{file['name']}".strip("/") == path:
+                    return remote_path, file
+        return None, None
+
+    def list_folder(self, folder):
+        folder = folder.strip("/")
+        with self._lock:
+            if folder not in self.folders:
+                return None
+            children = [
+                {"type": "PRINT_FILE", **{k: v for k, v in file.items() if k != "folder"}}
+                for file in self.files.values()
+                if file["folder"] == folder
+            ]
+            prefix = folder + "/" if folder else ""
+            subfolders = sorted(
+                name[len(prefix):] for name in self.folders
+                if name and name.startswith(prefix) and "/" not in name[len(prefix):]
+            )
+        return children + [{"type": "FOLDER", "name": name, "display_name": name} for name in subfolders]
+
+    # jobs
+
+    def _tick(self):
+        # a running print finishes on its own once print_seconds of printing went by
+        if self.state == PRINTING and self._printing_time() >= self.print_seconds:
+            self.job["time_printing"] = self.print_seconds
+            self.state = FINISHED
+
+    def _printing_time(self):
+        job = self.job
+        if self.state == PRINTING:
+            return job["time_printing"] + time.monotonic() - job["resumed_at"]
+        return job["time_printing"]
+
+    def start_print(self, remote_path):
+        with self._lock:
+            self._tick()
+            if self.state in (PRINTING, PAUSED):
+                raise RuntimeError(f"{self.host} is already printing")
+            if remote_path.strip("/") not in self.files:
+                self.add_file(remote_path)
+            self.job = {
+                "id": next(self._job_ids) + 100,
+                "path": remote_path.strip("/"),
+                "time_printing": 0.0,
+                "resumed_at": time.monotonic(),
+            }
+            self.state = PRINTING
+            return self.job["id"]
+
+    def finish_print(self, state=FINISHED):
+        with self._lock:
+            self._tick()
+            if self.state in (PRINTING, PAUSED):
+                self.job["time_printing"] = self._printing_time()
+                self.state = state
+
+    def job_command(self, job_id, action):
+        """
+        pause / resume / stop, returns the HTTP status PrusaLink would.
+        """
+        with self._lock:
+            self._tick()
+            if self.job is None or self.job["id"] != job_id:
+                return 404
+            if action == "pause" and self.state == PRINTING:
+                self.job["time_printing"] = self._printing_time()
+                self.state = PAUSED
+            elif action == "resume" and self.state == PAUSED:
+                self.job["resumed_at"] = time.monotonic()
+                self.state = PRINTING
+            elif action == "stop" and self.state in (PRINTING, PAUSED):
+                self.job["time_printing"] = self._printing_time()
+                self.state = STOPPED
+            else:
+                return 409
+            return 204
+
+    def status_json(self):
+        with self._lock:
+            self._tick()
+            printing = self.state in (PRINTING, PAUSED)
+            status = {
+                "storage": {"path": "/usb/", "name": "usb", "read_only": False},
+                "printer": {
+                    "state": self.state,
+                    "temp_nozzle": 215.0 if printing else 24.0,
+                    "target_nozzle": 215.0 if printing else 0.0,
+                    "temp_bed": 60.0 if printing else 23.0,
+                    "target_bed": 60.0 if printing else 0.0,
+                    "axis_z": 1.2 if printing else 0.0,
+                    "flow": 100,
+                    "speed": 100,
+                    "fan_hotend": 0,
+                    "fan_print": 0,
+                },
+            }
+            if self.job is not None:
+                status["job"] = self._job_fields()
+            return status
+
+    def job_json(self):
+        with self._lock:
+            self._tick()
+            if self.job is None:
+                return None
+            _, file = self.find_file(self.job["path"])
+            file = file or {"folder": "", "name": "", "display_name": "", "size": 0, "m_timestamp": 0}
+            folder = "/usb/" + file["folder"] if file["folder"] else "/usb"
+            return {
+                **self._job_fields(),
+                "state": self.state,
+                "file": {
+                    "name": file["name"],
+                    "display_name": file["display_name"],
+                    "path": folder,
+                    "size": file["size"],
+                    "m_timestamp": file["m_timestamp"],
+                    "refs": {"download": f"{folder}/{file['name']}"},
+                },
+            }
+
+    def _job_fields(self):
+        elapsed = self._printing_time()
+        progress = 100.0 if self.state == FINISHED else min(99.0, 100.0 * elapsed / self.print_seconds)
+        return {
+            "id": self.job["id"],
+            "progress": round(progress, 1),
+            "time_printing": int(elapsed),
+            "time_remaining": max(0, int(self.print_seconds - elapsed)) if self.state != FINISHED else 0,
+        }
+
+    def current_file(self):
+        with self._lock:
+            self._tick()
+            return self.job["path"] if self.job is not None and self.state in (PRINTING, PAUSED) else None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    printer = None
+    protocol_version = "HTTP/1.1"  # keep-alive, like PrusaLink
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(code)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _drain(self):
+        # read what was sent so the connection can be reused
+        length = int(self.headers.get("Content-Length") or 0)
+        while length > 0:
+            length -= len(self.rfile.read(min(length, 65536)))
+
+    def _handle(self, method):
+        printer = self.printer
+        with printer._lock:
+            printer.requests += 1
+            flaky = printer._random.random() < printer.failure_rate
+
+        if printer.mode == HANG:
+            # never answer, the client's read timeout has to deal with it
+            time.sleep(3600)
+            return
+        if printer.latency:
+            time.sleep(printer.latency)
+        if self.headers.get("X-Api-Key") != printer.api_key:
+            self._drain()
+            return self._reply(401, {"title": "Unauthorized"})
+        if flaky:
+            self._drain()
+            return self._reply(503, {"title": "Service Unavailable"})
+
+        path = unquote(self.path.split("?", 1)[0])
+        if path.startswith("/api/v1/files/usb"):
+            return self._files(method, path[len("/api/v1/files/usb"):])
+        if path.startswith("/api/v1/job/"):
+            return self._job_command(method, path[len("/api/v1/job/"):])
+
+        self._drain()
+        if method == "GET" and path == "/api/version":
+            return self._reply(200, {"api": "2.0.0", "server": "2.1.2", "text": "PrusaLink (fake)"})
+        if method == "GET" and path == "/api/v1/status":
+            return self._reply(200, printer.status_json())
+        if method == "GET" and path == "/api/v1/job":
+            job = printer.job_json()
+            return self._reply(200, job) if job else self._reply(204)
+        return self._reply(404, {"title": "Not Found"})
+
+    def _job_command(self, method, rest):
+        self._drain()
+        job_id, _, action = rest.partition("/")
+        if not job_id.isdigit():
+            return self._reply(404, {"title": "Not Found"})
+        if method == "DELETE" and not action:
+            action = "stop"
+        elif method != "PUT" or action not in ("pause", "resume"):
+            return self._reply(405, {"title": "Method Not Allowed"})
+        code = self.printer.job_command(int(job_id), action)
+        return self._reply(code, {"title": "Conflict"} if code == 409 else None)
+
+    def _files(self, method, path):
+        printer = self.printer
+        if method == "PUT":
+            return self._upload(path)
+        self._drain()
+
+        if method == "GET" and (path.endswith("/") or not path):
+            children = printer.list_folder(path)
+            if children is None:
+                return self._reply(404, {"title": "Not Found"})
+            return self._reply(200, {"type": "FOLDER", "name": path.strip("/").rsplit("/", 1)[-1], "children": children})
+
+        remote_path, file = printer.find_file(path)
+        if file is None:
+            return self._reply(404, {"title": "Not Found"})
+        if method == "HEAD" or method == "GET":
+            return self._reply(200, {"type": "PRINT_FILE", **file})
+        if method == "DELETE":
+            if printer.current_file() == remote_path:
+                return self._reply(409, {"title": "File is being printed"})
+            with printer._lock:
+                printer.files.pop(remote_path, None)
+            return self._reply(204)
+        return self._reply(405, {"title": "Method Not Allowed"})
+
+    def _upload(self, path):
+        printer = self.printer
+        length = int(self.headers.get("Content-Length") or 0)
+        remote_path, existing = printer.find_file(path)
+        if existing is not None and self.headers.get("Overwrite") != "?1":
+            self._drain()
+            return self._reply(409, {"title": "File already exists"})
+
+        started, received = time.monotonic(), 0
+        while received < length:
+            chunk = self.rfile.read(min(length - received, 65536))
+            if not chunk:
+                return
+            received += len(chunk)
+            if printer.bandwidth:
+                # sleep until this many bytes would have taken at `bandwidth`
+                time.sleep(max(0.0, started + received / printer.bandwidth - time.monotonic()))
+
+        with printer._lock:
+            printer.uploaded_bytes += received
+        printer.add_file(path, size=received)
+        if self.headers.get("Print-After-Upload") == "?1":
+            try:
+                printer.start_print(path)
+            except RuntimeError:
+                pass
+        return self._reply(201)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_HEAD(self):
+        self._handle("HEAD")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+
+def _handler_for(printer):
+    return type("FakePrinterHandler", (_Handler,), {"printer": printer})
+
+
+class FakeFarm:
+    """
+    `size` FakePrinters on consecutive loopback addresses, all on one port
+    (PrinterClient only knows one PRUSALINK_PORT). While running, that's
+    the port clients.PrinterClient connects to.
+
+      with FakeFarm(20, latency=0.02, offline=0.1) as farm:
+          printers = farm.create_printers()
+          ...
+
+    `offline` is the share of printers that are down, in `offline_mode`
+    (REFUSE or HANG); they're the last ones of the farm.
+    """
+
+    def __init__(self, size, port=0, offline=0.0, offline_mode=REFUSE, seed=0, **printer_options):
+        self.port = port
+        down = round(size * offline)
+        self.printers = [
+            FakePrinter(
+                str(FIRST_HOST + i),
+                mode=offline_mode if i >= size - down else UP,
+                seed=seed + i,
+                **printer_options,
+            )
+            for i in range(size)
+        ]
+        self._previous_port = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __iter__(self):
+        return iter(self.printers)
+
+    def __len__(self):
+        return len(self.printers)
+
+    def start(self):
+        port = self.port
+        for printer in self.printers:
+            printer.port = port
+            printer.start()
+            if not port and printer.mode != REFUSE:
+                # first one to bind picks the port, everyone else uses the same
+                port = printer.port
+        if not port:
+            # nobody is listening anywhere, any free port will refuse connections
+            probe = ThreadingHTTPServer((self.printers[0].host if self.printers else "127.0.0.1", 0), _Handler)
+            port = probe.server_address[1]
+            probe.server_close()
+        self.port = port
+
+        self._previous_port = clients.PRUSALINK_PORT
+        clients.PRUSALINK_PORT = self.port
+        # clients built before the farm point at the old port
+        for pk in list(clients._clients):
+            clients.invalidate_client(pk)
+
+    def stop(self):
+        for printer in self.printers:
+            printer.stop()
+        if self._previous_port is not None:
+            clients.PRUSALINK_PORT = self._previous_port
+            self._previous_port = None
+        for pk in list(clients._clients):
+            clients.invalidate_client(pk)
+
+    def by_host(self, host):
+        return next(printer for printer in self.printers if printer.host == str(host))
+
+    def create_printers(self, prefix="fake"):
+        """
+        A Printers row for every fake printer, returns them in farm order.
+        """
+        from .models import Printers
+
+        Printers.objects.bulk_create(
+            Printers(
+                name=f"{prefix} {i}", slug=f"{prefix}-{i}", model="mk4" if i % 2 else "core_one",
+                host=printer.host, api_key=printer.api_key, date_added=time.strftime("%Y-%m-%d"),
+                staff_notes="",
+            )
+            for i, printer in enumerate(self.printers)
+        )
+        rows = {str(row.host): row for row in Printers.objects.filter(slug__startswith=f"{prefix}-")}
+        return [rows[printer.host] for printer in self.printers]
@@ -0,0 +1,128 @@
+"""
+Per-printer circuit breaker.
+
+Every PrinterClient has a PrinterHealth and asks it before each call, so the
+status collector, the poller, uploads and commands all share what any of them
+learned about a printer:
+
+  closed     calls go through; PRINTER_BREAKER_THRESHOLD failures in a row open it
+  open       calls fail right away with PrinterUnavailable, no connection attempt
+  half_open  after the backoff one call is let through as a probe: success
+             closes the circuit, failure opens it again for twice as long
+             (up to PRINTER_BREAKER_MAX_BACKOFF)
+
+Only connection problems count (refused, unreachable, timeouts, see
+is_printer_failure()), a printer answering with an error status is up, and
+an upload whose body failed on our side (clients.UploadBody) says nothing
+about the printer at all. State is per process.
+"""
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+
+# consecutive failed calls before we stop trying
+PRINTER_BREAKER_THRESHOLD = getattr(settings, "PRINTER_BREAKER_THRESHOLD", 3)
+# seconds before the first probe of an open circuit, doubling per failed probe
+PRINTER_BREAKER_BACKOFF = getattr(settings, "PRINTER_BREAKER_BACKOFF", 5.0)
+PRINTER_BREAKER_MAX_BACKOFF = getattr(settings, "PRINTER_BREAKER_MAX_BACKOFF", 300.0)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_printer_failure(error) -> bool:
+    """
+    Whether a failed call means the printer is unreachable. Anything else
+    requests raises (bad URL, garbled encoding, ...) is our problem.
+    """
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class PrinterUnavailable(requests.ConnectionError):
+    """
+    Raised instead of calling a printer whose circuit is open. It's a
+    requests.ConnectionError so every existing "printer is offline" path
+    handles it as is.
+    """
+
+    def __init__(self, health):
+        self.health = health.snapshot()
+        super().__init__(
+            f"Printer offline ({self.health['reason'] or 'unreachable'}), "
+            f"next try in {self.health['retry_in']:.0f}s"
+        )
+
+
+class PrinterHealth:
+
+    def __init__(self, threshold=None, backoff=None, max_backoff=None):
+        self.threshold = threshold or PRINTER_BREAKER_THRESHOLD
+        self.backoff = backoff or PRINTER_BREAKER_BACKOFF
+        self.max_backoff = max_backoff or PRINTER_BREAKER_MAX_BACKOFF
+
+        self.state = CLOSED
+        self.failures = 0  # in a row
+        self.open_for = 0.0  # current backoff
+        self.retry_at = 0.0  # monotonic
+        self.last_seen = None  # wall clock of the last answer
+        self.last_failure_at = None
+        self.reason = None
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self.retry_at:
+                # this caller is the probe, everyone else keeps failing fast until it's back
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.open_for = 0.0
+            self.reason = None
+            self.last_seen = time.time()
+
+    def record_failure(self, reason):
+        with self._lock:
+            self.failures += 1
+            self.reason = reason
+            self.last_failure_at = time.time()
+
+            if self.state == HALF_OPEN:
+                self.open_for = min(self.open_for * 2 or self.backoff, self.max_backoff)
+            elif self.failures >= self.threshold:
+                self.open_for = self.backoff
+            else:
+                return
+            self.state = OPEN
+            self.retry_at = time.monotonic() + self.open_for
+
+    def release(self):
+        """
+        The call failed for a reason that says nothing about the printer
+        (e.g. our own file went missing), let the next call probe instead.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.retry_at = time.monotonic()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in": max(0.0, self.retry_at - time.monotonic()) if self.state != CLOSED else 0.0,
+                "last_seen": self.last_seen,
+                "last_failure_at": self.last_failure_at,
+                "reason": self.reason,
+            }
@@ -0,0 +1,338 @@
+"""
+Print job state machine, fed by the poller.
+
+Every poll hands a printer's /api/v1/status to observe_job(), which keeps
+PrintJob rows in step with what the printer is doing:
+
+  new job id, printing or paused  -> PrintJob created, file matched to its PendingJobUsage
+  new job id, already ended       -> nothing, we didn't see it print (first deploy, poller restart)
+  PRINTING / PAUSED / ATTENTION   -> printing / paused
+  FINISHED / STOPPED / ERROR      -> ended, filament used gets filled in
+  open job no longer reported     -> ended as unknown
+
+The Printers counters follow the jobs without ever reading them back:
+  - total_print_count goes up in the same transaction that creates the job,
+    and the (printer, job_id) unique constraint lets only one poller do that
+  - everything else gets added by count_ended_jobs(), which flips each ended
+    job's `counted` flag and adds it to its printer in one transaction
+So no job is counted twice however many pollers race over it.
+
+Progress of running jobs isn't written per poll, the poller collects it in a
+JobLedger and writes the whole cycle with one bulk_update.
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+import threading
+
+import requests
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .dispatch import mark_started
+from .models import PendingJobUsage, Printers, PrintJob
+from .stats import OUTCOME_FIELDS, TOTAL_FIELDS, add_daily_stats
+
+
+# raw PrusaLink printer state -> PrintJob state, anything else leaves the job as it is
+PRINTER_STATE_TO_JOB = {
+    "PRINTING": PrintJob.PRINTING,
+    "PAUSED": PrintJob.PAUSED,
+    "ATTENTION": PrintJob.PAUSED,  # waiting on someone at the printer mid-print
+    "FINISHED": PrintJob.FINISHED,
+    "STOPPED": PrintJob.STOPPED,
+    "ERROR": PrintJob.ERROR,
+}
+
+
+# printer pk -> id of the ended job it's still showing (FINISHED sits on the screen
+# until someone clears it), saves looking that job up again on every poll
+_ended_on_screen = {}
+
+
+@dataclass
+class JobEvents:
+    job: PrintJob = None
+    started: bool = False
+    ended: list = field(default_factory=list)
+    # open jobs whose state/progress moved, for JobLedger
+    changed: list = field(default_factory=list)
+
+
+def job_remote_paths(job_json) -> list:
+    """
+    The ways a /api/v1/job file can be spelled in PendingJobUsage.remote_path
+    ("PRINT_QUEUE/foo.bgcode"): by display name first, then the raw download ref.
+    """
+    file_info = (job_json or {}).get("file") or {}
+    paths = []
+
+    folder = (file_info.get("path") or "").strip("/")
+    if folder.startswith("usb"):
+        folder = folder[3:].strip("/")
+    if file_info.get("display_name"):
+        paths.append(f"{folder}/{file_info['display_name']}" if folder else file_info["display_name"])
+
+    download = (file_info.get("refs") or {}).get("download")
+    if download:
+        paths.append(download)
+        paths.append(download.lstrip("/").removeprefix("usb/"))
+
+    return paths
+
+
+def _start_job(printer, job_id, job_info, fetch_job, now):
+    job_json = None
+    if fetch_job is not None:
+        try:
+            job_json = fetch_job()
+        except (requests.RequestException, ValueError):
+            # the file details are nice to have, the job gets tracked either way
+            job_json = None
+
+    paths = job_remote_paths(job_json)
+    pending = None
+    if paths:
+        pending = (
+            PendingJobUsage.objects.filter(printer=printer, remote_path__in=paths)
+            .order_by("-created_at")
+            .first()
+        )
+
+    time_printing = job_info.get("time_printing") or 0
+    file_info = (job_json or {}).get("file") or {}
+
+    try:
+        with transaction.atomic():
+            job = PrintJob.objects.create(
+                printer=printer,
+                job_id=job_id,
+                remote_path=pending.remote_path if pending else (paths[0] if paths else ""),
+                display_name=file_info.get("display_name") or file_info.get("name") or "",
+                started_at=now - timezone.timedelta(seconds=time_printing),
+                expected_filament_mm=pending.filament_mm if pending else None,
+                expected_filament_g=pending.filament_g if pending else None,
+                expected_filament_cm3=pending.filament_cm3 if pending else None,
+            )
+            Printers.objects.filter(pk=printer.pk).update(
+                total_print_count=Coalesce(F("total_print_count"), 0) + 1,
+                last_job_id=job_id,
+            )
+            add_daily_stats(printer.pk, timezone.localdate(job.started_at), prints_started=1)
+            if paths:
+                # a dispatched file being printed stops holding its printer
+                mark_started(printer, paths, job)
+        return job, True
+    except IntegrityError:
+        # another poller got there first (and counted it)
+        return PrintJob.objects.get(printer=printer, job_id=job_id), False
+
+
+def _end_job(job, state, now) -> bool:
+    """
+    Closes an open job, False if someone else closed it first.
+    """
+    job.state = state
+    job.ended_at = now
+
+    if state == PrintJob.FINISHED:
+        fraction = 1.0
+    elif job.progress is not None:
+        fraction = min(max(job.progress / 100.0, 0.0), 1.0)
+    else:
+        fraction = None
+
+    if fraction is not None:
+        for unit in ("mm", "g", "cm3"):
+            expected = getattr(job, f"expected_filament_{unit}")
+            if expected is not None:
+                setattr(job, f"filament_{unit}", expected * fraction)
+
+    # only the poller that moves it out of an active state gets to end it
+    return bool(PrintJob.objects.filter(pk=job.pk, state__in=PrintJob.ACTIVE_STATES).update(
+        state=job.state,
+        ended_at=job.ended_at,
+        progress=job.progress,
+        duration=job.duration,
+        filament_mm=job.filament_mm,
+        filament_g=job.filament_g,
+        filament_cm3=job.filament_cm3,
+    ))
+
+
+def observe_job(printer, status_json, fetch_job=None, now=None) -> JobEvents:
+    """
+    Moves the printer's PrintJob rows along given one /api/v1/status json.
+    `fetch_job` returns the /api/v1/job json, only called when a new job
+    shows up (that's where the file name lives).
+
+    Starts and ends are written right away, progress of an open job is only
+    put on the returned JobEvents.changed for a JobLedger to write.
+    """
+    now = now or timezone.now()
+    job_info = status_json.get("job") or {}
+    raw_state = ((status_json.get("printer") or {}).get("state") or "").upper()
+    job_id = str(job_info.get("id") or "")
+    events = JobEvents()
+
+    open_jobs = {job.job_id: job for job in PrintJob.objects.filter(printer=printer, state__in=PrintJob.ACTIVE_STATES)}
+
+    # an open job the printer no longer reports ended while we weren't looking
+    for other_id, job in open_jobs.items():
+        if other_id != job_id and _end_job(job, PrintJob.UNKNOWN, now):
+            events.ended.append(job)
+
+    if not job_id or _ended_on_screen.get(printer.pk) == job_id:
+        return events
+
+    job = open_jobs.get(job_id)
+    if job is None:
+        job = PrintJob.objects.filter(printer=printer, job_id=job_id).first()
+        if job is None:
+            if PRINTER_STATE_TO_JOB.get(raw_state) not in PrintJob.ACTIVE_STATES:
+                # a print that ended before we ever saw it, we can't tell what it used
+                _ended_on_screen[printer.pk] = job_id
+                return events
+            job, events.started = _start_job(printer, job_id, job_info, fetch_job, now)
+    events.job = job
+
+    if job.state not in PrintJob.ACTIVE_STATES:
+        _ended_on_screen[printer.pk] = job_id
+        return events
+
+    before = (job.state, job.progress, job.duration)
+    if job_info.get("progress") is not None:
+        job.progress = job_info["progress"]
+    if job_info.get("time_printing") is not None:
+        job.duration = job_info["time_printing"]
+
+    state = PRINTER_STATE_TO_JOB.get(raw_state, job.state)
+    if state not in PrintJob.ACTIVE_STATES:
+        if _end_job(job, state, now):
+            events.ended.append(job)
+        _ended_on_screen[printer.pk] = job_id
+    else:
+        job.state = state
+        if (job.state, job.progress, job.duration) != before:
+            events.changed.append(job)
+
+    return events
+
+
+class JobLedger:
+    """
+    Collects what the poller threads saw during a cycle so it can be written
+    in one transaction: a bulk_update for the progress of running jobs, then
+    count_ended_jobs() for the Printers counters.
+    """
+
+    def __init__(self):
+        self._changed = {}
+        self._lock = threading.Lock()
+
+    def add(self, events):
+        with self._lock:
+            for job in events.changed:
+                self._changed[job.pk] = job  # latest poll wins
+
+    def commit(self) -> dict:
+        with self._lock:
+            changed, self._changed = list(self._changed.values()), {}
+
+        try:
+            with transaction.atomic():
+                if changed:
+                    # a job another poller ended in the meantime stays ended
+                    PrintJob.objects.filter(state__in=PrintJob.ACTIVE_STATES).bulk_update(
+                        changed, ["state", "progress", "duration"], batch_size=500,
+                    )
+                counted = count_ended_jobs()
+        except Exception:
+            # rolled back, try again with the next commit unless a newer poll came in meanwhile
+            with self._lock:
+                self._changed = {**{job.pk: job for job in changed}, **self._changed}
+            raise
+
+        return {"updated": len(changed), "counted": counted}
+
+
+ledger = JobLedger()
+
+
+def count_ended_jobs() -> int:
+    """
+    Adds every ended job the Printers counters don't include yet (successful
+    prints, printing uptime, filament used), one UPDATE per printer, and to
+    its day in PrinterDailyStats.
+    Returns how many jobs got counted.
+    """
+    uncounted = PrintJob.objects.filter(counted=False).exclude(state__in=PrintJob.ACTIVE_STATES).values_list(
+        "pk", "printer_id", "state", "ended_at", "duration", "filament_mm", "filament_g", "filament_cm3",
+    )
+
+    totals = defaultdict(lambda: defaultdict(float))
+    daily = defaultdict(lambda: dict.fromkeys(TOTAL_FIELDS, 0))
+    counted = 0
+    with transaction.atomic():
+        for pk, printer_id, state, ended_at, duration, mm, g, cm3 in uncounted:
+            # claim the job, if someone else already did it's theirs to count
+            if not PrintJob.objects.filter(pk=pk, counted=False).update(counted=True):
+                continue
+            counted += 1
+
+            day = daily[(printer_id, timezone.localdate(ended_at or timezone.now()))]
+            day[OUTCOME_FIELDS[state]] += 1
+            day["printing_seconds"] += duration or 0
+            day["filament_mm"] += mm or 0.0
+            day["filament_g"] += g or 0.0
+            day["filament_cm3"] += cm3 or 0.0
+
+            total = totals[printer_id]
+            total["successful_prints"] += state == PrintJob.FINISHED
+            total["printing_seconds"] += duration or 0
+            total["filament_usage_mm"] += mm or 0.0
+            total["filament_usage_g"] += g or 0.0
+            total["filament_usage_cm3"] += cm3 or 0.0
+
+        for printer_id, total in totals.items():
+            updates = {
+                "printing_uptime": Coalesce(F("printing_uptime"), 0) + round(total.pop("printing_seconds") / 60),
+                "successful_prints": Coalesce(F("successful_prints"), 0) + int(total.pop("successful_prints")),
+            }
+            for name, amount in total.items():
+                if amount:
+                    updates[name] = Coalesce(F(name), 0.0) + amount
+            Printers.objects.filter(pk=printer_id).update(**updates)
+
+        for (printer_id, day), amounts in daily.items():
+            add_daily_stats(printer_id, day, **amounts)
+
+    return counted
+
+
+def current_job(printer):
+    return PrintJob.objects.filter(printer=printer, state__in=PrintJob.ACTIVE_STATES).order_by("-started_at").first()
+
+
+def job_stats(printer, since=None) -> dict:
+    """
+    Per-printer totals as one indexed aggregate query.
+    success_rate is None until there's at least one ended job.
+    """
+    jobs = PrintJob.objects.filter(printer=printer)
+    if since is not None:
+        jobs = jobs.filter(started_at__gte=since)
+
+    stats = jobs.aggregate(
+        total_prints=Count("pk"),
+        finished=Count("pk", filter=Q(state=PrintJob.FINISHED)),
+        failed=Count("pk", filter=Q(state__in=[PrintJob.STOPPED, PrintJob.ERROR])),
+        ended=Count("pk", filter=~Q(state__in=PrintJob.ACTIVE_STATES)),
+        printing_seconds=Sum("duration"),
+        filament_mm=Sum("filament_mm"),
+        filament_g=Sum("filament_g"),
+        filament_cm3=Sum("filament_cm3"),
+    )
+    stats["success_rate"] = round(stats["finished"] / stats["ended"], 2) if stats["ended"] else None
+    return stats
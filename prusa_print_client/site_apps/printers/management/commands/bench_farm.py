@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from site_apps.printers import status_cache
+from site_apps.printers.clients import get_client
+from site_apps.printers.fakefarm import FakeFarm, HANG, REFUSE, UP
+from site_apps.printers.models import Printers
+from site_apps.printers.status_cache import store_statuses
+from site_apps.printers.utils import PRINTER_POLL_WORKERS, fetch_printer_statuses
+
+
+def summarize(samples, scale=1.0, digits=4) -> dict:
+    """
+    p50/p95/max/mean of a list of timings, times `scale` (1000 for ms).
+    """
+    if not samples:
+        return {"n": 0, "p50": None, "p95": None, "max": None, "mean": None}
+    ordered = sorted(sample * scale for sample in samples)
+
+    def rank(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], digits)
+
+    return {
+        "n": len(ordered),
+        "p50": rank(0.5),
+        "p95": rank(0.95),
+        "max": round(ordered[-1], digits),
+        "mean": round(sum(ordered) / len(ordered), digits),
+    }
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def run_scenario(size, failure_rate=0.0, offline=0.0, offline_mode=REFUSE, latency=0.0, bandwidth=None,
+                 repeat=5, upload_bytes=1024 ** 2, files=20, port=0) -> dict:
+    """
+    Runs every benchmark against a fresh fake farm of `size` printers and
+    returns the numbers. Wipes the Printers table first, so only ever call
+    this on a throwaway database (the command sets one up).
+    """
+    Printers.objects.all().delete()
+    cache.clear()
+
+    result = {"printers": size, "failure_rate": failure_rate, "offline": offline, "offline_mode": offline_mode}
+
+    with FakeFarm(size, port=port, offline=offline, offline_mode=offline_mode, latency=latency,
+                  failure_rate=failure_rate, bandwidth=bandwidth, print_seconds=3600) as farm:
+        printers = farm.create_printers()
+        live = [printer for printer, fake in zip(printers, farm) if fake.mode == UP]
+        # every other printer is busy, like on a normal day
+        for fake in farm.printers[::2]:
+            if fake.mode == UP:
+                fake.start_print("PRINT_QUEUE/benchy.bgcode")
+
+        # what the status collector does every few seconds
+        result["status_sweep_s"] = summarize([
+            timed(lambda: store_statuses(printers, fetch_printer_statuses(printers)))
+            for _ in range(repeat)
+        ])
+
+        # the dashboard reading that cache
+        client, url = Client(), reverse("printers:printers_status_api")
+        result["status_api_ms"] = summarize([timed(lambda: client.get(url)) for _ in range(repeat * 10)], scale=1000)
+
+        result["poll_cycle_s"] = summarize([
+            timed(lambda: call_command("poll_printers", stdout=StringIO(), stderr=StringIO()))
+            for _ in range(repeat)
+        ])
+
+        # the same file to every printer at once, like a broadcast upload. Down
+        # printers sit this one out, they'd only measure PRINTER_UPLOAD_TIMEOUT
+        payload = os.urandom(upload_bytes)
+
+        def upload(printer):
+            try:
+                return get_client(printer).put_stream(payload, "PRINT_QUEUE/bench-upload.bgcode", overwrite=True).ok
+            except Exception:
+                return False
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, min(len(live), PRINTER_POLL_WORKERS))) as pool:
+            sent = list(pool.map(upload, live))
+        elapsed = time.perf_counter() - started
+        result["upload"] = {
+            "seconds": round(elapsed, 4),
+            "bytes_each": upload_bytes,
+            "ok": sum(sent),
+            "failed": len(sent) - sum(sent),
+            "mb_per_s": round(sum(sent) * upload_bytes / 1e6 / elapsed, 2) if elapsed else None,
+        }
+
+        def seed_files():
+            old = time.time() - 7 * 86400
+            for fake in farm:
+                for n in range(files):
+                    fake.add_file(f"PRINT_QUEUE/old-part-{n}.bgcode", size=256 * 1024, m_timestamp=old + n)
+
+        delete_runs = []
+        for _ in range(repeat):
+            seed_files()
+            delete_runs.append(timed(lambda: call_command("delete_files", stdout=StringIO(), stderr=StringIO())))
+        result["delete_files_s"] = summarize(delete_runs)
+        result["printer_requests"] = sum(fake.requests for fake in farm)
+        result["live_printers"] = len(live)
+
+    return result
+
+
+# metric -> where its headline number lives in a result, and whether bigger is better
+HEADLINES = {
+    "status_sweep_s": (("status_sweep_s", "p50"), False),
+    "status_api_ms": (("status_api_ms", "p50"), False),
+    "poll_cycle_s": (("poll_cycle_s", "p50"), False),
+    "upload_mb_per_s": (("upload", "mb_per_s"), True),
+    "delete_files_s": (("delete_files_s", "p50"), False),
+}
+
+
+def headline(result, name):
+    (section, key), _ = HEADLINES[name]
+    return (result.get(section) or {}).get(key)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=settings.BASE_DIR,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = """Benchmarks the status API, poll_printers, uploads and delete_files against a farm of fake
+                PrusaLink printers on 127.0.0.x, in a throwaway database. Writes JSON that --compare reads back"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[5, 25, 100],
+                            help="farm sizes to run (default: %(default)s)")
+        parser.add_argument("--failure-rates", type=float, nargs="+", default=[0.0, 0.1],
+                            help="share of requests a printer answers with 503 (default: %(default)s)")
+        parser.add_argument("--offline", type=float, default=0.0,
+                            help="share of printers that are down altogether")
+        parser.add_argument("--offline-mode", choices=[REFUSE, HANG], default=REFUSE,
+                            help="how a down printer behaves: refuse connections or accept and never answer")
+        parser.add_argument("--latency", type=float, default=0.005,
+                            help="seconds each fake printer takes to answer (default: %(default)s)")
+        parser.add_argument("--bandwidth", type=float, default=0.0, metavar="MB_PER_S",
+                            help="upload bandwidth per printer, 0 for unlimited")
+        parser.add_argument("--upload-mb", type=float, default=1.0,
+                            help="size of the file uploaded to every printer (default: %(default)s)")
+        parser.add_argument("--files", type=int, default=20,
+                            help="old files put on every printer for delete_files (default: %(default)s)")
+        parser.add_argument("--repeat", type=int, default=5,
+                            help="runs of each benchmark per scenario (default: %(default)s)")
+        parser.add_argument("--port", type=int, default=0,
+                            help="port for the fake printers, default any free one")
+        parser.add_argument("--output", metavar="FILE", help="write the results as JSON here")
+        parser.add_argument("--compare", metavar="FILE", help="JSON from an earlier run to compare against")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["compare"]) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can't read {options['compare']}: {e}")
+
+        # never near the real printers table: a fresh test database, on disk for
+        # sqlite so the poller's threads can write to it like in production
+        tmpdir = tempfile.TemporaryDirectory()
+        if connection.vendor == "sqlite":
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tmpdir.name, "bench.sqlite3")
+        old_name = connection.settings_dict["NAME"]
+        autostart = status_cache.PRINTER_STATUS_AUTOSTART
+        setup_test_environment()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        # we sweep ourselves, a background collector would skew the numbers
+        status_cache.PRINTER_STATUS_AUTOSTART = False
+
+        results = []
+        try:
+            for size in options["sizes"]:
+                for failure_rate in options["failure_rates"]:
+                    result = run_scenario(
+                        size,
+                        failure_rate=failure_rate,
+                        offline=options["offline"],
+                        offline_mode=options["offline_mode"],
+                        latency=options["latency"],
+                        bandwidth=options["bandwidth"] * 1e6 or None,
+                        repeat=options["repeat"],
+                        upload_bytes=int(options["upload_mb"] * 1024 ** 2),
+                        files=options["files"],
+                        port=options["port"],
+                    )
+                    results.append(result)
+                    self.stdout.write(self.format_result(result, baseline))
+        finally:
+            status_cache.PRINTER_STATUS_AUTOSTART = autostart
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            tmpdir.cleanup()
+
+        report = {
+            "commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": {k: options[k] for k in (
+                "sizes", "failure_rates", "offline", "offline_mode", "latency", "bandwidth", "upload_mb", "files", "repeat",
+            )},
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def format_result(self, result, baseline=None):
+        def fmt(name, value):
+            return "-" if value is None else f"{value:g}"
+
+        previous = None
+        if baseline:
+            previous = next((
+                old for old in baseline.get("results", [])
+                if (old.get("printers"), old.get("failure_rate"), old.get("offline"), old.get("offline_mode"))
+                == (result["printers"], result["failure_rate"], result["offline"], result["offline_mode"])
+            ), None)
+
+        parts = []
+        for name, (_, bigger_is_better) in HEADLINES.items():
+            value = headline(result, name)
+            part = f"{name} {fmt(name, value)}"
+            old = headline(previous, name) if previous else None
+            if value is not None and old:
+                ratio = value / old
+                worse = ratio < 0.9 if bigger_is_better else ratio > 1.1
+                part += f" (x{ratio:.2f}{' !' if worse else ''})"
+            parts.append(part)
+
+        title = f"{result['printers']} printers, {result['failure_rate']:.0%} failing requests"
+        if result["offline"]:
+            title += f", {result['offline']:.0%} {result['offline_mode']}"
+        return f"{title}: " + ", ".join(parts)
@@ -1,27 +1,174 @@
-import PrusaLinkPy
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import requests
 
 from django.core.management.base import BaseCommand
 
-from printers.models import Printers
+from site_apps.printers.models import PendingJobUsage, PrinterFile, Printers
+from site_apps.printers.clients import get_client
+from site_apps.printers.utils import PRINTER_POLL_WORKERS
+
+
+# we store all uploaded prints in this dir
+UPLOAD_DIR = "/PRINT_QUEUE"
+
+
+def list_print_files(client, remote_dir=UPLOAD_DIR):
+    """
+    Every print file under `remote_dir` on the printer's USB, as dicts with
+    path (for client.delete), remote_path (PendingJobUsage form),
+    size and m_timestamp.
+    """
+    resp = client.get_files(remote_dir.rstrip("/") + "/")
+    if resp.status_code == 404:
+        return []
+    resp.raise_for_status()
+
+    files = []
+    for child in resp.json().get("children", []):
+        if child.get("type") == "FOLDER":
+            files += list_print_files(client, f"{remote_dir}/{child['display_name']}")
+        elif child.get("type") == "PRINT_FILE":
+            files.append({
+                "path": f"{remote_dir}/{child['name']}",
+                "remote_path": f"{remote_dir}/{child.get('display_name') or child['name']}".lstrip("/"),
+                "short_path": f"{remote_dir}/{child['name']}".lstrip("/"),
+                "size": child.get("size") or 0,
+                "m_timestamp": child.get("m_timestamp") or 0,
+            })
+    return files
+
+
+def current_print_paths(client):
+    """
+    Paths (both spellings) of the file the printer is printing right now,
+    empty if it's idle. Raises if we can't tell, we never guess on this.
+    """
+    resp = client.get_job()
+    if resp.status_code == 204:
+        return set()
+    resp.raise_for_status()
+
+    file_info = resp.json().get("file") or {}
+    folder = (file_info.get("path") or "").strip("/").removeprefix("usb").strip("/")
+    return {
+        f"{folder}/{name}".lstrip("/")
+        for name in (file_info.get("name"), file_info.get("display_name"))
+        if name
+    }
+
+
+def cleanup_printer(printer, older_than=None, keep_recent=0, dry_run=False):
+    """
+    Deletes old print files from one printer, returns a report dict.
+    Keeps the file being printed, the `keep_recent` newest ones and anything
+    modified in the last `older_than` seconds.
+    """
+    report = {"removed": [], "bytes": 0, "kept": 0, "failed": [], "error": None}
+    client = get_client(printer)
+
+    try:
+        printing = current_print_paths(client)
+        files = list_print_files(client)
+    except (requests.RequestException, ValueError) as e:
+        report["error"] = str(e) or e.__class__.__name__
+        return report
+
+    files.sort(key=lambda f: f["m_timestamp"], reverse=True)
+    cutoff = time.time() - older_than if older_than else None
+
+    for i, file in enumerate(files):
+        if (
+            i < keep_recent
+            or file["remote_path"] in printing
+            or file["short_path"] in printing
+            or (cutoff is not None and file["m_timestamp"] > cutoff)
+        ):
+            report["kept"] += 1
+            continue
+
+        if not dry_run:
+            try:
+                resp = client.delete(file["path"])
+            except requests.RequestException as e:
+                report["failed"].append((file["path"], str(e) or e.__class__.__name__))
+                continue
+            # 404: someone beat us to it, it's gone either way
+            if resp.status_code not in (200, 204, 404):
+                report["failed"].append((file["path"], f"{resp.status_code} {resp.text[:200]}"))
+                continue
+
+        report["removed"].append(file)
+        report["bytes"] += file["size"]
+
+    return report
+
+
+def format_bytes(size):
+    return f"{size / 1024 ** 2:.1f} MB"
 
 
 class Command(BaseCommand):
     help = "Automatically clears the folder of 3D print files"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=float, default=None, metavar="HOURS",
+                            help="only delete files last modified more than this many hours ago")
+        parser.add_argument("--keep-recent", type=int, default=0, metavar="N",
+                            help="always keep the N newest files on each printer")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="report what would be deleted without deleting anything")
+        parser.add_argument("--printer", action="append", dest="slugs", metavar="SLUG",
+                            help="only clean this printer (repeatable), default all")
+        parser.add_argument("--workers", type=int, default=PRINTER_POLL_WORKERS,
+                            help="printers cleaned at the same time")
+
     def handle(self, *args, **options):
+        printers = Printers.objects.all()
+        if options["slugs"]:
+            printers = printers.filter(slug__in=options["slugs"])
+        printers = list(printers)
+        if not printers:
+            return
 
-        for printer in Printers.objects.all():
-            
-            try:
-                client = PrusaLinkPy.PrusaLinkPy(printer.host, api_key=printer.api_key)
+        older_than = options["older_than"] * 3600 if options["older_than"] else None
+
+        def cleanup(printer):
+            return cleanup_printer(printer, older_than, options["keep_recent"], options["dry_run"])
+
+        # one printer per worker, files on a printer go one after another
+        with ThreadPoolExecutor(max_workers=max(1, min(len(printers), options["workers"]))) as pool:
+            reports = dict(zip(printers, pool.map(cleanup, printers)))
+
+        verb = "would remove" if options["dry_run"] else "removed"
+        total_files = total_bytes = total_failed = total_pending = 0
+
+        for printer, report in reports.items():
+            if report["error"]:
+                self.stderr.write(self.style.ERROR(f"{printer.slug}: unreachable ({report['error']})"))
+                total_failed += 1
+                continue
+
+            # the uploads these files came from will never be printed now
+            removed_paths = [f["remote_path"] for f in report["removed"]] + [f["short_path"] for f in report["removed"]]
+            pending = PendingJobUsage.objects.filter(printer=printer, remote_path__in=removed_paths)
+            pruned = pending.count() if options["dry_run"] else pending.delete()[0]
+            if not options["dry_run"]:
+                # and the next upload of the same content has to send it again
+                PrinterFile.objects.filter(printer=printer, remote_path__in=removed_paths).delete()
 
-                files = client.get_recursive_files("/PRINT_QUEUE") # we store all uploaded prints in this dir
+            line = (f"{printer.slug}: {verb} {len(report['removed'])} files ({format_bytes(report['bytes'])}), "
+                    f"kept {report['kept']}, {len(report['failed'])} failed, {pruned} pending usage rows")
+            self.stdout.write(self.style.WARNING(line) if report["failed"] else line)
+            for path, error in report["failed"]:
+                self.stderr.write(f"  {path}: {error}")
 
+            total_files += len(report["removed"])
+            total_bytes += report["bytes"]
+            total_failed += len(report["failed"])
+            total_pending += pruned
 
-                for folder_name, mapping in files.items():
-                    for display_name, internal_path in mapping.items():
-                        # TODO: prob do something about the response, like check it
-                        resp = client.delete(internal_path)
-            except:
-                # if it fails, it fails
-                pass
\ No newline at end of file
+        summary = (f"{verb} {total_files} files ({format_bytes(total_bytes)}) from {len(printers)} printers, "
+                   f"{total_pending} pending usage rows, {total_failed} failures")
+        self.stdout.write(self.style.ERROR(summary) if total_failed else self.style.SUCCESS(summary))
@@ -1,68 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import logging
+import random
+import time
+
 import requests
-import PrusaLinkPy
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db.models import F
-from django.db import transaction
+from django.db import close_old_connections
+
+from site_apps.printers.clients import get_client
+from site_apps.printers import metrics
+from site_apps.printers.jobs import ledger as job_ledger, observe_job
+from site_apps.printers.models import Printers
+from site_apps.printers.status_cache import store_statuses
+from site_apps.printers.telemetry import buffer as telemetry_buffer, rollup_telemetry
+from site_apps.printers.utils import *
+
+
+logger = logging.getLogger(__name__)
+
+# --daemon defaults, seconds
+PRINTER_POLL_INTERVAL = getattr(settings, "PRINTER_POLL_INTERVAL", 5.0)
+PRINTER_POLL_MAX_BACKOFF = getattr(settings, "PRINTER_POLL_MAX_BACKOFF", 300.0)
+# how often the daemon re-reads the printer list to pick up added/removed/edited printers
+PRINTER_LIST_REFRESH = 30.0
+# how often the daemon writes buffered telemetry and job progress/counters,
+# and rolls up/expires old telemetry
+FLUSH_EVERY = 10.0
+TELEMETRY_ROLLUP_EVERY = 300.0
+
+
+def run_step(name, step):
+    """
+    Runs one of the daemon's database chores. A failure (SQLite's "database
+    is locked", a dropped connection) is logged and counted, the daemon goes
+    on and the next cycle tries again. Returns the step's result, None if it failed.
+    """
+    try:
+        return step()
+    except Exception as e:
+        logger.exception("%s failed", name)
+        metrics.poll_bookkeeping_errors.inc(type=e.__class__.__name__)
+        close_old_connections()
+        return None
 
-from printers.models import Printers
-from printers.utils import *
+
+def record_printer_status(printer, status_json):
+    """
+    Bookkeeping for one successful poll: moves the printer's PrintJob rows
+    along (see jobs.py). Progress goes to the job ledger, the Printers
+    counters get updated when the ledger is committed at the end of a cycle.
+    """
+    events = observe_job(printer, status_json, fetch_job=lambda: get_client(printer).get_job().json())
+    job_ledger.add(events)
+
+
+def poll_printer(printer) -> bool:
+    """
+    Polls one printer, updates the status cache and its stats.
+    Returns False if the printer couldn't be reached.
+    """
+    started = time.perf_counter()
+    try:
+        status_json = get_printer_status(printer)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        store_statuses([printer], {}, errors={printer.pk: str(e) or e.__class__.__name__})
+        telemetry_buffer.add(printer, None)
+        metrics.printer_poll_seconds.observe(time.perf_counter() - started, printer=printer.slug, outcome="offline")
+        return False
+
+    telemetry_buffer.add(printer, status_json)
+    outcome = "ok"
+    try:
+        store_statuses([printer], {printer.pk: status_json})
+        record_printer_status(printer, status_json)
+    except Exception as e:
+        # the printer itself is fine, don't count it as down over our own bookkeeping
+        logger.exception("recording the status of %s failed", printer.slug)
+        metrics.poll_bookkeeping_errors.inc(type=e.__class__.__name__)
+        outcome = "bookkeeping_error"
+    finally:
+        close_old_connections()
+        metrics.printer_poll_seconds.observe(time.perf_counter() - started, printer=printer.slug, outcome=outcome)
+
+    return True
 
 
 class Command(BaseCommand):
     help = """Polls printers to increment their total print count, update total filament usage, etc. for collecting stats
-                to better track the printers as they degrade"""
+                to better track the printers as they degrade. Runs once (cron) or forever with --daemon"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--daemon", action="store_true",
+                            help="keep running, polling every printer on its own schedule")
+        parser.add_argument("--interval", type=float, default=PRINTER_POLL_INTERVAL,
+                            help="seconds between two polls of a healthy printer (default: %(default)s)")
+        parser.add_argument("--jitter", type=float, default=0.1,
+                            help="spread each delay by +/- this fraction so printers don't get polled in lockstep")
+        parser.add_argument("--max-backoff", type=float, default=PRINTER_POLL_MAX_BACKOFF,
+                            help="cap in seconds for the exponential backoff on unreachable printers")
+        parser.add_argument("--workers", type=int, default=PRINTER_POLL_WORKERS,
+                            help="max printers polled at the same time")
+        parser.add_argument("--metrics-port", type=int,
+                            help="with --daemon, serve the poller's Prometheus metrics on this port")
 
     def handle(self, *args, **options):
+        if options["daemon"]:
+            if options["metrics_port"]:
+                metrics.start_exporter(options["metrics_port"])
+                self.stdout.write(f"Metrics on port {options['metrics_port']}")
+            return self.run_daemon(options)
+
+        printers = list(Printers.objects.all())
+        if not printers:
+            return
+
+        # one-shot: still concurrent, so a dead printer only costs its own timeout
+        with metrics.poll_cycle_seconds.time(source="poll_printers"):
+            with ThreadPoolExecutor(max_workers=min(len(printers), options["workers"])) as pool:
+                list(pool.map(poll_printer, printers))
+
+        telemetry_buffer.flush()
+        job_ledger.commit()
+        rollup_telemetry()
+
+    def next_delay(self, failures, options):
+        """
+        Regular interval while the printer answers, doubling per consecutive
+        failure up to --max-backoff, with jitter either way.
+        """
+        delay = min(options["interval"] * (2 ** failures), options["max_backoff"])
+        return delay * (1 + random.uniform(-options["jitter"], options["jitter"]))
+
+    def run_daemon(self, options):
+        self.stdout.write(f"Polling printers every {options['interval']}s, Ctrl+C to stop")
+
+        printers = {}   # pk -> Printers
+        failures = {}   # pk -> consecutive failed polls
+        schedule = []   # heap of (due, pk)
+        in_flight = {}  # pk -> future
+        refreshed_at = None
+        flushed_at = rolled_up_at = time.monotonic()
+
+        pool = ThreadPoolExecutor(max_workers=options["workers"])
+        try:
+            while True:
+                now = time.monotonic()
+
+                if refreshed_at is None or now - refreshed_at > PRINTER_LIST_REFRESH:
+                    # keeps polling the printers we know when the list can't be read
+                    current = run_step("refreshing the printer list", lambda: {
+                        printer.pk: printer for printer in Printers.objects.all()
+                    })
+                    if current is not None:
+                        for pk in current.keys() - printers.keys():
+                            # new printer, spread first polls over one interval
+                            heapq.heappush(schedule, (now + random.uniform(0, options["interval"]), pk))
+                        printers = current
+                        refreshed_at = now
+                    else:
+                        # don't hammer the database, try again in a few seconds
+                        refreshed_at = now - PRINTER_LIST_REFRESH + FLUSH_EVERY
+
+                # hand every due printer to the pool, one poll per printer at a time
+                while schedule and schedule[0][0] <= now:
+                    _, pk = heapq.heappop(schedule)
+                    if pk in printers and pk not in in_flight:
+                        in_flight[pk] = pool.submit(poll_printer, printers[pk])
+
+                for pk, future in list(in_flight.items()):
+                    if not future.done():
+                        continue
+                    del in_flight[pk]
+
+                    ok = not future.exception() and future.result()
+                    failures[pk] = 0 if ok else failures.get(pk, 0) + 1
+                    if pk in printers:
+                        heapq.heappush(schedule, (time.monotonic() + self.next_delay(failures[pk], options), pk))
+
+                if now - flushed_at > FLUSH_EVERY:
+                    # what doesn't go in stays buffered for the next flush
+                    run_step("flushing telemetry", telemetry_buffer.flush)
+                    run_step("committing job progress", job_ledger.commit)
+                    flushed_at = now
+                if now - rolled_up_at > TELEMETRY_ROLLUP_EVERY:
+                    run_step("rolling up telemetry", rollup_telemetry)
+                    rolled_up_at = now
 
-        for printer in Printers.objects.all():
-
-            try:
-        
-                client = PrusaLinkPy.PrusaLinkPy(printer.host, api_key=printer.api_key)
-
-                resp = client.get_status()
-                resp.raise_for_status()  # raises for HTTP 4xx/5xx
-
-                # grabbing the data
-                status_json = resp.json()
-                raw_state = status_json.get("printer", {}).get("state")
-                job_info  = status_json.get("job", {}) or {}
-                job_id = str(job_info.get("id") or "")
-
-                ### updating total prints to date for each printer
-                if raw_state is not None:
-                    status = map_printer_status(raw_state)
-            
-                if status is "printing" and job_id != (printer.last_job_id or ""):
-                    Printers.objects.filter(slug=printer.slug).update(
-                        total_print_count=F("total_print_count") + 1,
-                        last_job_id=job_id
-                    )
-                    # sync the in-memory object if you need it
-                    printer.refresh_from_db(fields=["total_print_count", "last_job_id"])
-                    
-                    
-                ### updating filament usage
-                with transaction.atomic():
-                    used_mm, used_g, used_cm3, pending = get_filament_usage_from_job(printer, job_info)
-                    changed_fields = []
-
-                    if used_mm:
-                        printer.filament_usage_mm += used_mm
-                        changed_fields.append("filament_usage_mm")
-                    if used_g:
-                        printer.filament_usage_g += used_g
-                        changed_fields.append("filament_usage_g")
-                    if used_cm3:
-                        printer.filament_usage_cm3 += used_cm3
-                        changed_fields.append("filament_usage_cm3")
-                    if changed_fields:
-                        printer.save(update_fields=changed_fields)
-                    # remove pending usage so we don't double-count next cron run
-                    if pending:
-                        pending.delete()
-                    
-            except:
-                # if it fails, it fails
-                pass
\ No newline at end of file
+                wait = schedule[0][0] - time.monotonic() if schedule else options["interval"]
+                # check back quickly while polls are running so results get rescheduled on time
+                time.sleep(min(max(wait, 0.01), 0.05 if in_flight else 0.5))
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping poller")
+        finally:
+            # polls already running finish (within their timeout) so the last flush has them too
+            pool.shutdown(wait=True, cancel_futures=True)
+            run_step("flushing telemetry", telemetry_buffer.flush)
+            run_step("committing job progress", job_ledger.commit)
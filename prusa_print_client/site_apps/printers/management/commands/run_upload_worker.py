@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from site_apps.printers import metrics
+from site_apps.printers.upload_queue import UPLOAD_WORKERS, UploadWorker
+
+
+class Command(BaseCommand):
+    help = """Transfers queued uploads to the printers. Run this when UPLOAD_WORKER_AUTOSTART is off
+                so the web workers don't do it themselves"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=UPLOAD_WORKERS,
+                            help="max transfers running at once (default: %(default)s)")
+        parser.add_argument("--metrics-port", type=int,
+                            help="serve this worker's Prometheus metrics on this port")
+
+    def handle(self, *args, **options):
+        if options["metrics_port"]:
+            metrics.start_exporter(options["metrics_port"])
+            self.stdout.write(f"Metrics on port {options['metrics_port']}")
+        self.stdout.write(f"Upload worker running with {options['workers']} slots, Ctrl+C to stop")
+        try:
+            UploadWorker(workers=options["workers"]).run()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping upload worker")
@@ -0,0 +1,272 @@
+"""
+In-process metrics in the Prometheus text format, served at /api/metrics/ (views.metrics_api).
+
+No client library, just counters and histograms with labels behind a lock.
+Every process keeps its own numbers, scrape each one you care about: the web
+workers at /api/metrics/, `poll_printers --daemon` and `run_upload_worker`
+on their own port when started with --metrics-port (start_exporter()).
+
+What gets measured and where:
+  printer_request_seconds / printer_request_errors_total   clients.PrinterClient.request
+  printer_upload_bytes_total / printer_upload_seconds      clients.PrinterClient.put_stream
+  printer_poll_seconds / poll_cycle_seconds                poll_printers, status collector
+  status_cache_reads_total                                 status_cache.get_statuses
+  http_request_seconds / http_db_queries                   QueryCountMiddleware
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+import requests
+from django.conf import settings
+from django.db import connection
+
+
+# seconds, tuned for LAN printers: most calls are well under 100 ms, a dead one hits the timeout
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# who gets to read the metrics besides superusers, Prometheus usually scrapes from localhost
+METRICS_ALLOWED_IPS = getattr(settings, "METRICS_ALLOWED_IPS", ["127.0.0.1", "::1"])
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = dict(self._values)
+        for key in sorted(values):
+            lines += self._render_value(key, values[key])
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [count per bucket (+Inf last), sum]
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts = list(counts)
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            le = [("le", bound if bound == "+Inf" else repr(float(bound)))]
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+registry = []
+
+
+printer_request_seconds = Histogram(
+    "printer_request_seconds", "PrusaLink call latency including retries.", ["printer", "method", "endpoint"],
+)
+printer_request_errors = Counter(
+    "printer_request_errors_total", "PrusaLink calls that failed, by error type.", ["printer", "type"],
+)
+printer_upload_bytes = Counter(
+    "printer_upload_bytes_total", "Bytes of print files sent to printers.", ["printer"],
+)
+printer_upload_seconds = Histogram(
+    "printer_upload_seconds", "Duration of print file transfers to printers.", ["printer", "outcome"],
+    buckets=DURATION_BUCKETS,
+)
+printer_commands = Counter(
+    "printer_commands_total", "Pause/resume/stop commands sent to printers, by outcome.", ["action", "outcome"],
+)
+printer_poll_seconds = Histogram(
+    "printer_poll_seconds", "One printer's poll in poll_printers, bookkeeping included.", ["printer", "outcome"],
+)
+poll_cycle_seconds = Histogram(
+    "poll_cycle_seconds", "Duration of a whole farm sweep.", ["source"], buckets=DURATION_BUCKETS,
+)
+poll_bookkeeping_errors = Counter(
+    "poll_bookkeeping_errors_total", "Polls where the printer answered but recording the result failed.", ["type"],
+)
+status_cache_reads = Counter(
+    "status_cache_reads_total", "Printer status cache lookups by views, by result.", ["result"],
+)
+http_request_seconds = Histogram(
+    "http_request_seconds", "Time spent in each view.", ["view", "method"],
+)
+http_db_queries = Histogram(
+    "http_db_queries", "Database queries per request, by view.", ["view"], buckets=QUERY_BUCKETS,
+)
+
+
+def error_type(error):
+    """
+    Short label for what went wrong talking to a printer.
+    """
+    if isinstance(error, requests.Timeout):
+        return "timeout"
+    if isinstance(error, requests.ConnectionError):
+        return "connection"
+    if isinstance(error, requests.Response):
+        return f"http_{error.status_code // 100}xx"
+    if isinstance(error, ValueError):
+        return "bad_response"
+    return error.__class__.__name__
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+class ExporterHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.client_address[0] not in METRICS_ALLOWED_IPS:
+            self.send_error(403)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a scrape every few seconds would flood the daemon's output
+        pass
+
+
+def start_exporter(port, host="") -> ThreadingHTTPServer:
+    """
+    Serves this process's metrics on `port` from a background thread, for
+    the daemons that have no web endpoint. Same METRICS_ALLOWED_IPS check
+    as views.metrics_api. Returns the server, shutdown() stops it.
+    """
+    server = ThreadingHTTPServer((host, port), ExporterHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
+
+
+class QueryCountMiddleware:
+    """
+    Times every request and counts the database queries it runs, labelled
+    by the view's url name. Works both ways so Django doesn't push the async
+    views (status, commands, stream) into a thread just for this.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        counter = QueryCounter()
+        started = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self._observe(request, time.perf_counter() - started, counter.queries)
+        return response
+
+    async def __acall__(self, request):
+        # the request's queries (sync views, async ORM calls) all run on its
+        # thread sensitive executor, so the wrapper goes on that thread's connection
+        counter = QueryCounter()
+        started = time.perf_counter()
+        wrapper = await sync_to_async(counter.install)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrapper.__exit__)(None, None, None)
+        self._observe(request, time.perf_counter() - started, counter.queries)
+        return response
+
+    def _observe(self, request, elapsed, queries):
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        http_request_seconds.observe(elapsed, view=view, method=request.method)
+        http_db_queries.observe(queries, view=view)
+
+
+class QueryCounter:
+    """
+    connection.execute_wrapper() that counts the queries going through it.
+    """
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        # entered on the calling thread's connection, exit it on the same thread
+        wrapper = connection.execute_wrapper(self)
+        wrapper.__enter__()
+        return wrapper
@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:32
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0005_printers_filament_usage_cm3_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('remote_path', models.CharField(max_length=255)),
+                ('spool_path', models.CharField(max_length=512)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('uploading', 'Uploading'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('bytes_total', models.BigIntegerField(default=0)),
+                ('bytes_sent', models.BigIntegerField(default=0)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('error', models.TextField(blank=True)),
+                ('filament_mm', models.FloatField(blank=True, null=True)),
+                ('filament_g', models.FloatField(blank=True, null=True)),
+                ('filament_cm3', models.FloatField(blank=True, null=True)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('printer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_jobs', to='printers.printers')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='printers_up_status_d5b67d_idx')],
+            },
+        ),
+    ]
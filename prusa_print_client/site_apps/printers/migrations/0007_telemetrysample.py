@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0006_uploadjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelemetrySample',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('raw', 'Raw'), ('1m', '1 minute'), ('1h', '1 hour')], default='raw', max_length=4)),
+                ('timestamp', models.DateTimeField()),
+                ('temp_nozzle', models.FloatField(blank=True, null=True)),
+                ('temp_bed', models.FloatField(blank=True, null=True)),
+                ('temp_nozzle_max', models.FloatField(blank=True, null=True)),
+                ('progress', models.FloatField(blank=True, null=True)),
+                ('state', models.CharField(blank=True, max_length=16)),
+                ('printing_fraction', models.FloatField(default=0)),
+                ('samples', models.PositiveIntegerField(default=1)),
+                ('printer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='telemetry', to='printers.printers')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['printer', 'resolution', 'timestamp'], name='printers_te_printer_159f4d_idx'), models.Index(fields=['resolution', 'timestamp'], name='printers_te_resolut_bd8d2a_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0007_telemetrysample'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrintJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_id', models.CharField(max_length=64)),
+                ('remote_path', models.CharField(blank=True, max_length=255)),
+                ('display_name', models.CharField(blank=True, max_length=255)),
+                ('state', models.CharField(choices=[('printing', 'Printing'), ('paused', 'Paused'), ('finished', 'Finished'), ('stopped', 'Stopped'), ('error', 'Error'), ('unknown', 'Unknown')], default='printing', max_length=16)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('duration', models.PositiveIntegerField(blank=True, null=True)),
+                ('progress', models.FloatField(blank=True, null=True)),
+                ('expected_filament_mm', models.FloatField(blank=True, null=True)),
+                ('expected_filament_g', models.FloatField(blank=True, null=True)),
+                ('expected_filament_cm3', models.FloatField(blank=True, null=True)),
+                ('filament_mm', models.FloatField(blank=True, null=True)),
+                ('filament_g', models.FloatField(blank=True, null=True)),
+                ('filament_cm3', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pendingjobusage',
+            index=models.Index(fields=['printer', 'remote_path'], name='printers_pe_printer_fe7bc8_idx'),
+        ),
+        migrations.AddField(
+            model_name='printjob',
+            name='printer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='print_jobs', to='printers.printers'),
+        ),
+        migrations.AddIndex(
+            model_name='printjob',
+            index=models.Index(fields=['printer', 'state'], name='printers_pr_printer_207050_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='printjob',
+            index=models.Index(fields=['printer', 'started_at'], name='printers_pr_printer_9cb3e0_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='printjob',
+            constraint=models.UniqueConstraint(fields=('printer', 'job_id'), name='unique_printer_job'),
+        ),
+    ]
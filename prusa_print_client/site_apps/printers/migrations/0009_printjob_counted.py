@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:37
+
+from django.db import migrations, models
+
+
+def mark_existing_counted(apps, schema_editor):
+    # the poller used to add a job to the counters as soon as it ended
+    PrintJob = apps.get_model("printers", "PrintJob")
+    PrintJob.objects.exclude(state__in=["printing", "paused"]).update(counted=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0008_printjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='printjob',
+            name='counted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='printjob',
+            index=models.Index(condition=models.Q(('counted', False)), fields=['state'], name='printjob_uncounted'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_daily_stats(apps, schema_editor):
+    # same bucketing as stats.py, from the jobs tracked so far
+    PrintJob = apps.get_model("printers", "PrintJob")
+    PrinterDailyStats = apps.get_model("printers", "PrinterDailyStats")
+    outcomes = {"finished": "prints_finished", "stopped": "prints_failed", "error": "prints_failed", "unknown": "prints_unknown"}
+
+    rows = {}
+    def row(printer_id, when):
+        key = (printer_id, timezone.localdate(when))
+        if key not in rows:
+            rows[key] = PrinterDailyStats(printer_id=printer_id, day=key[1])
+        return rows[key]
+
+    for job in PrintJob.objects.all().iterator():
+        row(job.printer_id, job.started_at).prints_started += 1
+        if job.counted and job.state in outcomes:
+            day = row(job.printer_id, job.ended_at or job.started_at)
+            setattr(day, outcomes[job.state], getattr(day, outcomes[job.state]) + 1)
+            day.printing_seconds += job.duration or 0
+            day.filament_mm += job.filament_mm or 0.0
+            day.filament_g += job.filament_g or 0.0
+            day.filament_cm3 += job.filament_cm3 or 0.0
+
+    PrinterDailyStats.objects.bulk_create(rows.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0009_printjob_counted'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrinterDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('prints_started', models.PositiveIntegerField(default=0)),
+                ('prints_finished', models.PositiveIntegerField(default=0)),
+                ('prints_failed', models.PositiveIntegerField(default=0)),
+                ('prints_unknown', models.PositiveIntegerField(default=0)),
+                ('printing_seconds', models.PositiveIntegerField(default=0)),
+                ('filament_mm', models.FloatField(default=0.0)),
+                ('filament_g', models.FloatField(default=0.0)),
+                ('filament_cm3', models.FloatField(default=0.0)),
+                ('printer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='printers.printers')),
+            ],
+            options={
+                'verbose_name_plural': 'Printer daily stats',
+                'indexes': [models.Index(fields=['day', 'printer'], name='printers_pr_day_293abc_idx')],
+                'constraints': [models.UniqueConstraint(fields=('printer', 'day'), name='unique_printer_day')],
+            },
+        ),
+        migrations.RunPython(backfill_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0010_printerdailystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadedContent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('filename', models.CharField(max_length=255)),
+                ('format', models.CharField(blank=True, max_length=16)),
+                ('filament_mm', models.FloatField(blank=True, null=True)),
+                ('filament_g', models.FloatField(blank=True, null=True)),
+                ('filament_cm3', models.FloatField(blank=True, null=True)),
+                ('estimated_time', models.PositiveIntegerField(blank=True, null=True)),
+                ('metadata', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Uploaded content',
+            },
+        ),
+        migrations.AddField(
+            model_name='uploadjob',
+            name='content',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_jobs', to='printers.uploadedcontent'),
+        ),
+        migrations.CreateModel(
+            name='PrinterFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('remote_path', models.CharField(max_length=255)),
+                ('uploaded_at', models.DateTimeField(auto_now=True)),
+                ('printer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='files', to='printers.printers')),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='printer_files', to='printers.uploadedcontent')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('printer', 'remote_path'), name='unique_printer_file')],
+            },
+        ),
+    ]
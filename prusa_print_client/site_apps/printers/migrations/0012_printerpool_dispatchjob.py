@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0011_uploadedcontent_printerfile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrinterPool',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True)),
+                ('slug', models.SlugField(max_length=64, unique=True)),
+                ('printers', models.ManyToManyField(blank=True, related_name='pools', to='printers.printers')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DispatchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target_model', models.CharField(blank=True, choices=[('core_one', 'Prusa Core One'), ('mk4', 'Original Prusa MK4')], max_length=128)),
+                ('priority', models.IntegerField(default=0)),
+                ('filename', models.CharField(max_length=255)),
+                ('remote_path', models.CharField(max_length=255)),
+                ('spool_path', models.CharField(max_length=512)),
+                ('bytes_total', models.BigIntegerField(default=0)),
+                ('estimated_time', models.PositiveIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('assigned', 'Assigned'), ('started', 'Started'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='waiting', max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('assigned_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('content', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dispatch_jobs', to='printers.uploadedcontent')),
+                ('print_job', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dispatch_jobs', to='printers.printjob')),
+                ('printer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dispatch_jobs', to='printers.printers')),
+                ('upload_job', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='dispatch_job', to='printers.uploadjob')),
+                ('pool', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='dispatch_jobs', to='printers.printerpool')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', '-priority', 'created_at'], name='printers_di_status_17a3bb_idx'), models.Index(fields=['printer', 'status'], name='printers_di_printer_1f4e87_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('pool__isnull', True), models.Q(('target_model', ''), _negated=True)), models.Q(('pool__isnull', False), ('target_model', '')), _connector='OR'), name='dispatchjob_one_target')],
+            },
+        ),
+    ]
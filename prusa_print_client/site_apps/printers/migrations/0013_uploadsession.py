@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-18 11:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('printers', '0012_printerpool_dispatchjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('target_model', models.CharField(blank=True, choices=[('core_one', 'Prusa Core One'), ('mk4', 'Original Prusa MK4')], max_length=128)),
+                ('priority', models.IntegerField(default=0)),
+                ('filename', models.CharField(max_length=255)),
+                ('spool_path', models.CharField(max_length=512)),
+                ('bytes_total', models.BigIntegerField()),
+                ('bytes_received', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('finalized', 'Finalized'), ('aborted', 'Aborted')], default='open', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('dispatch_job', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='printers.dispatchjob')),
+                ('pool', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='printers.printerpool')),
+                ('printer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='printers.printers')),
+                ('upload_job', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='upload_session', to='printers.uploadjob')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='printers_up_status_e61741_idx')],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.urls import reverse
+from django.utils import timezone
 
 
 class Printers(models.Model):
@@ -21,7 +22,7 @@ class Printers(models.Model):
     staff_notes = models.TextField()
     last_maintenance = models.DateField(auto_now=False, auto_now_add=False, null=True, blank=True)
 
-    # bookkeeping for print count
+    # bookkeeping for print count, superseded by PrintJob
     last_job_id = models.CharField(max_length=64, null=True, blank=True)
 
     # stats for curiosity's sake
@@ -64,5 +65,461 @@ class PendingJobUsage(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # new jobs get matched to their file on every poll that sees one start
+            models.Index(fields=["printer", "remote_path"]),
+        ]
+
+    def __str__(self):
+        return f"{self.printer.slug} :: {self.remote_path}"
+
+
+class PrintJob(models.Model):
+    """
+    One print on one printer, from the poll that first sees it to the one
+    where it ends. Driven by jobs.observe_job(), per-printer stats are
+    aggregates over this table.
+    """
+    PRINTING = "printing"
+    PAUSED = "paused"
+    FINISHED = "finished"
+    STOPPED = "stopped"
+    ERROR = "error"
+    UNKNOWN = "unknown"  # the job vanished between two polls
+    STATES = [
+        (PRINTING, "Printing"),
+        (PAUSED, "Paused"),
+        (FINISHED, "Finished"),
+        (STOPPED, "Stopped"),
+        (ERROR, "Error"),
+        (UNKNOWN, "Unknown"),
+    ]
+    ACTIVE_STATES = (PRINTING, PAUSED)
+
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.CASCADE,
+        related_name="print_jobs",
+    )
+    # the printer's own job id, only unique per printer
+    job_id = models.CharField(max_length=64)
+    # same form as PendingJobUsage.remote_path, e.g. "PRINT_QUEUE/foo.bgcode"
+    remote_path = models.CharField(max_length=255, blank=True)
+    display_name = models.CharField(max_length=255, blank=True)
+
+    state = models.CharField(max_length=16, choices=STATES, default=PRINTING)
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField(null=True, blank=True)
+    duration = models.PositiveIntegerField(null=True, blank=True)  # seconds spent printing
+    progress = models.FloatField(null=True, blank=True)  # percent
+
+    # what the sliced file says the whole print takes (from PendingJobUsage)
+    expected_filament_mm = models.FloatField(null=True, blank=True)
+    expected_filament_g = models.FloatField(null=True, blank=True)
+    expected_filament_cm3 = models.FloatField(null=True, blank=True)
+
+    # what it actually used, set when the job ends (scaled by progress if it didn't finish)
+    filament_mm = models.FloatField(null=True, blank=True)
+    filament_g = models.FloatField(null=True, blank=True)
+    filament_cm3 = models.FloatField(null=True, blank=True)
+
+    # whether the Printers counters include this job's outcome yet, see jobs.count_ended_jobs()
+    counted = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["printer", "job_id"], name="unique_printer_job"),
+        ]
+        indexes = [
+            models.Index(fields=["printer", "state"]),
+            models.Index(fields=["printer", "started_at"]),
+            # only ever a handful of rows, looked up every poll cycle
+            models.Index(fields=["state"], condition=models.Q(counted=False), name="printjob_uncounted"),
+        ]
+
+    def __str__(self):
+        return f"{self.printer_id} #{self.job_id} ({self.state})"
+
+
+class PrinterDailyStats(models.Model):
+    """
+    Per printer, per day totals of its PrintJobs, kept up to date by the
+    poller (see stats.py) so farm stats never have to scan job history.
+    Starts count on the day the job started, everything else on the day it ended.
+    """
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.CASCADE,
+        related_name="daily_stats",
+    )
+    day = models.DateField()
+
+    prints_started = models.PositiveIntegerField(default=0)
+    prints_finished = models.PositiveIntegerField(default=0)
+    prints_failed = models.PositiveIntegerField(default=0)  # stopped or error
+    prints_unknown = models.PositiveIntegerField(default=0)  # vanished between polls
+    printing_seconds = models.PositiveIntegerField(default=0)
+    filament_mm = models.FloatField(default=0.0)
+    filament_g = models.FloatField(default=0.0)
+    filament_cm3 = models.FloatField(default=0.0)
+
+    class Meta:
+        verbose_name_plural = "Printer daily stats"
+        constraints = [
+            models.UniqueConstraint(fields=["printer", "day"], name="unique_printer_day"),
+        ]
+        indexes = [
+            models.Index(fields=["day", "printer"]),
+        ]
+
+    def __str__(self):
+        return f"{self.printer_id} @ {self.day}"
+
+
+class UploadedContent(models.Model):
+    """
+    A print file we've seen before, by sha256 of its bytes, with the metadata
+    parsed out of it the first time. Re-uploads of the same file reuse this
+    instead of parsing it again (see content.py).
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    filename = models.CharField(max_length=255)  # first name it was uploaded as
+
+    format = models.CharField(max_length=16, blank=True)
+    filament_mm = models.FloatField(null=True, blank=True)
+    filament_g = models.FloatField(null=True, blank=True)
+    filament_cm3 = models.FloatField(null=True, blank=True)
+    estimated_time = models.PositiveIntegerField(null=True, blank=True)  # seconds
+    metadata = models.JSONField(default=dict, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Uploaded content"
+
+    def __str__(self):
+        return f"{self.filename} ({self.sha256[:12]})"
+
+    def as_metadata(self) -> dict:
+        # same shape as bgcode.read_print_metadata()
+        filament = {unit: getattr(self, f"filament_{unit}") for unit in ("mm", "g", "cm3")}
+        return {
+            "format": self.format or None,
+            "filament": {unit: amount for unit, amount in filament.items() if amount is not None},
+            "estimated_time": self.estimated_time,
+            "metadata": self.metadata,
+        }
+
+
+class PrinterFile(models.Model):
+    """
+    A file we put in a printer's PRINT_QUEUE and what's in it, so uploading
+    the same content to the same path again can skip the transfer.
+    """
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.CASCADE,
+        related_name="files",
+    )
+    remote_path = models.CharField(max_length=255)  # e.g. "PRINT_QUEUE/foo.bgcode"
+    content = models.ForeignKey(
+        UploadedContent,
+        on_delete=models.CASCADE,
+        related_name="printer_files",
+    )
+    uploaded_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["printer", "remote_path"], name="unique_printer_file"),
+        ]
+
+    def __str__(self):
+        return f"{self.printer_id} :: {self.remote_path}"
+
+
+class UploadJob(models.Model):
+    """
+    A print file waiting for (or going through) its transfer to a printer.
+    The file sits in UPLOAD_SPOOL_DIR until the upload worker is done with it.
+    """
+    QUEUED = "queued"
+    UPLOADING = "uploading"
+    DONE = "done"
+    FAILED = "failed"
+    STATUSES = [
+        (QUEUED, "Queued"),
+        (UPLOADING, "Uploading"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.CASCADE,
+        related_name="upload_jobs",
+    )
+    filename = models.CharField(max_length=255)
+    remote_path = models.CharField(max_length=255)
+    spool_path = models.CharField(max_length=512)
+
+    status = models.CharField(max_length=16, choices=STATUSES, default=QUEUED)
+    bytes_total = models.BigIntegerField(default=0)
+    bytes_sent = models.BigIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    error = models.TextField(blank=True)
+
+    # set while spooling, becomes a PrinterFile once the transfer succeeds
+    content = models.ForeignKey(
+        UploadedContent,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="upload_jobs",
+    )
+
+    # parsed while spooling, becomes a PendingJobUsage once the transfer succeeds
+    filament_mm = models.FloatField(null=True, blank=True)
+    filament_g = models.FloatField(null=True, blank=True)
+    filament_cm3 = models.FloatField(null=True, blank=True)
+
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # the worker's "what's due next" query
+            models.Index(fields=["status", "next_attempt_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} -> {self.printer_id} ({self.status})"
+
+
+class PrinterPool(models.Model):
+    """
+    A named group of printers an upload can be dispatched to instead of one
+    printer, e.g. "PETG loaded" or "0.6 nozzle". A printer can be in several.
+    """
+    name = models.CharField(max_length=128, unique=True)
+    slug = models.SlugField(max_length=64, unique=True)
+    printers = models.ManyToManyField(Printers, related_name="pools", blank=True)
+
+    def __str__(self):
+        return self.name
+
+
+class DispatchJob(models.Model):
+    """
+    A print file queued for "any MK4" or "any printer in this pool" rather
+    than a specific printer. dispatch.py hands it to whichever printer of its
+    target frees up soonest, as an UploadJob.
+    """
+    WAITING = "waiting"
+    ASSIGNED = "assigned"  # sent to its printer, waiting for someone to start it
+    STARTED = "started"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+    STATUSES = [
+        (WAITING, "Waiting"),
+        (ASSIGNED, "Assigned"),
+        (STARTED, "Started"),
+        (FAILED, "Failed"),
+        (CANCELLED, "Cancelled"),
+    ]
+
+    # exactly one of these two
+    target_model = models.CharField(max_length=128, choices=Printers.PRINTERS, blank=True)
+    pool = models.ForeignKey(
+        PrinterPool,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="dispatch_jobs",
+    )
+    priority = models.IntegerField(default=0)  # higher goes first
+
+    filename = models.CharField(max_length=255)
+    remote_path = models.CharField(max_length=255)
+    spool_path = models.CharField(max_length=512)
+    bytes_total = models.BigIntegerField(default=0)
+    content = models.ForeignKey(
+        UploadedContent,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="dispatch_jobs",
+    )
+    # from the file's metadata, seconds
+    estimated_time = models.PositiveIntegerField(null=True, blank=True)
+
+    status = models.CharField(max_length=16, choices=STATUSES, default=WAITING)
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="dispatch_jobs",
+    )
+    upload_job = models.OneToOneField(
+        UploadJob,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="dispatch_job",
+    )
+    print_job = models.ForeignKey(
+        PrintJob,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="dispatch_jobs",
+    )
+    error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    assigned_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=(models.Q(pool__isnull=True) & ~models.Q(target_model=""))
+                | (models.Q(pool__isnull=False) & models.Q(target_model="")),
+                name="dispatchjob_one_target",
+            ),
+        ]
+        indexes = [
+            # the dispatcher loading what's waiting, in order
+            models.Index(fields=["status", "-priority", "created_at"]),
+            # what's already lined up on each printer
+            models.Index(fields=["printer", "status"]),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} -> {self.target_model or self.pool_id} ({self.status})"
+
+
+class UploadSession(models.Model):
+    """
+    A resumable upload from the browser (upload_sessions.py). The file comes
+    in chunks into a spool file and becomes an UploadJob (printer) or a
+    DispatchJob (target_model/pool) once it's complete.
+    """
+    OPEN = "open"
+    FINALIZED = "finalized"
+    ABORTED = "aborted"
+    STATUSES = [
+        (OPEN, "Open"),
+        (FINALIZED, "Finalized"),
+        (ABORTED, "Aborted"),
+    ]
+
+    key = models.CharField(max_length=32, unique=True)
+
+    # where it's going, like upload_jobs_api: one printer, a model or a pool
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="upload_sessions",
+    )
+    target_model = models.CharField(max_length=128, choices=Printers.PRINTERS, blank=True)
+    pool = models.ForeignKey(
+        PrinterPool,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="upload_sessions",
+    )
+    priority = models.IntegerField(default=0)
+
+    filename = models.CharField(max_length=255)
+    spool_path = models.CharField(max_length=512)
+    bytes_total = models.BigIntegerField()
+    # everything before this offset is in the spool file
+    bytes_received = models.BigIntegerField(default=0)
+    # what the client says the whole file hashes to, checked when finalizing
+    sha256 = models.CharField(max_length=64, blank=True)
+
+    status = models.CharField(max_length=16, choices=STATUSES, default=OPEN)
+    upload_job = models.OneToOneField(
+        UploadJob,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="upload_session",
+    )
+    dispatch_job = models.OneToOneField(
+        DispatchJob,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="upload_session",
+    )
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # expiring abandoned sessions
+            models.Index(fields=["status", "updated_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} ({self.bytes_received}/{self.bytes_total}, {self.status})"
+
+
+class TelemetrySample(models.Model):
+    """
+    Temperature/progress/state history of a printer, written by poll_printers.
+
+    Raw samples get rolled up into 1 minute buckets, those into 1 hour buckets,
+    and each level is deleted after its retention (see telemetry.py), so the
+    table stays roughly the same size no matter how long the farm runs.
+    """
+    RAW = "raw"
+    MINUTE = "1m"
+    HOUR = "1h"
+    RESOLUTIONS = [
+        (RAW, "Raw"),
+        (MINUTE, "1 minute"),
+        (HOUR, "1 hour"),
+    ]
+
+    printer = models.ForeignKey(
+        Printers,
+        on_delete=models.CASCADE,
+        related_name="telemetry",
+    )
+    resolution = models.CharField(max_length=4, choices=RESOLUTIONS, default=RAW)
+    # start of the bucket for rollups
+    timestamp = models.DateTimeField()
+
+    # averages over the bucket for rollups
+    temp_nozzle = models.FloatField(null=True, blank=True)
+    temp_bed = models.FloatField(null=True, blank=True)
+    temp_nozzle_max = models.FloatField(null=True, blank=True)
+    progress = models.FloatField(null=True, blank=True)
+    # mapped status (see map_printer_status), the last one seen for rollups
+    state = models.CharField(max_length=16, blank=True)
+    # share of the bucket spent printing, 0..1, this is what utilization graphs use
+    printing_fraction = models.FloatField(default=0)
+    samples = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["printer", "resolution", "timestamp"]),
+            # rollups/retention scan by age across all printers
+            models.Index(fields=["resolution", "timestamp"]),
+        ]
+
     def __str__(self):
-        return f"{self.printer.slug} :: {self.remote_path}"
\ No newline at end of file
+        return f"{self.printer_id} {self.resolution} {self.timestamp:%Y-%m-%d %H:%M:%S}"
@@ -0,0 +1,98 @@
+"""
+Farm statistics, served from the PrinterDailyStats rollup.
+
+jobs.py adds to the rollup as it goes (a start when a PrintJob is created, the
+outcome when it gets counted), so a farm report for any window only reads
+one row per printer per day in it, however much job history there is.
+"""
+from django.db.models import F, Sum
+
+from .models import PrinterDailyStats, Printers, PrintJob
+
+
+# PrintJob end state -> PrinterDailyStats counter
+OUTCOME_FIELDS = {
+    PrintJob.FINISHED: "prints_finished",
+    PrintJob.STOPPED: "prints_failed",
+    PrintJob.ERROR: "prints_failed",
+    PrintJob.UNKNOWN: "prints_unknown",
+}
+
+TOTAL_FIELDS = [
+    "prints_started", "prints_finished", "prints_failed", "prints_unknown",
+    "printing_seconds", "filament_mm", "filament_g", "filament_cm3",
+]
+
+
+def add_daily_stats(printer_id, day, **amounts):
+    """
+    Adds `amounts` (field=number) to a printer's row for `day`, creating it
+    if needed. Atomic F() update, call it inside the transaction that
+    changes the jobs it accounts for.
+    """
+    amounts = {name: amount for name, amount in amounts.items() if amount}
+    if not amounts:
+        return
+    row, _ = PrinterDailyStats.objects.get_or_create(printer_id=printer_id, day=day)
+    PrinterDailyStats.objects.filter(pk=row.pk).update(
+        **{name: F(name) + amount for name, amount in amounts.items()}
+    )
+
+
+def _summarize(totals, printer_count, window_seconds):
+    ended = totals["prints_finished"] + totals["prints_failed"] + totals["prints_unknown"]
+    possible = printer_count * window_seconds
+    return {
+        **totals,
+        "printing_hours": round(totals["printing_seconds"] / 3600, 2),
+        # share of the window the printers spent printing
+        "utilization": round(totals["printing_seconds"] / possible, 4) if possible else None,
+        "success_rate": round(totals["prints_finished"] / ended, 2) if ended else None,
+    }
+
+
+def farm_stats(since, until) -> dict:
+    """
+    Totals per printer, per printer model and for the whole farm over the
+    days [since, until] (dates, inclusive). Two queries.
+    """
+    window_seconds = ((until - since).days + 1) * 24 * 60 * 60
+    printers = list(Printers.objects.order_by("name").values("pk", "slug", "name", "model"))
+
+    rows = (
+        PrinterDailyStats.objects.filter(day__gte=since, day__lte=until)
+        .values("printer")
+        .annotate(**{name: Sum(name) for name in TOTAL_FIELDS})
+    )
+    by_printer = {row.pop("printer"): row for row in rows}
+
+    empty = {name: 0 for name in TOTAL_FIELDS}
+    model_names = dict(Printers.PRINTERS)
+    per_printer, per_model, farm = [], {}, dict(empty)
+
+    for printer in printers:
+        totals = {name: by_printer.get(printer["pk"], empty)[name] or 0 for name in TOTAL_FIELDS}
+        per_printer.append({
+            "slug": printer["slug"],
+            "name": printer["name"],
+            "model": printer["model"],
+            **_summarize(totals, 1, window_seconds),
+        })
+
+        count, model_totals = per_model.get(printer["model"], (0, dict(empty)))
+        per_model[printer["model"]] = (count + 1, model_totals)
+        for name in TOTAL_FIELDS:
+            model_totals[name] += totals[name]
+            farm[name] += totals[name]
+
+    return {
+        "since": since,
+        "until": until,
+        "printers": per_printer,
+        "models": [
+            {"model": model, "name": model_names.get(model, model), "printers": count,
+             **_summarize(totals, count, window_seconds)}
+            for model, (count, totals) in per_model.items()
+        ],
+        "farm": {"printers": len(printers), **_summarize(farm, len(printers), window_seconds)},
+    }
@@ -0,0 +1,390 @@
+"""
+Shared cache of the latest status of every printer.
+
+One background collector sweeps the farm every PRINTER_STATUS_INTERVAL seconds
+and writes what it got into Django's cache. The API views only ever read from
+here, so the printers see the same load whether 1 or 50 tabs are open.
+
+With the default LocMemCache that's one collector per process; point CACHES
+at a shared backend (file/redis/db) and the sweep lock below makes it one
+collector for the whole deployment.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+
+from . import metrics
+from .clients import get_health
+from .utils import PRINTER_STATUSES, fetch_printer_statuses, map_printer_status
+
+
+logger = logging.getLogger(__name__)
+
+# seconds between two sweeps of the farm
+PRINTER_STATUS_INTERVAL = getattr(settings, "PRINTER_STATUS_INTERVAL", 2.0)
+# entries older than this get flagged as stale in the API responses
+PRINTER_STATUS_STALE_AFTER = getattr(settings, "PRINTER_STATUS_STALE_AFTER", 10.0)
+# start the in-process collector the first time a view reads the cache
+PRINTER_STATUS_AUTOSTART = getattr(settings, "PRINTER_STATUS_AUTOSTART", True)
+
+# how often (seconds) an open status stream checks the cache for changes
+PRINTER_STREAM_TICK = getattr(settings, "PRINTER_STREAM_TICK", 0.5)
+# streams are closed after this many seconds, EventSource reconnects on its own
+PRINTER_STREAM_MAX_AGE = getattr(settings, "PRINTER_STREAM_MAX_AGE", 300)
+# send an SSE comment this often so proxies don't drop an idle stream
+PRINTER_STREAM_HEARTBEAT = 15
+
+# every "status" a cached entry can have
+STATUSES = PRINTER_STATUSES + ("offline", "unknown")
+
+STATUS_KEY = "printers:status:{slug}"
+SWEEP_LOCK_KEY = "printers:status:sweep-lock"
+# bumped whenever any printer's live fields change, see get_snapshot()
+VERSION_KEY = "printers:status:version"
+
+
+def _status_key(slug):
+    return STATUS_KEY.format(slug=slug)
+
+
+def build_entry(printer, status_json, previous=None, error=None, now=None, health=None) -> dict:
+    """
+    Turns one printer's /api/v1/status json (or None if it didn't answer)
+    into the dict we keep in the cache. `health` is the printer's circuit
+    breaker snapshot (health.py), it fills in why it's offline.
+    """
+    now = now or time.time()
+    previous = previous or {}
+    health = health or {}
+
+    if status_json is None:
+        seen = [t for t in (previous.get("last_seen"), health.get("last_seen")) if t is not None]
+        return {
+            "slug": printer.slug,
+            "ok": False,
+            "status": "offline",
+            "printer": {},
+            "job": {},
+            "fetched_at": now,
+            "last_seen": max(seen) if seen else None,
+            "error": error or (f"Printer unavailable ({health['reason']})" if health.get("reason") else "Printer unavailable"),
+            "circuit": health.get("state"),
+            "retry_in": health.get("retry_in"),
+        }
+
+    printer_info = status_json.get("printer") or {}
+    raw_state = printer_info.get("state")
+
+    return {
+        "slug": printer.slug,
+        "ok": True,
+        # if for some reason there's no state, treat as busy/error-ish
+        "status": map_printer_status(raw_state) if raw_state is not None else "busy",
+        "printer": printer_info,
+        "job": status_json.get("job") or {},
+        "fetched_at": now,
+        "last_seen": now,
+        "error": None,
+        "circuit": health.get("state"),
+        "retry_in": None,
+    }
+
+
+def store_statuses(printers, statuses, errors=None):
+    """
+    Writes a sweep's worth of results into the cache.
+    `statuses` is {printer.pk: status_json or None} like fetch_printer_statuses returns.
+    """
+    errors = errors or {}
+    keys = [_status_key(printer.slug) for printer in printers]
+    previous = cache.get_many(keys)
+    now = time.time()
+
+    entries = {}
+    version = None
+    for key, printer in zip(keys, printers):
+        entry = build_entry(
+            printer,
+            statuses.get(printer.pk),
+            previous=previous.get(key),
+            error=errors.get(printer.pk),
+            now=now,
+            health=get_health(printer),
+        )
+
+        before = previous.get(key)
+        if before is None or "version" not in before or _state_fields(before) != _state_fields(entry):
+            # one bump per sweep, every printer that changed in it shares the new version
+            version = version or _next_version()
+            entry["version"] = version
+        else:
+            entry["version"] = before["version"]
+        entries[key] = entry
+
+    # no expiry, an old entry is still useful for last_seen
+    cache.set_many(entries, timeout=None)
+    return entries
+
+
+def get_statuses(printers) -> dict:
+    """
+    Reads the cached status of each printer, never talks to the printers.
+
+    Returns {slug: entry} where every entry also carries "age" (seconds) and
+    "stale" (bool). Printers the collector hasn't reached yet come back as
+    status "unknown".
+    """
+    if PRINTER_STATUS_AUTOSTART:
+        collector.ensure_running()
+
+    printers = list(printers)
+    return _read_entries(printers, cache.get_many([_status_key(printer.slug) for printer in printers]))
+
+
+async def aget_statuses(printers) -> dict:
+    """
+    get_statuses() for async views, `printers` a list (no lazy queryset).
+    """
+    if PRINTER_STATUS_AUTOSTART:
+        collector.ensure_running()
+
+    return _read_entries(printers, await cache.aget_many([_status_key(printer.slug) for printer in printers]))
+
+
+def _read_entries(printers, cached):
+    now = time.time()
+
+    result = {}
+    for printer in printers:
+        entry = cached.get(_status_key(printer.slug))
+        if entry is None:
+            entry = {
+                "slug": printer.slug,
+                "ok": False,
+                "status": "unknown",
+                "printer": {},
+                "job": {},
+                "fetched_at": None,
+                "last_seen": None,
+                "error": "No status collected yet",
+                "circuit": None,
+                "retry_in": None,
+            }
+
+        entry = dict(entry)
+        entry["age"] = None if entry["fetched_at"] is None else round(now - entry["fetched_at"], 2)
+        entry["stale"] = entry["age"] is None or entry["age"] > PRINTER_STATUS_STALE_AFTER
+        result[printer.slug] = entry
+
+        metrics.status_cache_reads.inc(
+            result="miss" if entry["fetched_at"] is None else "stale" if entry["stale"] else "hit"
+        )
+
+    return result
+
+
+def get_status(printer) -> dict:
+    return get_statuses([printer])[printer.slug]
+
+
+async def aget_status(printer) -> dict:
+    return (await aget_statuses([printer]))[printer.slug]
+
+
+def _next_version():
+    cache.add(VERSION_KEY, 0, timeout=None)
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # evicted between the add and the incr
+        cache.set(VERSION_KEY, 1, timeout=None)
+        return 1
+
+
+def _state_fields(entry) -> dict:
+    printer_info = entry["printer"]
+    job_info = entry["job"]
+
+    return {
+        "status": entry["status"],
+        "nozzle_temp": printer_info.get("temp_nozzle"),
+        "bed_temp": printer_info.get("temp_bed"),
+        "progress": job_info.get("progress"),
+        "time_remaining": job_info.get("time_remaining"),
+        # only interesting once it drops off, otherwise it'd change every sweep
+        "last_seen": None if entry["ok"] else entry["last_seen"],
+        "error": None if entry["ok"] else entry["error"],
+    }
+
+
+def live_fields(entry) -> dict:
+    """
+    The handful of fields that actually change from tick to tick,
+    this is what gets pushed to the browser.
+    """
+    return {**_state_fields(entry), "stale": entry["stale"]}
+
+
+def get_snapshot(printers, since=None) -> dict:
+    """
+    Live fields of every printer in one go, for printers_snapshot_api.
+
+    Every cached entry carries the farm version it last changed at. With
+    `since` only printers that changed after that version are included;
+    if `since` is ahead of us (cache was cleared) it's a full snapshot again.
+    """
+    statuses = get_statuses(printers)
+    version = cache.get(VERSION_KEY) or 0
+    full = since is None or since > version
+
+    return {
+        "version": version,
+        "full": full,
+        "printers": {
+            slug: live_fields(entry)
+            for slug, entry in statuses.items()
+            # stale entries stop changing, keep telling the client about them
+            if full or entry.get("version") is None or entry["version"] > since or entry["stale"]
+        },
+    }
+
+
+class StatusStream:
+    """
+    Server-Sent Events feed of the status cache for a fixed set of printers.
+
+    The first event is a full "snapshot", after that only "update" events
+    holding the fields that changed since the last one, e.g.
+      event: update
+      data: {"mk4-1": {"nozzle_temp": 215.1, "progress": 43}}
+    """
+
+    def __init__(self, printers):
+        self.printers = list(printers)
+        self.sent = None
+        self.started = time.monotonic()
+        self.last_event = self.started
+
+    @property
+    def expired(self):
+        return time.monotonic() - self.started > PRINTER_STREAM_MAX_AGE
+
+    def poll(self):
+        """
+        Returns the next chunk to write to the client, or None if there's
+        nothing new to say yet.
+        """
+        current = {slug: live_fields(entry) for slug, entry in get_statuses(self.printers).items()}
+
+        if self.sent is None:
+            self.sent = current
+            return self._event("snapshot", current, retry=True)
+
+        changes = {}
+        for slug, fields in current.items():
+            previous = self.sent.get(slug, {})
+            changed = {name: value for name, value in fields.items() if previous.get(name) != value}
+            if changed:
+                changes[slug] = changed
+        self.sent = current
+
+        if changes:
+            return self._event("update", changes)
+
+        if time.monotonic() - self.last_event > PRINTER_STREAM_HEARTBEAT:
+            self.last_event = time.monotonic()
+            return ": ping\n\n"
+
+        return None
+
+    def _event(self, name, data, retry=False):
+        self.last_event = time.monotonic()
+        chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n"
+        if retry:
+            chunk = "retry: 3000\n" + chunk
+        return chunk
+
+    def __iter__(self):
+        # WSGI: blocks a worker for the life of the stream, prefer running under asgi.py
+        while not self.expired:
+            chunk = self.poll()
+            if chunk:
+                yield chunk
+            time.sleep(PRINTER_STREAM_TICK)
+
+    async def __aiter__(self):
+        # not thread sensitive: every open stream would queue on the one
+        # thread all the async views' ORM calls go through
+        poll = sync_to_async(self.poll, thread_sensitive=False)
+        while not self.expired:
+            chunk = await poll()
+            if chunk:
+                yield chunk
+            await asyncio.sleep(PRINTER_STREAM_TICK)
+
+
+class StatusCollector:
+    """
+    Background thread that sweeps the whole farm on a fixed cadence.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or PRINTER_STATUS_INTERVAL
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def ensure_running(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="printer-status-collector", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def sweep(self):
+        """
+        Polls every printer once and stores the results. Returns False if
+        another collector already did this interval's sweep.
+        """
+        # only one collector per interval across everything sharing the cache
+        if not cache.add(SWEEP_LOCK_KEY, os.getpid(), timeout=self.interval):
+            return False
+
+        from .models import Printers
+
+        with metrics.poll_cycle_seconds.time(source="collector"):
+            printers = list(Printers.objects.only("pk", "slug", "host", "api_key"))
+            statuses = fetch_printer_statuses(printers)
+            store_statuses(printers, statuses)
+        return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.sweep()
+            except Exception:
+                # never let one bad sweep kill the collector
+                logger.exception("printer status sweep failed")
+            finally:
+                close_old_connections()
+
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+collector = StatusCollector()
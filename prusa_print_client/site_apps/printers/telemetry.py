@@ -0,0 +1,189 @@
+"""
+Time series of printer temperatures, progress and state.
+
+poll_printers adds a raw sample per printer per poll to a buffer that gets
+bulk inserted every few seconds. rollup_telemetry() then folds:
+
+  raw  older than TELEMETRY_RAW_RETENTION     -> 1 minute buckets
+  1m   older than TELEMETRY_MINUTE_RETENTION  -> 1 hour buckets
+  1h   older than TELEMETRY_HOUR_RETENTION    -> deleted
+
+Every level only ever covers time the level below no longer has, so a graph
+just reads all three for its window.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import TelemetrySample
+from .utils import map_printer_status
+
+
+TELEMETRY_RAW_RETENTION = timedelta(hours=getattr(settings, "TELEMETRY_RAW_RETENTION_HOURS", 6))
+TELEMETRY_MINUTE_RETENTION = timedelta(days=getattr(settings, "TELEMETRY_MINUTE_RETENTION_DAYS", 7))
+TELEMETRY_HOUR_RETENTION = timedelta(days=getattr(settings, "TELEMETRY_HOUR_RETENTION_DAYS", 365))
+
+# samples kept for the next flush while the database won't take them, oldest go first
+TELEMETRY_BUFFER_MAX = 20_000
+
+# buckets are aligned to this
+EPOCH = datetime(2000, 1, 1, tzinfo=dt_timezone.utc)
+
+# (resolution, rolls up into, bucket size, how long the source level is kept)
+ROLLUPS = [
+    (TelemetrySample.RAW, TelemetrySample.MINUTE, timedelta(minutes=1), TELEMETRY_RAW_RETENTION),
+    (TelemetrySample.MINUTE, TelemetrySample.HOUR, timedelta(hours=1), TELEMETRY_MINUTE_RETENTION),
+]
+
+
+def sample_from_status(printer, status_json, when=None) -> TelemetrySample:
+    """
+    Builds (doesn't save) a raw sample from a /api/v1/status json,
+    None for status_json means the printer didn't answer.
+    """
+    if status_json is None:
+        return TelemetrySample(printer=printer, timestamp=when or timezone.now(), state="offline")
+
+    printer_info = status_json.get("printer") or {}
+    job_info = status_json.get("job") or {}
+    state = map_printer_status(printer_info.get("state")) if printer_info.get("state") is not None else "busy"
+
+    return TelemetrySample(
+        printer=printer,
+        timestamp=when or timezone.now(),
+        temp_nozzle=printer_info.get("temp_nozzle"),
+        temp_bed=printer_info.get("temp_bed"),
+        temp_nozzle_max=printer_info.get("temp_nozzle"),
+        progress=job_info.get("progress"),
+        state=state,
+        printing_fraction=1.0 if state == "printing" else 0.0,
+    )
+
+
+class TelemetryBuffer:
+    """
+    Collects samples from the poller threads so they can go in with one
+    bulk insert instead of one INSERT per poll.
+    """
+
+    def __init__(self):
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def add(self, printer, status_json):
+        sample = sample_from_status(printer, status_json)
+        with self._lock:
+            self._samples.append(sample)
+
+    def flush(self):
+        with self._lock:
+            samples, self._samples = self._samples, []
+        if samples:
+            try:
+                with transaction.atomic():
+                    TelemetrySample.objects.bulk_create(samples, batch_size=500)
+            except Exception:
+                # nothing went in, keep them for the next flush
+                with self._lock:
+                    self._samples = (samples + self._samples)[-TELEMETRY_BUFFER_MAX:]
+                raise
+        return len(samples)
+
+
+buffer = TelemetryBuffer()
+
+
+def _weighted(total, weight):
+    return total / weight if weight else None
+
+
+def _rollup_level(source, target, bucket_size, retention, now):
+    # only whole buckets, a bucket must never be split over two runs
+    cutoff = now - retention
+    cutoff = cutoff - ((cutoff - EPOCH) % bucket_size)
+
+    old = TelemetrySample.objects.filter(resolution=source, timestamp__lt=cutoff)
+    rows = old.order_by("printer_id", "timestamp").values_list(
+        "printer_id", "timestamp", "temp_nozzle", "temp_bed", "temp_nozzle_max",
+        "progress", "state", "printing_fraction", "samples",
+    )
+
+    buckets = {}
+    for printer_id, ts, nozzle, bed, nozzle_max, progress, state, printing, samples in rows.iterator(chunk_size=2000):
+        start = ts - ((ts - EPOCH) % bucket_size)
+        b = buckets.setdefault((printer_id, start), {
+            "nozzle": 0.0, "nozzle_n": 0, "bed": 0.0, "bed_n": 0, "nozzle_max": None,
+            "progress": None, "state": "", "printing": 0.0, "samples": 0,
+        })
+        # averages are weighted by how many raw samples each row stands for
+        if nozzle is not None:
+            b["nozzle"] += nozzle * samples
+            b["nozzle_n"] += samples
+        if bed is not None:
+            b["bed"] += bed * samples
+            b["bed_n"] += samples
+        if nozzle_max is not None:
+            b["nozzle_max"] = nozzle_max if b["nozzle_max"] is None else max(b["nozzle_max"], nozzle_max)
+        if progress is not None:
+            b["progress"] = progress
+        b["state"] = state
+        b["printing"] += printing * samples
+        b["samples"] += samples
+
+    rolled = [
+        TelemetrySample(
+            printer_id=printer_id,
+            resolution=target,
+            timestamp=start,
+            temp_nozzle=_weighted(b["nozzle"], b["nozzle_n"]),
+            temp_bed=_weighted(b["bed"], b["bed_n"]),
+            temp_nozzle_max=b["nozzle_max"],
+            progress=b["progress"],
+            state=b["state"],
+            printing_fraction=b["printing"] / b["samples"],
+            samples=b["samples"],
+        )
+        for (printer_id, start), b in buckets.items()
+    ]
+
+    TelemetrySample.objects.bulk_create(rolled, batch_size=500)
+    old.delete()
+    return len(rolled)
+
+
+def rollup_telemetry(now=None) -> dict:
+    """
+    Runs every rollup and the final retention cut, returns how many rows
+    each step produced/removed. Safe to run as often as you like.
+    """
+    now = now or timezone.now()
+    result = {}
+
+    with transaction.atomic():
+        for source, target, bucket_size, retention in ROLLUPS:
+            result[target] = _rollup_level(source, target, bucket_size, retention, now)
+
+        result["expired"], _ = TelemetrySample.objects.filter(
+            resolution=TelemetrySample.HOUR,
+            timestamp__lt=now - TELEMETRY_HOUR_RETENTION,
+        ).delete()
+
+    return result
+
+
+def get_telemetry(printer, since, until=None):
+    """
+    All samples of a printer in [since, until), oldest first, mixing
+    resolutions as they come (recent = raw, older = 1m, oldest = 1h).
+    """
+    samples = TelemetrySample.objects.filter(printer=printer, timestamp__gte=since)
+    if until is not None:
+        samples = samples.filter(timestamp__lt=until)
+
+    return samples.order_by("timestamp").values_list(
+        "timestamp", "resolution", "temp_nozzle", "temp_bed", "temp_nozzle_max",
+        "progress", "state", "printing_fraction",
+    )
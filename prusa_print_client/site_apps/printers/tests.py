@@ -1,3 +1,1352 @@
-from django.test import TestCase
+import asyncio
+import base64
+import datetime
+import hashlib
+from io import BytesIO, StringIO
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+from unittest import mock
+import zlib
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.http import UnreadablePostError
+from django.test import AsyncClient, AsyncRequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+import requests
+from asgiref.sync import async_to_sync, sync_to_async
+from django.utils import timezone
+
+from . import (
+    bgcode, broadcast, clients, content, dispatch, health, jobs, metrics, status_cache, thumbnails, upload_queue,
+    upload_sessions, uploads, views,
+)
+from .async_clients import get_async_client
+from .clients import get_client
+from .dispatch import Dispatcher, mark_started
+from .fakefarm import FakeFarm
+from .jobs import count_ended_jobs, ledger as job_ledger, observe_job
+from .management.commands import poll_printers
+from .management.commands.bench_farm import run_scenario
+from .models import (
+    DispatchJob, PendingJobUsage, PrinterDailyStats, PrinterFile, PrinterPool, Printers, PrintJob, TelemetrySample,
+    UploadJob, UploadSession,
+)
+from .stats import add_daily_stats, farm_stats
+from .status_cache import store_statuses
+from .telemetry import rollup_telemetry
+from .uploads import UploadStream
+from .utils import fetch_printer_statuses
+
+
+def add_printers(count, pending_per_printer=3):
+    start = Printers.objects.count()
+    for i in range(start, start + count):
+        printer = Printers.objects.create(
+            name=f"Printer {i}", slug=f"printer-{i}", model="mk4" if i % 2 else "core_one",
+            host=f"127.0.0.{i % 250 + 2}", api_key="secret", date_added=datetime.date(2025, 1, 1),
+            staff_notes="notes " * 200,
+        )
+        PendingJobUsage.objects.bulk_create(
+            PendingJobUsage(printer=printer, remote_path=f"PRINT_QUEUE/part-{n}.bgcode", filament_g=n)
+            for n in range(pending_per_printer)
+        )
+
+
+class QueryCountTests(TestCase):
+    """
+    The pages shouldn't run more queries as the farm (and its pending jobs) grows.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.admin = get_user_model().objects.create_superuser("admin", "admin@example.com", "password")
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url):
+        add_printers(2)
+        small = self.count_queries(url)
+        add_printers(40)
+        self.assertEqual(self.count_queries(url), small)
+
+    def test_dashboard(self):
+        self.assertConstantQueries("/")
+
+    def test_printer_page(self):
+        self.assertConstantQueries("/printer-1")
+
+    def test_pending_jobs_admin(self):
+        self.client.force_login(self.admin)
+        self.assertConstantQueries("/admin/printers/pendingjobusage/")
+
+    def test_dashboard_fragment_cache(self):
+        add_printers(3)
+        self.client.get("/")
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/")
+        self.assertEqual(len(queries), 0)
+        self.assertContains(response, "Printer 2")
+
+        # saving a printer throws the rendered list away
+        Printers.objects.filter(slug="printer-2").update(name="Renamed")
+        printer = Printers.objects.get(slug="printer-2")
+        printer.save()
+        self.assertContains(self.client.get("/"), "Renamed")
+
+
+    def test_metrics_endpoints(self):
+        add_printers(1, pending_per_printer=0)
+        Printers.objects.filter(slug="printer-0").update(slug="metrics", name="Metrics printer")
+        self.assertContains(self.client.get("/metrics"), "Metrics printer")
+        self.assertContains(self.client.get("/api/metrics/"), "http_request_seconds")
+
+        # the daemons serve theirs on a port of their own
+        server = metrics.start_exporter(0, "127.0.0.1")
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        response = requests.get(f"http://127.0.0.1:{server.server_port}/metrics", timeout=5)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE poll_cycle_seconds histogram", response.text)
+
+
+@mock.patch.object(status_cache, "PRINTER_STATUS_AUTOSTART", False)
+class FakeFarmTests(TransactionTestCase):
+    """
+    The poller, status cache and cleanup against fake PrusaLink printers.
+    """
+
+    def setUp(self):
+        cache.clear()
+
+    def test_status_sweep(self):
+        with FakeFarm(3, offline=0.34) as farm:
+            printers = farm.create_printers()
+            farm.printers[0].start_print("PRINT_QUEUE/benchy.bgcode")
+            store_statuses(printers, fetch_printer_statuses(printers))
+
+            statuses = {item["slug"]: item["status"] for item in self.client.get("/api/printers/status/").json()}
+        self.assertEqual(statuses, {"fake-0": "printing", "fake-1": "ready", "fake-2": "offline"})
+
+    def test_poll_printers_follows_a_print(self):
+        with FakeFarm(1) as farm:
+            printer, = farm.create_printers()
+            fake, = farm.printers
+            fake.start_print("PRINT_QUEUE/benchy.bgcode")
+
+            call_command("poll_printers", stdout=StringIO())
+            job = PrintJob.objects.get(printer=printer)
+            self.assertEqual((job.state, job.display_name), (PrintJob.PRINTING, "benchy.bgcode"))
+
+            fake.finish_print()
+            call_command("poll_printers", stdout=StringIO())
+
+        job.refresh_from_db()
+        printer.refresh_from_db()
+        self.assertEqual(job.state, PrintJob.FINISHED)
+        self.assertTrue(job.counted)
+        self.assertEqual((printer.total_print_count, printer.successful_prints), (1, 1))
+
+    def test_daemon_survives_database_errors(self):
+        locked = OperationalError("database is locked")
+        failures = {"list": 1, "telemetry": 2, "rollup": 1}
+
+        def flaky(name, real):
+            def call(*args, **kwargs):
+                if failures[name]:
+                    failures[name] -= 1
+                    raise locked
+                return real(*args, **kwargs)
+            return call
+
+        real_sleep, deadline = time.sleep, time.monotonic() + 1.5
+
+        def sleep(seconds):
+            # Ctrl+C for the daemon after a while, the fake printers' threads sleep on
+            if threading.current_thread() is threading.main_thread() and time.monotonic() > deadline:
+                raise KeyboardInterrupt
+            real_sleep(seconds)
+
+        def polls(slug):
+            return sum(metrics.printer_poll_seconds._values.get((slug, "ok"), ([0], 0))[0])
+
+        errors = sum(metrics.poll_bookkeeping_errors._values.values())
+        with FakeFarm(1) as farm:
+            printer, = farm.create_printers()
+            polls_before = polls(printer.slug)
+            with mock.patch.object(poll_printers, "FLUSH_EVERY", 0), \
+                    mock.patch.object(poll_printers, "TELEMETRY_ROLLUP_EVERY", 0), \
+                    mock.patch.object(poll_printers, "PRINTER_LIST_REFRESH", 0), \
+                    mock.patch.object(poll_printers.Printers.objects, "all",
+                                      flaky("list", poll_printers.Printers.objects.all)), \
+                    mock.patch.object(TelemetrySample.objects, "bulk_create",
+                                      flaky("telemetry", TelemetrySample.objects.bulk_create)), \
+                    mock.patch.object(poll_printers, "rollup_telemetry", flaky("rollup", lambda: None)), \
+                    mock.patch.object(time, "sleep", sleep), \
+                    self.assertLogs(poll_printers.logger, "ERROR") as logs:
+                call_command("poll_printers", daemon=True, interval=0.05, stdout=StringIO())
+
+        self.assertEqual(failures, {"list": 0, "telemetry": 0, "rollup": 0})
+        self.assertEqual(len(logs.records), 4)
+        self.assertEqual(sum(metrics.poll_bookkeeping_errors._values.values()) - errors, 4)
+        # the samples of the failed flushes went in with a later one
+        self.assertGreater(TelemetrySample.objects.filter(printer=printer).count(), 2)
+        self.assertEqual(TelemetrySample.objects.filter(printer=printer).count(), polls(printer.slug) - polls_before)
+
+    def test_delete_files_keeps_the_current_print(self):
+        with FakeFarm(1) as farm:
+            farm.create_printers()
+            fake, = farm.printers
+            for n in range(5):
+                fake.add_file(f"PRINT_QUEUE/part-{n}.bgcode", m_timestamp=time.time() - 86400)
+            fake.start_print("PRINT_QUEUE/part-3.bgcode")
+
+            call_command("delete_files", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(list(fake.files), ["PRINT_QUEUE/part-3.bgcode"])
+
+    def test_bench_scenario(self):
+        result = run_scenario(2, failure_rate=0.5, repeat=1, upload_bytes=1024, files=2)
+
+        self.assertEqual(result["printers"], 2)
+        self.assertEqual(result["upload"]["ok"] + result["upload"]["failed"], 2)
+        for name in ("status_sweep_s", "poll_cycle_s", "delete_files_s"):
+            self.assertEqual(result[name]["n"], 1)
+
+
+@mock.patch.object(status_cache, "PRINTER_STATUS_AUTOSTART", False)
+class AsyncClientTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_calls(self):
+        with FakeFarm(2, offline=0.5) as farm:
+            up, down = farm.create_printers()
+            fake = farm.by_host(up.host)
+            fake.start_print("PRINT_QUEUE/benchy.bgcode")
+            client = get_async_client(up)
+
+            async def calls():
+                statuses = await asyncio.gather(*(client.get_status() for _ in range(20)))
+                paused = await client.pause_print()
+                uploaded = await client.put_stream(b"G1 X1\n" * 1000, "PRINT_QUEUE/part.bgcode", overwrite=True)
+                return statuses, paused, uploaded, await client.exists_gcode("PRINT_QUEUE/part.bgcode")
+
+            statuses, paused, uploaded, exists = asyncio.run(calls())
+            self.assertEqual({resp.json()["printer"]["state"] for resp in statuses}, {"PRINTING"})
+            self.assertEqual((paused.status_code, fake.state), (204, "PAUSED"))
+            self.assertEqual((uploaded.status_code, fake.files["PRINT_QUEUE/part.bgcode"]["size"], exists), (201, 6000, True))
+
+            async def offline():
+                for _ in range(3):
+                    with self.assertRaises(requests.ConnectionError):
+                        await get_async_client(down).get_status()
+
+            asyncio.run(offline())
+            # the sync client of that printer learned it too
+            self.assertEqual(get_client(down).health.snapshot()["state"], "open")
+
+    def test_connections_close_with_their_loop(self):
+        with FakeFarm(1) as farm:
+            printer, = farm.create_printers()
+            client = get_async_client(printer)
+
+            async def calls():
+                await asyncio.gather(*(client.get_status() for _ in range(20)))
+                await client.get_status()
+                idle = client._pools[asyncio.get_running_loop()][0]
+                # the later call reused one of the first ones' connections
+                self.assertLessEqual(len(idle), clients.PRINTER_POOL_SIZE)
+                return [writer for _, writer in idle]
+
+            # a throwaway loop per call, like async views under WSGI
+            for run in (lambda: asyncio.run(calls()), async_to_sync(calls)):
+                writers = run()
+                self.assertTrue(writers)
+                self.assertTrue(all(writer.is_closing() for writer in writers))
+                self.assertEqual(client._pools, {})
+
+    def test_middleware_stays_async(self):
+        # Django logs (in DEBUG) every middleware it has to adapt, which would run the async views in a thread
+        before = metrics.http_request_seconds._values.get(("printers:printers_status_api", "GET"), ([], 0))[0]
+        with self.settings(DEBUG=True), self.assertNoLogs("django.request", "DEBUG"):
+            response = async_to_sync(AsyncClient().get)("/api/printers/status/")
+        self.assertEqual(response.status_code, 200)
+        after = metrics.http_request_seconds._values[("printers:printers_status_api", "GET")][0]
+        self.assertEqual(sum(after) - sum(before or [0]), 1)
+
+    def test_queries_counted_under_asgi(self):
+        add_printers(3)
+
+        def queries(view):
+            return metrics.http_db_queries._values.get((view,), ([], 0))
+
+        for path, view in (("/api/printers/status/", "printers:printers_status_api"),
+                           ("/api/printers/snapshot/", "printers:printers_snapshot_api")):
+            with self.subTest(view=view):
+                before = queries(view)
+                self.assertEqual(self.client.get(path).status_code, 200)
+                wsgi = queries(view)
+                self.assertEqual(async_to_sync(AsyncClient().get)(path).status_code, 200)
+                asgi = queries(view)
+                # one observation each, and the same queries whichever handler ran the view
+                self.assertEqual((sum(wsgi[0]) - sum(before[0]), sum(asgi[0]) - sum(wsgi[0])), (1, 1))
+                self.assertGreater(wsgi[1] - before[1], 0)
+                self.assertEqual(asgi[1] - wsgi[1], wsgi[1] - before[1])
+
+    def test_commands_api(self):
+        user = get_user_model().objects.create_superuser("admin", password="pw")
+        self.client.force_login(user)
+        with FakeFarm(1) as farm:
+            printer, = farm.create_printers()
+            fake, = farm.printers
+
+            response = self.client.post("/api/printer-commands/", {"slug": printer.slug, "action": "pause"},
+                                        content_type="application/json")
+            self.assertEqual(response.json(), {"error": "No active print"})
+
+            fake.start_print("PRINT_QUEUE/benchy.bgcode")
+            response = self.client.post("/api/printer-commands/", {"slug": printer.slug, "action": "pause"},
+                                        content_type="application/json")
+            self.assertEqual((response.json(), fake.state), ({"ok": True, "action": "pause"}, "PAUSED"))
+            # was compared with `is` and paused instead
+            self.client.post("/api/printer-commands/", {"slug": printer.slug, "action": "stop"},
+                             content_type="application/json")
+            self.assertEqual(fake.state, "STOPPED")
+
+    def test_bulk_commands(self):
+        self.client.force_login(get_user_model().objects.create_superuser("admin", password="pw"))
+        with FakeFarm(4, offline=0.25) as farm:
+            printers = farm.create_printers()
+            for fake in farm.printers[:2]:
+                fake.start_print("PRINT_QUEUE/benchy.bgcode")
+            store_statuses(printers, fetch_printer_statuses(printers))
+
+            def bulk(**body):
+                return self.client.post("/api/printer-commands/bulk/", body, content_type="application/json")
+
+            self.assertEqual(bulk(action="stop").status_code, 400)
+            self.assertEqual(bulk(action="explode", all=True).status_code, 400)
+            for bad in ({"slugs": {"fake-0": True}}, {"slugs": [1]}, {"slugs": [["fake-0"]]},
+                        {"state": [{}]}, {"model": ["mk4"]}, {"model": "prusa_xl"}, {"pool": "nope"},
+                        {"state": "idle"}, {"state": ["printing", "printnig"]}):
+                self.assertEqual(bulk(action="stop", **bad).status_code, 400)
+            self.assertEqual([fake.state for fake in farm.printers[:2]], ["PRINTING", "PRINTING"])
+
+            # states are the ones printers_status_api shows, in any case
+            response = bulk(action="pause", state="PRINTING").json()
+            self.assertEqual(response["summary"], {"done": 2})
+            self.assertEqual([fake.state for fake in farm.printers[:2]], ["PAUSED", "PAUSED"])
+
+            response = bulk(action="stop", all=True).json()
+            outcomes = {slug: result["outcome"] for slug, result in response["results"].items()}
+            self.assertEqual(outcomes, {"fake-0": "done", "fake-1": "done", "fake-2": "no_job", "fake-3": "unavailable"})
+
+            response = bulk(action="resume", slugs=["fake-0", "nope"]).json()
+            self.assertEqual((response["unknown"], response["results"]["fake-0"]["outcome"]), (["nope"], "rejected"))
+
+
+class PrinterHealthTests(TestCase):
+
+    def test_transitions(self):
+        clock = [100.0]
+        with mock.patch.object(health.time, "monotonic", lambda: clock[0]):
+            breaker = health.PrinterHealth(threshold=2, backoff=5, max_backoff=8)
+            breaker.record_failure("timeout")
+            self.assertEqual((breaker.state, breaker.allow_request()), (health.CLOSED, True))
+            breaker.record_failure("timeout")
+            self.assertEqual((breaker.state, breaker.allow_request()), (health.OPEN, False))
+            self.assertEqual(breaker.snapshot()["retry_in"], 5)
+
+            # one probe once the backoff is over, everyone else still fails fast
+            clock[0] += 5
+            self.assertTrue(breaker.allow_request())
+            self.assertEqual((breaker.state, breaker.allow_request()), (health.HALF_OPEN, False))
+            breaker.record_failure("connection")
+            self.assertEqual((breaker.state, breaker.snapshot()["retry_in"]), (health.OPEN, 8))  # 10, capped
+
+            # a probe that failed on our side doesn't count, the next call probes instead
+            clock[0] += 8
+            self.assertTrue(breaker.allow_request())
+            breaker.release()
+            self.assertTrue(breaker.allow_request())
+            self.assertEqual(breaker.state, health.HALF_OPEN)
+
+            breaker.record_success()
+            self.assertEqual(breaker.snapshot()["state"], health.CLOSED)
+            self.assertEqual((breaker.failures, breaker.allow_request()), (0, True))
+
+    def test_upload_aborted_on_our_side(self):
+        def aborted():
+            yield b"G1 X1\n" * 100
+            raise UnreadablePostError("client went away")
+
+        with FakeFarm(1) as farm:
+            printer, = farm.create_printers()
+            client = get_client(printer)
+            for _ in range(client.health.threshold + 1):
+                with self.assertRaises(requests.ConnectionError):
+                    client.put_stream(UploadStream(aborted(), 10_000), "PRINT_QUEUE/part.bgcode")
+                with self.assertRaises(requests.ConnectionError):
+                    asyncio.run(get_async_client(printer).put_stream(aborted(), "PRINT_QUEUE/part.bgcode",
+                                                                     length=10_000))
+            self.assertEqual(client.health.snapshot()["state"], health.CLOSED)
+            self.assertEqual(client.get_status().status_code, 200)
+
+
+class JobTests(TestCase):
+
+    def setUp(self):
+        add_printers(1, pending_per_printer=0)
+        self.printer = Printers.objects.get()
+
+    def status(self, state, job_id, progress=None):
+        return {"printer": {"state": state}, "job": {"id": job_id, "progress": progress, "time_printing": 60}}
+
+    def test_job_first_seen_after_it_ended(self):
+        # the poller starts while the printer shows an old print: not ours to count
+        for state in ("FINISHED", "STOPPED", "IDLE"):
+            events = observe_job(self.printer, self.status(state, 7))
+            self.assertEqual((events.job, events.started), (None, False))
+        job_ledger.commit()
+        self.printer.refresh_from_db()
+        self.assertFalse(PrintJob.objects.exists())
+        self.assertFalse(self.printer.total_print_count)
+
+        events = observe_job(self.printer, self.status("PAUSED", 8, 40))
+        self.assertTrue(events.started)
+        job_ledger.add(events)
+        job_ledger.commit()
+        self.assertEqual(PrintJob.objects.get().state, PrintJob.PAUSED)
+
+    def test_counted_once(self):
+        PendingJobUsage.objects.create(printer=self.printer, remote_path="PRINT_QUEUE/benchy.bgcode",
+                                       filament_mm=1000.0, filament_g=3.0)
+        file_json = {"file": {"display_name": "benchy.bgcode", "path": "/usb/PRINT_QUEUE"}}
+        sequence = [
+            self.status("PRINTING", 5, 10), self.status("PRINTING", 5, 60),
+            self.status("FINISHED", 5, 100), self.status("FINISHED", 5, 100),
+        ]
+
+        def replay():
+            for status in sequence:
+                job_ledger.add(observe_job(self.printer, status, fetch_job=lambda: file_json))
+                job_ledger.commit()
+            self.printer.refresh_from_db()
+            return (
+                self.printer.total_print_count, self.printer.successful_prints,
+                self.printer.filament_usage_mm, self.printer.filament_usage_g,
+                PrinterDailyStats.objects.get(printer=self.printer).prints_finished,
+            )
+
+        self.assertEqual(replay(), (1, 1, 1000.0, 3.0, 1))
+        # a restarted poller (nothing in memory) sees the same job and end state again
+        jobs._ended_on_screen.clear()
+        self.assertEqual(replay(), (1, 1, 1000.0, 3.0, 1))
+        self.assertEqual(count_ended_jobs(), 0)
+        self.assertTrue(PrintJob.objects.get().counted)
+
+
+class StatsTests(TestCase):
+
+    def setUp(self):
+        add_printers(3, pending_per_printer=0)
+        self.printers = list(Printers.objects.order_by("name"))
+
+    def test_job_stats(self):
+        printer, idle = self.printers[:2]
+        start = timezone.now() - datetime.timedelta(days=2)
+        for job_id, state, duration, filament_g, hours in [
+            ("1", PrintJob.FINISHED, 100, 2.0, 0), ("2", PrintJob.STOPPED, 50, 0.5, 1),
+            ("3", PrintJob.ERROR, 10, None, 2), ("4", PrintJob.PRINTING, None, None, 30),
+        ]:
+            PrintJob.objects.create(printer=printer, job_id=job_id, state=state, duration=duration,
+                                    filament_g=filament_g, started_at=start + datetime.timedelta(hours=hours))
+
+        stats = jobs.job_stats(printer)
+        self.assertEqual(
+            (stats["total_prints"], stats["finished"], stats["failed"], stats["ended"],
+             stats["printing_seconds"], stats["filament_g"], stats["success_rate"]),
+            (4, 1, 2, 3, 160, 2.5, 0.33),
+        )
+        stats = jobs.job_stats(printer, since=start + datetime.timedelta(hours=2))
+        self.assertEqual((stats["total_prints"], stats["ended"], stats["success_rate"]), (2, 1, 0.0))
+        # nothing ended yet (or nothing at all): no rate rather than 0%
+        stats = jobs.job_stats(printer, since=start + datetime.timedelta(hours=3))
+        self.assertEqual((stats["total_prints"], stats["ended"], stats["success_rate"]), (1, 0, None))
+        stats = jobs.job_stats(idle)
+        self.assertEqual((stats["total_prints"], stats["printing_seconds"], stats["success_rate"]), (0, None, None))
+
+    def test_farm_stats(self):
+        core_one, mk4, busy = self.printers
+        day = datetime.date(2025, 3, 1)
+        next_day = day + datetime.timedelta(days=1)
+        add_daily_stats(core_one.pk, day, prints_started=2, prints_finished=1, prints_failed=1,
+                        printing_seconds=36000, filament_g=10.0)
+        add_daily_stats(core_one.pk, next_day, prints_finished=1, printing_seconds=7200, filament_g=2.5)
+        add_daily_stats(core_one.pk, next_day, prints_unknown=1)
+        add_daily_stats(busy.pk, day, prints_started=1)
+        # outside the window
+        add_daily_stats(core_one.pk, day - datetime.timedelta(days=1), prints_finished=5, printing_seconds=3600)
+        add_daily_stats(mk4.pk, next_day + datetime.timedelta(days=1), prints_finished=5)
+        self.assertEqual(PrinterDailyStats.objects.filter(printer=core_one).count(), 3)
+
+        with self.assertNumQueries(2):
+            stats = farm_stats(day, next_day)
+
+        pick = lambda row: (row["prints_started"], row["prints_finished"], row["prints_failed"],
+                            row["prints_unknown"], row["printing_hours"], row["utilization"],
+                            row["success_rate"], row["filament_g"])
+        self.assertEqual([(row["slug"], pick(row)) for row in stats["printers"]], [
+            ("printer-0", (2, 2, 1, 1, 12.0, 0.25, 0.5, 12.5)),
+            ("printer-1", (0, 0, 0, 0, 0.0, 0.0, None, 0)),
+            ("printer-2", (1, 0, 0, 0, 0.0, 0.0, None, 0)),
+        ])
+        self.assertEqual({row["model"]: (row["printers"], pick(row)) for row in stats["models"]}, {
+            "core_one": (2, (3, 2, 1, 1, 12.0, 0.125, 0.5, 12.5)),
+            "mk4": (1, (0, 0, 0, 0, 0.0, 0.0, None, 0)),
+        })
+        self.assertEqual((stats["farm"]["printers"], pick(stats["farm"])), (3, (3, 2, 1, 1, 12.0, 0.0833, 0.5, 12.5)))
+
+
+class TelemetryTests(TestCase):
+
+    def setUp(self):
+        add_printers(1, pending_per_printer=0)
+        self.printer = Printers.objects.get()
+        self.now = datetime.datetime(2025, 6, 1, 12, 0, 30, tzinfo=datetime.timezone.utc)
+
+    def sample(self, resolution, ago, nozzle, state="printing", samples=1, **fields):
+        return TelemetrySample.objects.create(
+            printer=self.printer, resolution=resolution, timestamp=self.now - ago, temp_nozzle=nozzle,
+            temp_nozzle_max=nozzle, state=state, printing_fraction=1.0 if state == "printing" else 0.0,
+            samples=samples, **fields,
+        )
+
+    def rows(self, resolution):
+        return list(TelemetrySample.objects.filter(resolution=resolution).order_by("timestamp").values_list(
+            "timestamp", "temp_nozzle", "temp_nozzle_max", "progress", "state", "printing_fraction", "samples",
+        ))
+
+    def test_rollups_and_retention(self):
+        raw, minute, hour = TelemetrySample.RAW, TelemetrySample.MINUTE, TelemetrySample.HOUR
+        td = datetime.timedelta
+        # raw: 05:58:50 and 05:58:59 share a minute, 05:59:00 starts the next,
+        # 06:00:10 is in the minute the 6 hour cutoff (06:00:30) falls in and stays raw
+        self.sample(raw, td(hours=6, seconds=100), 200.0, progress=10)
+        self.sample(raw, td(hours=6, seconds=91), 210.0, progress=11)
+        self.sample(raw, td(hours=6, seconds=90), 60.0, state="idle")
+        self.sample(raw, td(hours=6, seconds=20), 61.0, state="idle")
+        # 1m rows past their 7 days: 10:00 and 10:59 make one hour (weighted by samples), 11:00 another
+        self.sample(minute, td(days=8, hours=2, seconds=30), 100.0, samples=2)
+        self.sample(minute, td(days=8, hours=1, minutes=1, seconds=30), 130.0, state="idle")
+        self.sample(minute, td(days=8, hours=1, seconds=30), 90.0)
+        # 1h rows just past and just inside the year
+        self.sample(hour, td(days=365, seconds=1), 50.0)
+        self.sample(hour, td(days=364), 55.0)
+
+        self.assertEqual(rollup_telemetry(self.now), {minute: 2, hour: 2, "expired": 1})
+        at = lambda *hms: datetime.datetime(2025, 6, 1, *hms, tzinfo=datetime.timezone.utc)
+        self.assertEqual(self.rows(raw), [(at(6, 0, 10), 61.0, 61.0, None, "idle", 0.0, 1)])
+        self.assertEqual(self.rows(minute), [
+            (at(5, 58), 205.0, 210.0, 11.0, "printing", 1.0, 2),
+            (at(5, 59), 60.0, 60.0, None, "idle", 0.0, 1),
+        ])
+        day = datetime.datetime(2025, 5, 24, tzinfo=datetime.timezone.utc)
+        self.assertEqual(self.rows(hour), [
+            (self.now - td(days=364), 55.0, 55.0, None, "printing", 1.0, 1),
+            (day.replace(hour=10), 110.0, 130.0, None, "idle", 2 / 3, 3),
+            (day.replace(hour=11), 90.0, 90.0, None, "printing", 1.0, 1),
+        ])
+
+        # nothing left to do the second time, and nothing changes
+        before = {level: self.rows(level) for level in (raw, minute, hour)}
+        self.assertEqual(rollup_telemetry(self.now), {minute: 0, hour: 0, "expired": 0})
+        self.assertEqual({level: self.rows(level) for level in (raw, minute, hour)}, before)
+
+
+def printing(seconds_left):
+    return {"printer": {"state": "PRINTING"}, "job": {"id": 1, "progress": 50, "time_remaining": seconds_left}}
+
+
+IDLE = {"printer": {"state": "IDLE"}}
+
+
+@mock.patch.object(status_cache, "PRINTER_STATUS_AUTOSTART", False)
+class StatusSnapshotTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        add_printers(3, pending_per_printer=0)
+        self.printers = list(Printers.objects.order_by("slug"))
+        self.url = "/api/printers/snapshot/"
+
+    def store(self, progress):
+        store_statuses(self.printers, {printer.pk: printing(600) for printer in self.printers}
+                       | {self.printers[1].pk: {**printing(600), "job": {"progress": progress}}})
+
+    def test_etag_and_since(self):
+        self.store(progress=10)
+        response = self.client.get(self.url)
+        first = response.json()
+        self.assertEqual((response.status_code, first["full"]), (200, True))
+        self.assertEqual(sorted(first["printers"]), ["printer-0", "printer-1", "printer-2"])
+        self.assertEqual(first["printers"]["printer-1"]["progress"], 10)
+
+        # nothing changed: 304 without a body, whether or not the sweep ran again
+        self.store(progress=10)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual((response.status_code, response.content), (304, b""))
+        response = self.client.get(self.url, {"since": first["version"]})
+        self.assertEqual(response.json(), {"version": first["version"], "full": False, "printers": {}})
+        etag = response["ETag"]
+
+        self.store(progress=20)
+        response = self.client.get(self.url, {"since": first["version"]}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        changed = response.json()
+        self.assertEqual((changed["version"], changed["full"]), (first["version"] + 1, False))
+        self.assertEqual(list(changed["printers"]), ["printer-1"])
+        self.assertEqual(changed["printers"]["printer-1"]["progress"], 20)
+        self.assertFalse(self.client.get(self.url, {"since": changed["version"]}).json()["printers"])
+
+        # a version from before the cache was cleared gets everything again
+        self.assertTrue(self.client.get(self.url, {"since": changed["version"] + 5}).json()["full"])
+        self.assertEqual(self.client.get(self.url, {"since": "x"}).status_code, 400)
+
+        # stale printers keep being reported until the collector reaches them again
+        later = time.time() + status_cache.PRINTER_STATUS_STALE_AFTER + 1
+        with mock.patch.object(status_cache.time, "time", return_value=later):
+            snapshot = status_cache.get_snapshot(self.printers, since=changed["version"])
+        self.assertEqual(len(snapshot["printers"]), 3)
+        self.assertTrue(all(fields["stale"] for fields in snapshot["printers"].values()))
+
+    def test_printer_api_is_live_fields_only(self):
+        self.store(progress=10)
+        response = self.client.post("/api/printers/individual-printer/", {"slug": "printer-1"},
+                                    content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual((payload["slug"], payload["curr_status"], payload["progress"]), ("printer-1", "printing", 10))
+        payload = self.client.post("/api/printers/individual-printer/", {"slug": "printer-0"},
+                                   content_type="application/json").json()
+        self.assertEqual((payload["time_remaining"], payload["time_units"]), (10, " minutes"))
+        # the static fields are printers_meta_api's, host and api key nobody's
+        self.assertFalse({"api_key", "host", "staff_notes", "date_added", "name", "last_maintenance"} & set(payload))
+        meta = self.client.get("/api/printers/meta/").json()["printer-1"]
+        self.assertEqual((meta["name"], meta["staff_notes"][:6]), ("Printer 1", "notes "))
+        self.assertFalse({"api_key", "host"} & set(meta))
+
+    @mock.patch.object(status_cache, "PRINTER_STREAM_TICK", 0)
+    def test_stream(self):
+        self.store(progress=10)
+        request = AsyncRequestFactory().get("/api/printers/stream/", {"slug": ["printer-0", "printer-1"]})
+
+        async def read():
+            response = await views.printers_stream_api(request)
+            chunks = aiter(response.streaming_content)
+            first = await anext(chunks)
+            await sync_to_async(self.store)(progress=20)
+            second = await anext(chunks)
+            await chunks.aclose()
+            return response, first.decode(), second.decode()
+
+        response, first, second = async_to_sync(read)()
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertTrue(first.startswith("retry: 3000\nevent: snapshot\ndata: "))
+        snapshot = json.loads(first.split("data: ", 1)[1])
+        self.assertEqual(sorted(snapshot), ["printer-0", "printer-1"])
+        self.assertEqual(snapshot["printer-1"]["progress"], 10)
+        # only what changed, of the printer it changed on
+        self.assertTrue(second.startswith("event: update\ndata: "))
+        update = json.loads(second.split("data: ", 1)[1])
+        self.assertEqual(list(update), ["printer-1"])
+        self.assertIn("progress", update["printer-1"])
+        self.assertEqual(update["printer-1"]["progress"], 20)
+        self.assertNotIn("nozzle_temp", update["printer-1"])
+
+
+@mock.patch.object(status_cache, "PRINTER_STATUS_AUTOSTART", False)
+class DispatchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        add_printers(4, pending_per_printer=0)
+        # printer-0/2 are core_one, printer-1/3 mk4
+        self.printers = {printer.slug: printer for printer in Printers.objects.all()}
+        self.dispatcher = Dispatcher(lookahead=600)
+
+    def set_statuses(self, statuses):
+        printers = [self.printers[slug] for slug in statuses]
+        store_statuses(printers, {self.printers[slug].pk: status for slug, status in statuses.items()})
+
+    def queue(self, name, priority=0, estimated_time=3600, **target):
+        return DispatchJob.objects.create(
+            filename=name, remote_path=f"PRINT_QUEUE/{name}", spool_path=f"/nonexistent/{name}",
+            priority=priority, estimated_time=estimated_time, **target,
+        )
+
+    def test_soonest_free_printer_and_priority(self):
+        self.set_statuses({"printer-0": IDLE, "printer-1": printing(3000), "printer-2": None, "printer-3": printing(100)})
+        low = self.queue("low.bgcode", target_model="mk4")
+        high = self.queue("high.bgcode", priority=5, target_model="mk4")
+        core = self.queue("core.bgcode", target_model="core_one")
+
+        self.dispatcher.tick()
+
+        # printer-3 is done in 100s and takes the important one, then nothing mk4 is free soon
+        high.refresh_from_db()
+        low.refresh_from_db()
+        core.refresh_from_db()
+        self.assertEqual((high.status, high.printer.slug), (DispatchJob.ASSIGNED, "printer-3"))
+        self.assertEqual(low.status, DispatchJob.WAITING)
+        self.assertEqual(self.dispatcher.position(low), 0)
+        # printer-2 is offline
+        self.assertEqual(core.printer.slug, "printer-0")
+        self.assertEqual(UploadJob.objects.get(pk=high.upload_job_id).printer.slug, "printer-3")
+
+        # once it's being printed printer-3 is only busy for that print
+        job = PrintJob.objects.create(printer=self.printers["printer-3"], job_id="7", started_at=timezone.now())
+        mark_started(self.printers["printer-3"], ["PRINT_QUEUE/high.bgcode"], job)
+        self.set_statuses({"printer-1": printing(200), "printer-3": printing(3500)})
+        self.dispatcher.tick()
+        low.refresh_from_db()
+        self.assertEqual(low.printer.slug, "printer-1")
+
+    def test_pool(self):
+        pool = PrinterPool.objects.create(name="PETG", slug="petg")
+        pool.printers.add(self.printers["printer-0"], self.printers["printer-3"])
+        self.set_statuses({"printer-0": printing(5000), "printer-1": IDLE, "printer-3": printing(10)})
+        job = self.queue("petg.bgcode", pool=pool)
+
+        self.dispatcher.tick()
+        job.refresh_from_db()
+        self.assertEqual(job.printer.slug, "printer-3")
+
+    def test_failed_assign_stays_queued(self):
+        self.set_statuses({"printer-1": IDLE})
+        job = self.queue("retry.bgcode", target_model="mk4")
+
+        with mock.patch.object(dispatch, "assign", side_effect=OperationalError("database is locked")), \
+                self.assertLogs(dispatch.logger, "ERROR"):
+            self.assertEqual(self.dispatcher.tick(), [])
+        # no reload in between: the job has to still be in the heap
+        self.assertEqual(self.dispatcher.tick(), [(job.pk, self.printers["printer-1"].pk)])
+
+    def test_many_waiting_jobs(self):
+        self.set_statuses({slug: printing(7200) for slug in self.printers})
+        DispatchJob.objects.bulk_create(
+            DispatchJob(filename=f"{n}.bgcode", remote_path=f"PRINT_QUEUE/{n}.bgcode", spool_path="/nonexistent",
+                        target_model="mk4" if n % 2 else "core_one", priority=n % 3)
+            for n in range(300)
+        )
+        self.dispatcher.tick()
+
+        # nothing frees up soon: the second tick only looks for new jobs
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.dispatcher.tick(), [])
+        self.assertLessEqual(len(queries), 5)
+
+        self.set_statuses({"printer-1": IDLE})
+        assigned = self.dispatcher.tick()
+        self.assertEqual(len(assigned), 1)
+        first = DispatchJob.objects.get(pk=assigned[0][0])
+        self.assertEqual((first.priority, first.filename), (2, "5.bgcode"))
+
+    def test_upload_api(self):
+        body = b"G1 X1\n; filament used [g] = 12.5\n; estimated printing time (normal mode) = 1h 2m 3s\n"
+        with tempfile.TemporaryDirectory() as spool, \
+                mock.patch.object(upload_queue, "UPLOAD_SPOOL_DIR", upload_queue.Path(spool)), \
+                mock.patch.object(thumbnails, "THUMBNAIL_DIR", thumbnails.Path(spool) / "thumbnails"), \
+                mock.patch.object(views, "UPLOAD_WORKER_AUTOSTART", False):
+            response = self.client.post(
+                "/api/upload-jobs/?model=mk4&priority=9", body,
+                content_type="application/octet-stream", HTTP_X_FILENAME="part.gcode",
+            )
+            self.assertEqual(response.status_code, 202)
+            job = DispatchJob.objects.get(pk=response.json()["dispatch_id"])
+            self.assertEqual((job.target_model, job.priority, job.estimated_time), ("mk4", 0, 3723))
+
+            status = self.client.get(response.json()["status_url"]).json()
+            self.assertEqual((status["status"], status["position"]), (DispatchJob.WAITING, 0))
+
+            bad = self.client.post("/api/upload-jobs/?model=prusa_xl", body,
+                                   content_type="application/octet-stream", HTTP_X_FILENAME="part.gcode")
+            self.assertEqual(bad.status_code, 400)
+
+
+class UploadTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        add_printers(1, pending_per_printer=0)
+        self.body = b"G1 X1 Y1\n" * 70000  # a few chunks worth
+        self.received = []
+
+        def put_stream(body, remote_path, **kwargs):
+            self.chunks = []
+            for chunk in body:
+                if not self.chunks:
+                    # progress can be asked for while it's on its way
+                    self.received.append((remote_path, (uploads.get_upload_progress("up-1") or {}).get("state")))
+                self.chunks.append(chunk)
+            return mock.Mock(ok=True)
+
+        client = mock.Mock()
+        client.put_stream.side_effect = put_stream
+        patcher = mock.patch.object(views, "get_client", return_value=client)
+        self.client_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, upload_id="up-1", **headers):
+        return self.client.post(
+            "/api/upload-bgcode/?slug=printer-0", self.body, content_type="application/octet-stream",
+            HTTP_X_FILENAME="part%20one.gcode", HTTP_X_UPLOAD_ID=upload_id, **headers,
+        )
+
+    def test_streamed_upload(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(
+            (result["filename"], result["remote_path"], result["bytes"], result["sha256"]),
+            ("part one.gcode", "PRINT_QUEUE/part one.gcode", len(self.body), hashlib.sha256(self.body).hexdigest()),
+        )
+        # passed on chunk by chunk, not as one read of the whole body
+        self.assertEqual(b"".join(self.chunks), self.body)
+        self.assertEqual(max(map(len, self.chunks)), uploads.UPLOAD_CHUNK_SIZE)
+        self.assertEqual(self.received, [("PRINT_QUEUE/part one.gcode", "uploading")])
+        self.assertTrue(PrinterFile.objects.filter(remote_path="PRINT_QUEUE/part one.gcode").exists())
+
+        progress = self.client.get("/api/upload-bgcode/up-1/progress/").json()
+        self.assertEqual(
+            (progress["state"], progress["bytes_sent"], progress["bytes_total"]), ("done", len(self.body), len(self.body)),
+        )
+        self.assertEqual(self.client.get("/api/upload-bgcode/up-2/progress/").status_code, 404)
+
+    def test_hash_mismatch(self):
+        response = self.upload(HTTP_X_CONTENT_SHA256="0" * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["sha256"], hashlib.sha256(self.body).hexdigest())
+        progress = self.client.get("/api/upload-bgcode/up-1/progress/").json()
+        self.assertEqual((progress["state"], progress["error"]), ("failed", "Content hash mismatch"))
+        self.assertFalse(PrinterFile.objects.exists())
+
+    def test_upload_id_checked(self):
+        for upload_id in ("../../etc", "a b", "x" * 65):
+            self.assertEqual(self.upload(upload_id=upload_id).status_code, 400)
+        self.assertFalse(self.client_mock.called)
+        # without one there's just no progress to ask for
+        self.assertEqual(self.upload(upload_id="").status_code, 200)
+        self.assertIsNone(uploads.get_upload_progress(""))
+
+
+class UploadQueueTests(TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.spool = upload_queue.Path(tmp.name)
+
+    def queue(self, printer, name="part.gcode"):
+        spool_path = self.spool / name
+        spool_path.write_bytes(b"G1 X1\n" * 100)
+        return upload_queue.create_upload_job(printer, name, spool_path, 600, None)
+
+    def test_one_transfer_per_printer(self):
+        add_printers(2, pending_per_printer=0)
+        first, second = Printers.objects.order_by("pk")
+        jobs = [self.queue(first, "a.gcode"), self.queue(first, "b.gcode"), self.queue(second, "c.gcode")]
+
+        claimed = [upload_queue.claim_next_job() for _ in range(3)]
+        self.assertEqual([job.pk if job else None for job in claimed], [jobs[0].pk, jobs[2].pk, None])
+        self.assertEqual(claimed[0].attempts, 1)
+
+        UploadJob.objects.filter(pk=jobs[0].pk).update(status=UploadJob.DONE)
+        self.assertEqual(upload_queue.claim_next_job().pk, jobs[1].pk)
+
+    def test_claim_rechecks_the_printer(self):
+        add_printers(1, pending_per_printer=0)
+        printer = Printers.objects.get()
+        jobs = [self.queue(printer, "a.gcode"), self.queue(printer, "b.gcode")]
+        atomic = transaction.atomic
+
+        def other_worker_first(*args, **kwargs):
+            # another worker claims a.gcode after we picked our candidates
+            UploadJob.objects.filter(pk=jobs[0].pk).update(status=UploadJob.UPLOADING)
+            return atomic(*args, **kwargs)
+
+        with mock.patch.object(upload_queue.transaction, "atomic", side_effect=other_worker_first):
+            self.assertIsNone(upload_queue.claim_next_job())
+        self.assertEqual(UploadJob.objects.get(pk=jobs[1].pk).status, UploadJob.QUEUED)
+
+    def test_retries_with_backoff(self):
+        with FakeFarm(2) as farm:
+            up, down = farm.create_printers()
+            farm.by_host(down.host).stop()
+            job = self.queue(down)
+
+            # each failed transfer comes back later, twice as late as the one before
+            for attempt, backoff in ((1, 15), (2, 30)):
+                UploadJob.objects.filter(pk=job.pk).update(next_attempt_at=timezone.now())
+                self.assertFalse(upload_queue.run_job(upload_queue.claim_next_job()))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts), (UploadJob.QUEUED, attempt))
+                self.assertAlmostEqual((job.next_attempt_at - timezone.now()).total_seconds(), backoff, delta=2)
+
+            # the printer's circuit is open by now: waiting on it costs no attempt
+            get_client(down).health.record_failure("connection")
+            UploadJob.objects.filter(pk=job.pk).update(next_attempt_at=timezone.now())
+            self.assertFalse(upload_queue.run_job(upload_queue.claim_next_job()))
+            job.refresh_from_db()
+            retry_in = get_client(down).health.snapshot()["retry_in"]
+            self.assertEqual((job.status, job.attempts), (UploadJob.QUEUED, 2))
+            self.assertAlmostEqual((job.next_attempt_at - timezone.now()).total_seconds(), retry_in, delta=2)
+
+            # out of attempts once the printer really fails a third time
+            get_client(down).health.record_success()
+            UploadJob.objects.filter(pk=job.pk).update(next_attempt_at=timezone.now())
+            self.assertFalse(upload_queue.run_job(upload_queue.claim_next_job()))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (UploadJob.FAILED, 3))
+            self.assertFalse(upload_queue.Path(job.spool_path).exists())
+
+            ok = self.queue(up)
+            self.assertTrue(upload_queue.run_job(upload_queue.claim_next_job()))
+            ok.refresh_from_db()
+            self.assertEqual(ok.status, UploadJob.DONE)
+            self.assertEqual(farm.by_host(up.host).files["PRINT_QUEUE/part.gcode"]["size"], 600)
+
+
+class BroadcastTests(TestCase):
+
+    def setUp(self):
+        add_printers(4, pending_per_printer=0)
+        self.printers = list(Printers.objects.order_by("slug"))
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for patch in (
+            mock.patch.object(upload_queue, "UPLOAD_SPOOL_DIR", upload_queue.Path(tmp.name) / "spool"),
+            mock.patch.object(broadcast, "UPLOAD_SPOOL_DIR", upload_queue.Path(tmp.name) / "spool"),
+            mock.patch.object(thumbnails, "THUMBNAIL_DIR", thumbnails.Path(tmp.name) / "thumbnails"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_checks_and_sends_in_one_pool(self):
+        body = b"G1 X1\n; filament used [g] = 4.2\n"
+        known = content.remember_content(hashlib.sha256(body).hexdigest(), len(body), "part.gcode",
+                                         {"format": "gcode", "filament": {"g": 4.2}})
+        # printer-0 still has it, printer-1 lost it, printer-2 lost it and fails the resend
+        for printer in self.printers[:3]:
+            PrinterFile.objects.create(printer=printer, remote_path="PRINT_QUEUE/part.gcode", content=known)
+
+        calls, threads = [], set()
+        barrier = threading.Barrier(4, timeout=5)
+
+        def client_for(printer):
+            client = mock.Mock()
+
+            def exists_gcode(remote_path):
+                threads.add(threading.current_thread())
+                calls.append(("HEAD", printer.slug))
+                # every printer is being talked to at once, the HEADs included
+                barrier.wait()
+                return printer.slug == "printer-0"
+
+            def put_stream(f, remote_path, **kwargs):
+                threads.add(threading.current_thread())
+                calls.append(("PUT", printer.slug))
+                if printer.slug == "printer-3":
+                    barrier.wait()
+                return mock.Mock(ok=printer.slug != "printer-2", status_code=500, text="USB full")
+
+            client.exists_gcode.side_effect = exists_gcode
+            client.put_stream.side_effect = put_stream
+            return client
+
+        with mock.patch.object(broadcast, "get_client", side_effect=client_for):
+            response = self.client.post(
+                "/api/upload-bgcode/broadcast/?" + "&".join(f"slug={p.slug}" for p in self.printers), body,
+                content_type="application/octet-stream", HTTP_X_FILENAME="part.gcode",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(result["slug"], result["ok"], result["deduplicated"]) for result in response.json()["results"]],
+            [("printer-0", True, True), ("printer-1", True, False), ("printer-2", False, False),
+             ("printer-3", True, False)],
+        )
+        self.assertEqual(sorted(calls), [
+            ("HEAD", "printer-0"), ("HEAD", "printer-1"), ("HEAD", "printer-2"),
+            ("PUT", "printer-1"), ("PUT", "printer-2"), ("PUT", "printer-3"),
+        ])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(
+            sorted(PrinterFile.objects.values_list("printer__slug", flat=True)), ["printer-0", "printer-1", "printer-3"],
+        )
+        self.assertEqual(
+            sorted(PendingJobUsage.objects.values_list("printer__slug", "filament_g")),
+            [("printer-0", 4.2), ("printer-1", 4.2), ("printer-3", 4.2)],
+        )
+
+
+def bgcode_block(block_type, payload, params=b"\x00\x00", compression=0, crc=False):
+    if compression == 1:
+        data = zlib.compress(payload)
+        block = struct.pack("<HHII", block_type, compression, len(payload), len(data)) + params + data
+    elif compression:
+        # pretend heatshrink, the reader only needs the sizes
+        block = struct.pack("<HHII", block_type, compression, len(payload) * 2, len(payload)) + params + payload
+    else:
+        block = struct.pack("<HHI", block_type, 0, len(payload)) + params + payload
+    return block + struct.pack("<I", zlib.crc32(block)) if crc else block
+
+
+class NonSeekable:
+
+    def __init__(self, data):
+        self._file = BytesIO(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+
+class CountingBytesIO(BytesIO):
+
+    bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class BgcodeTests(TestCase):
+
+    def bgcode(self, *blocks, crc=True):
+        return b"GCDE" + struct.pack("<IH", 1, 1 if crc else 0) + b"".join(blocks)
+
+    def sample(self, crc=True):
+        return self.bgcode(
+            bgcode_block(bgcode.FILE_METADATA, b"Producer=PrusaSlicer 2.8.0", crc=crc),
+            bgcode_block(bgcode.PRINTER_METADATA, (
+                b"printer_model=MK4\nfilament used [mm]=1000.5, 20\nfilament used [g]=2.0\n"
+                b"estimated printing time (normal mode)=1h 2m 3s\n"
+            ), compression=1, crc=crc),
+            bgcode_block(bgcode.THUMBNAIL, b"\x89PNG fake", struct.pack("<HHH", 0, 16, 16), crc=crc),
+            # heatshrink and an unknown image format are skipped, not misread
+            bgcode_block(bgcode.SLICER_METADATA, b"layer_height=0.2", compression=3, crc=crc),
+            bgcode_block(bgcode.THUMBNAIL, b"????", struct.pack("<HHH", 7, 4, 4), crc=crc),
+            bgcode_block(bgcode.PRINT_METADATA, b"filament used [g]=3.5\nprinter_model=MK4S", crc=crc),
+            bgcode_block(bgcode.GCODE, b"G1 X1\n" * 1000, crc=crc),
+            bgcode_block(bgcode.PRINT_METADATA, b"filament used [g]=99", crc=crc),
+            crc=crc,
+        )
+
+    def test_blocks(self):
+        expected = {
+            "format": "bgcode",
+            "filament": {"mm": 1020.5, "g": 3.5},
+            "estimated_time": 3723,
+            "metadata": {
+                "Producer": "PrusaSlicer 2.8.0", "printer_model": "MK4S", "filament used [mm]": "1000.5, 20",
+                "filament used [g]": "3.5", "estimated printing time (normal mode)": "1h 2m 3s",
+            },
+        }
+        for crc in (True, False):
+            body = self.sample(crc)
+            with self.subTest(crc=crc):
+                self.assertEqual(bgcode.read_print_metadata(BytesIO(body)), expected)
+                self.assertEqual(bgcode.read_print_metadata(NonSeekable(body)), expected)
+
+                # byte by byte, the way an upload may trickle in
+                reader = bgcode.MetadataReader()
+                for i in range(len(body)):
+                    reader.feed(body[i:i + 1])
+                    if reader.done:
+                        break
+                reader.close()
+                self.assertEqual(reader.result(), expected)
+                self.assertEqual([(t["format"], t["width"], t["data"]) for t in reader.thumbnails],
+                                 [("png", 16, b"\x89PNG fake")])
+
+    def test_skips_what_it_does_not_need(self):
+        big_thumbnail = bgcode_block(bgcode.THUMBNAIL, b"\x00" * (bgcode.MAX_THUMBNAIL_BLOCK + 1),
+                                     struct.pack("<HHH", 0, 1000, 1000), crc=True)
+        body = self.bgcode(big_thumbnail, bgcode_block(bgcode.PRINT_METADATA, b"filament used [g]=3.5", crc=True),
+                           bgcode_block(bgcode.GCODE, b"G1 X1\n" * 100_000, crc=True))
+        file_obj = CountingBytesIO(body)
+        self.assertEqual(bgcode.read_print_metadata(file_obj)["filament"], {"g": 3.5})
+        self.assertEqual(file_obj.tell(), 0)
+        self.assertLess(file_obj.bytes_read, 3 * bgcode.READ_SIZE)
+        # without seeking it all streams through, nothing of it is kept
+        self.assertEqual(bgcode.read_print_metadata(NonSeekable(body))["filament"], {"g": 3.5})
+
+    def test_broken_files(self):
+        body = self.sample()
+        print_block = body.index(struct.pack("<HHI", bgcode.PRINT_METADATA, 0, 40))
+        # cut off inside the print metadata: what came before it is still there
+        for file_obj in (BytesIO(body[:print_block + 20]), NonSeekable(body[:print_block + 20])):
+            result = bgcode.read_print_metadata(file_obj)
+            self.assertEqual((result["format"], result["filament"]), ("bgcode", {"mm": 1020.5, "g": 2.0}))
+        # cut off inside a block header
+        self.assertEqual(bgcode.read_print_metadata(BytesIO(body[:16]))["metadata"], {})
+
+        # deflate data that doesn't inflate loses that block only
+        broken = bytearray(bgcode_block(bgcode.PRINTER_METADATA, b"printer_model=MK4", compression=1))
+        broken[14:18] = b"\xff\xff\xff\xff"
+        result = bgcode.read_print_metadata(BytesIO(self.bgcode(
+            bytes(broken), bgcode_block(bgcode.PRINT_METADATA, b"filament used [g]=3.5"), crc=False,
+        )))
+        self.assertEqual(result["metadata"], {"filament used [g]": "3.5"})
+
+        # a header claiming a huge metadata block is skipped rather than buffered
+        huge = struct.pack("<HHI", bgcode.PRINT_METADATA, 0, bgcode.MAX_METADATA_BLOCK + 1) + b"\x00\x00"
+        self.assertEqual(bgcode.read_print_metadata(NonSeekable(self.bgcode(huge + b"x" * 100, crc=False)))["metadata"], {})
+
+
+def qoi_image(width, height, pixel):
+    # the first pixel spelled out, the rest one run (at most 62 per op)
+    body = b"\xff" + bytes(pixel)
+    left = width * height - 1
+    while left:
+        run = min(left, 62)
+        body += bytes([0xC0 | (run - 1)])
+        left -= run
+    return b"qoif" + struct.pack(">IIBB", width, height, 4, 0) + body + b"\x00" * 7 + b"\x01"
+
+
+def png_pixels(png):
+    # RGBA bytes of a png_encode()d image, which only uses filter 0
+    width, height = struct.unpack(">II", png[16:24])
+    raw = zlib.decompress(png[41:-16])  # IDAT right after IHDR, then its crc and IEND
+    stride = width * 4 + 1
+    return b"".join(raw[y * stride + 1:(y + 1) * stride] for y in range(height))
+
+
+class ThumbnailTests(TestCase):
+
+    def setUp(self):
+        add_printers(1, pending_per_printer=0)
+        self.printer = Printers.objects.get()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for patch in (
+            mock.patch.object(upload_queue, "UPLOAD_SPOOL_DIR", upload_queue.Path(tmp.name) / "spool"),
+            mock.patch.object(thumbnails, "THUMBNAIL_DIR", thumbnails.Path(tmp.name) / "thumbnails"),
+            mock.patch.object(thumbnails, "_cache_bytes", None),
+            mock.patch.object(views, "UPLOAD_WORKER_AUTOSTART", False),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def upload(self, name, body):
+        response = self.client.post(f"/api/upload-jobs/?slug={self.printer.slug}", body,
+                                    content_type="application/octet-stream", HTTP_X_FILENAME=name)
+        self.assertEqual(response.status_code, 202)
+        return UploadJob.objects.get(pk=response.json()["job_id"]).content
+
+    def test_qoi_to_png(self):
+        png = thumbnails.qoi_to_png(qoi_image(10, 10, (255, 0, 0, 255)))
+        self.assertEqual(png[:8], thumbnails.PNG_SIGNATURE)
+        self.assertEqual(png_pixels(png), bytes((255, 0, 0, 255)) * 100)
+
+    def test_bgcode_upload_and_serving(self):
+        body = (
+            b"GCDE" + struct.pack("<IH", 1, 0)
+            + bgcode_block(0, b"Producer=PrusaSlicer")
+            + bgcode_block(5, qoi_image(16, 16, (0, 128, 0, 255)), struct.pack("<HHH", 2, 16, 16))
+            + bgcode_block(5, qoi_image(300, 200, (0, 0, 255, 255)), struct.pack("<HHH", 2, 300, 200))
+            + bgcode_block(4, b"filament used [g]=3.5")
+            + bgcode_block(1, b"G1 X1\n")
+        )
+        content = self.upload("cube.bgcode", body)
+        self.assertEqual(content.filament_g, 3.5)
+        self.assertEqual([variant[:2] for variant in thumbnails.list_variants(content.sha256)], [(16, 16), (300, 200)])
+
+        url = f"/api/thumbnails/{content.sha256}/"
+        response = self.client.get(url + "?w=100")
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(png_pixels(b"".join(response.streaming_content)), bytes((0, 0, 255, 255)) * 300 * 200)
+        self.assertEqual(self.client.get(url + "?w=16")["ETag"], f'"{content.sha256[:16]}-16x16"')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+        self.assertEqual(self.client.get(f"/api/thumbnails/{'0' * 64}/").status_code, 404)
+
+        # a printer shows the last file we sent it until it prints something else
+        PrinterFile.objects.create(printer=self.printer, remote_path="PRINT_QUEUE/cube.bgcode", content=content)
+        previews = self.client.get("/api/printers/previews/?w=100").json()
+        self.assertEqual(previews, {self.printer.slug: {"url": url + "?w=100", "source": "queued"}})
+        PrintJob.objects.create(printer=self.printer, job_id="1", remote_path="PRINT_QUEUE/other.bgcode",
+                                started_at=timezone.now())
+        self.assertEqual(self.client.get("/api/printers/previews/").json(), {self.printer.slug: None})
+
+        self.assertEqual(thumbnails.trim_cache(max_bytes=0), 1)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_gcode_thumbnail_comments(self):
+        png = thumbnails.png_encode(1, 1, b"\x01\x02\x03\xff")
+        encoded = base64.b64encode(png).decode()
+        comment = "".join(f"; {encoded[i:i + 78]}\n" for i in range(0, len(encoded), 78))
+        body = (
+            f"; thumbnail begin 1x1 {len(encoded)}\n{comment}; thumbnail end\n"
+            "G1 X1\n; filament used [g] = 1.0\n"
+        ).encode()
+        content = self.upload("part.gcode", body)
+        (width, height, path), = thumbnails.list_variants(content.sha256)
+        self.assertEqual(path.read_bytes(), png)
+
+    def test_big_gcode_thumbnail_seekable(self):
+        # a thumbnail running well past the first GCODE_SCAN_BYTES, read from a file we can seek in
+        png = thumbnails.png_encode(160, 160, os.urandom(160 * 160 * 4))
+        encoded = base64.b64encode(png).decode()
+        comment = "".join(f"; {encoded[i:i + 78]}\n" for i in range(0, len(encoded), 78))
+        body = (
+            f"; generated by PrusaSlicer\n\n; thumbnail begin 160x160 {len(encoded)}\n{comment}; thumbnail end\n"
+            + "G1 X1\n" * 200_000 + "; filament used [g] = 2.5\n"
+        ).encode()
+        self.assertGreater(len(encoded), 2 * bgcode.GCODE_SCAN_BYTES)
+
+        result = bgcode.read_print_metadata(BytesIO(body))
+        self.assertEqual(result["filament"]["g"], 2.5)
+        reader = bgcode.MetadataReader()
+        with mock.patch.object(bgcode, "MetadataReader", lambda: reader):
+            bgcode.read_print_metadata(BytesIO(body))
+        self.assertEqual([(t["width"], t["data"]) for t in reader.thumbnails], [(160, png)])
+        # the head stopped where the thumbnail did, the middle was never read
+        self.assertLess(len(reader._head), len(encoded) + 64 * 1024 + bgcode.READ_SIZE)
+
+
+class UploadSessionTests(TestCase):
+
+    def setUp(self):
+        add_printers(1, pending_per_printer=0)
+        self.printer = Printers.objects.get()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        for patch in (
+            mock.patch.object(upload_sessions, "UPLOAD_SPOOL_DIR", upload_queue.Path(tmp.name) / "spool"),
+            mock.patch.object(upload_queue, "UPLOAD_SPOOL_DIR", upload_queue.Path(tmp.name) / "spool"),
+            mock.patch.object(thumbnails, "THUMBNAIL_DIR", thumbnails.Path(tmp.name) / "thumbnails"),
+            mock.patch.object(views, "UPLOAD_WORKER_AUTOSTART", False),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def put(self, url, chunk, offset):
+        return self.client.put(url, chunk, content_type="application/octet-stream", HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resume_and_finalize(self):
+        body = b"G1 X1\n" * 1000 + b"; filament used [g] = 4.2\n"
+        created = self.client.post("/api/upload-sessions/", {
+            "filename": "part.gcode", "size": len(body), "slug": self.printer.slug,
+            "sha256": hashlib.sha256(body).hexdigest(),
+        }, content_type="application/json")
+        self.assertEqual(created.status_code, 201)
+        url = created.json()["url"]
+
+        self.assertEqual(self.put(url, body[:4000], 0).json()["offset"], 4000)
+        # a retry of a chunk that already made it is told where to go on from
+        retried = self.put(url, body[:4000], 0)
+        self.assertEqual((retried.status_code, retried.json()["offset"]), (409, 4000))
+        self.assertEqual(self.client.post(created.json()["finalize_url"]).status_code, 409)
+
+        # another process picks up where this one's stream left off
+        upload_sessions._forget(created.json()["session"])
+        self.assertEqual(self.client.get(url).json()["offset"], 4000)
+        self.assertEqual(self.put(url, body[4000:], 4000).json()["offset"], len(body))
+        self.assertEqual(self.put(url, b"x", len(body)).status_code, 413)
+
+        finalized = self.client.post(created.json()["finalize_url"])
+        self.assertEqual(finalized.status_code, 202)
+        job = UploadJob.objects.get(pk=finalized.json()["job_id"])
+        self.assertEqual((job.filename, job.bytes_total, job.content.filament_g), ("part.gcode", len(body), 4.2))
+        self.assertEqual(upload_queue.Path(job.spool_path).read_bytes(), body)
+
+        # finalizing twice is harmless, the session takes no more chunks
+        self.assertEqual(self.client.post(created.json()["finalize_url"]).json()["job_id"], job.pk)
+        self.assertEqual(self.put(url, b"x", len(body)).status_code, 410)
+
+    def test_spool_file_gone(self):
+        body = b"G1 X1\n" * 1000
+
+        def session():
+            created = self.client.post("/api/upload-sessions/", {
+                "filename": "part.gcode", "size": len(body), "slug": self.printer.slug,
+            }, content_type="application/json").json()
+            self.assertEqual(self.put(created["url"], body[:4000], 0).json()["offset"], 4000)
+            upload_queue.Path(UploadSession.objects.get(key=created["session"]).spool_path).unlink()
+            return created
+
+        # a chunk for it is told to start over rather than failing with a 500
+        created = session()
+        response = self.put(created["url"], body[4000:], 4000)
+        self.assertEqual((response.status_code, response.json()["status"]), (410, UploadSession.ABORTED))
+        self.assertIn("start a new upload session", response.json()["error"])
+        self.assertEqual(self.client.get(created["url"]).json()["status"], UploadSession.ABORTED)
+
+        # the same when it goes missing after the last chunk
+        created = session()
+        upload_sessions._forget(created["session"])
+        self.assertEqual(self.put(created["url"], body[4000:], 4000).status_code, 410)
+        created = self.client.post("/api/upload-sessions/", {
+            "filename": "part.gcode", "size": len(body), "slug": self.printer.slug,
+        }, content_type="application/json").json()
+        self.assertEqual(self.put(created["url"], body, 0).json()["offset"], len(body))
+        upload_queue.Path(UploadSession.objects.get(key=created["session"]).spool_path).unlink()
+        response = self.client.post(created["finalize_url"])
+        self.assertEqual((response.status_code, response.json()["status"]), (410, UploadSession.ABORTED))
+        self.assertFalse(UploadJob.objects.exists())
+
+    def test_dedup_only_on_our_own_hash(self):
+        body = b"G1 X1\n; filament used [g] = 4.2\n"
+        other = b"G1 X9\n; filament used [g] = 9.9\n"
+        sha256 = hashlib.sha256(body).hexdigest()
+        known = content.remember_content(sha256, len(body), "part.gcode", {"format": "gcode", "filament": {"g": 4.2}})
+        PrinterFile.objects.create(printer=self.printer, remote_path="PRINT_QUEUE/part.gcode", content=known)
+        spool = upload_queue.UPLOAD_SPOOL_DIR
+
+        def upload_job(data, **headers):
+            return self.client.post(f"/api/upload-jobs/?slug={self.printer.slug}", data,
+                                    content_type="application/octet-stream", HTTP_X_FILENAME="part.gcode", **headers)
+
+        def session(data):
+            created = self.client.post("/api/upload-sessions/", {
+                "filename": "part.gcode", "size": len(data), "slug": self.printer.slug, "sha256": sha256,
+            }, content_type="application/json")
+            self.assertEqual(created.status_code, 201)
+            self.assertEqual(self.put(created.json()["url"], data, 0).json()["offset"], len(data))
+            return self.client.post(created.json()["finalize_url"])
+
+        with mock.patch.object(content, "get_client") as get_client:
+            get_client.return_value.exists_gcode.return_value = True
+
+            # claiming the hash of a file the printer has doesn't get other bytes waved through
+            response = upload_job(other, HTTP_X_CONTENT_SHA256=sha256)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(session(other).status_code, 400)
+            self.assertFalse(PendingJobUsage.objects.exists())
+
+            # the same bytes are recognised once we've hashed them, header or not
+            for headers in ({}, {"HTTP_X_CONTENT_SHA256": sha256}):
+                response = upload_job(body, **headers)
+                self.assertEqual((response.status_code, response.json()["deduplicated"]), (200, True))
+            response = session(body)
+            self.assertEqual((response.status_code, response.json()["deduplicated"]), (200, True))
+
+        self.assertFalse(UploadJob.objects.exists())
+        self.assertEqual(list(spool.iterdir()), [])
+        self.assertEqual(PendingJobUsage.objects.get(remote_path="PRINT_QUEUE/part.gcode").filament_g, 4.2)
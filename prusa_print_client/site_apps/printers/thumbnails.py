@@ -0,0 +1,253 @@
+"""
+Preview images of uploaded print files.
+
+Sliced files carry their own thumbnails (PrusaSlicer embeds a few sizes,
+PNG/JPG/QOI in .bgcode, base64 PNG comments in .gcode). MetadataReader picks
+them up during the upload pass we already make, and they're kept on disk
+by content hash:
+
+  THUMBNAIL_DIR/<sha[:2]>/<sha256>/<width>x<height>.<png|jpg>
+
+The sizes the slicer embedded are the variants, thumbnail_api serves the
+smallest one at least as wide as asked for. QOI gets converted to PNG so
+browsers can show it. A content directory with no images in it means we
+looked and the file has none.
+
+The content never changes under a hash, so the files are served as
+immutable. Serving one bumps its directory's mtime, and once the cache
+grows past THUMBNAIL_CACHE_MAX_BYTES the least recently used directories
+go. Evicted content gets its thumbnails back the next time it's uploaded.
+"""
+import os
+from pathlib import Path
+import re
+import shutil
+import struct
+import threading
+import time
+import zlib
+
+from django.conf import settings
+
+
+THUMBNAIL_DIR = Path(getattr(settings, "THUMBNAIL_DIR", settings.BASE_DIR / "thumbnails"))
+# the cache is trimmed back to this size, least recently served first
+THUMBNAIL_CACHE_MAX_BYTES = getattr(settings, "THUMBNAIL_CACHE_MAX_BYTES", 256 * 1024 ** 2)
+# serving a thumbnail only bumps its mtime if it's older than this, seconds
+THUMBNAIL_TOUCH_EVERY = 3600
+
+VARIANT_RE = re.compile(r"^(\d+)x(\d+)\.(png|jpg)$")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg"}
+
+_lock = threading.Lock()
+_cache_bytes = None  # running estimate, None until the first walk
+
+
+def content_dir(sha256) -> Path:
+    return THUMBNAIL_DIR / sha256[:2] / sha256
+
+
+def has_thumbnails(sha256) -> bool:
+    """
+    Whether we've looked at this content yet (it may have no images).
+    """
+    return content_dir(sha256).is_dir()
+
+
+def store_thumbnails(sha256, thumbnails) -> int:
+    """
+    Writes MetadataReader.thumbnails for some content, returns how many were
+    kept. Converts QOI to PNG, keeps one image per size (PNG over JPG).
+    """
+    global _cache_bytes
+    images = {}
+    for thumb in thumbnails:
+        image_format, data = thumb["format"], thumb["data"]
+        if image_format == "qoi":
+            try:
+                data = qoi_to_png(data)
+            except ValueError:
+                continue
+            image_format = "png"
+        if image_format not in CONTENT_TYPES:
+            continue
+        size = (thumb["width"], thumb["height"])
+        if size not in images or image_format == "png":
+            images[size] = (image_format, data)
+
+    directory = content_dir(sha256)
+    directory.mkdir(parents=True, exist_ok=True)
+    written = 0
+    for (width, height), (image_format, data) in images.items():
+        path = directory / f"{width}x{height}.{image_format}"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        written += len(data)
+
+    with _lock:
+        if _cache_bytes is not None:
+            _cache_bytes += written
+    trim_cache()
+    return len(images)
+
+
+def list_variants(sha256) -> list:
+    """
+    [(width, height, path)] narrowest first, [] if there are none (or we never looked).
+    """
+    try:
+        names = os.listdir(content_dir(sha256))
+    except OSError:
+        return []
+    variants = []
+    for name in names:
+        m = VARIANT_RE.match(name)
+        if m:
+            variants.append((int(m.group(1)), int(m.group(2)), content_dir(sha256) / name))
+    return sorted(variants)
+
+
+def pick_variant(sha256, width=None):
+    """
+    The narrowest variant at least `width` wide, the widest if none is or no
+    width was asked for. (width, height, path), or None.
+    """
+    variants = list_variants(sha256)
+    if not variants:
+        return None
+    if width:
+        for variant in variants:
+            if variant[0] >= width:
+                return variant
+    return variants[-1]
+
+
+def content_type(path) -> str:
+    return CONTENT_TYPES[Path(path).suffix.lstrip(".")]
+
+
+def touch(sha256):
+    # marks it as recently used for trim_cache(), at most once per THUMBNAIL_TOUCH_EVERY
+    directory = content_dir(sha256)
+    try:
+        if time.time() - directory.stat().st_mtime > THUMBNAIL_TOUCH_EVERY:
+            os.utime(directory)
+    except OSError:
+        pass
+
+
+def _content_dirs():
+    # [(mtime, bytes, path)] of every content directory
+    found = []
+    if not THUMBNAIL_DIR.is_dir():
+        return found
+    for prefix in os.scandir(THUMBNAIL_DIR):
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+                found.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue
+    return found
+
+
+def trim_cache(max_bytes=None) -> int:
+    """
+    Drops the least recently used content directories until the cache fits
+    in `max_bytes` (THUMBNAIL_CACHE_MAX_BYTES). Only walks the disk when the
+    running estimate says it's over. Returns how many directories went.
+    """
+    global _cache_bytes
+    max_bytes = THUMBNAIL_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+
+    with _lock:
+        if _cache_bytes is not None and _cache_bytes <= max_bytes:
+            return 0
+        found = _content_dirs()
+        total = sum(size for _, size, _ in found)
+        removed = 0
+        for _, size, path in sorted(found):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        _cache_bytes = total
+        return removed
+
+
+### QOI -> PNG, no imaging library needed for the few hundred pixels a thumbnail has
+
+def qoi_decode(data):
+    """
+    (width, height, RGBA bytes) of a QOI image, see https://qoiformat.org/qoi-specification.pdf
+    """
+    if len(data) < 22 or data[:4] != b"qoif":
+        raise ValueError("Not a QOI image")
+    width, height, channels, _ = struct.unpack(">IIBB", data[4:14])
+    if not width or not height or width * height > 4096 * 4096 or channels not in (3, 4):
+        raise ValueError("Unsupported QOI image")
+
+    pixels = bytearray(width * height * 4)
+    index = [(0, 0, 0, 0)] * 64
+    r, g, b, a = 0, 0, 0, 255
+    pos, end, out, total = 14, len(data) - 8, 0, len(pixels)
+    run = 0
+
+    while out < total:
+        if run:
+            run -= 1
+        elif pos < end:
+            op = data[pos]
+            pos += 1
+            if op == 0xFE:
+                r, g, b = data[pos], data[pos + 1], data[pos + 2]
+                pos += 3
+            elif op == 0xFF:
+                r, g, b, a = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+                pos += 4
+            elif op >> 6 == 0:
+                r, g, b, a = index[op]
+            elif op >> 6 == 1:
+                r = (r + ((op >> 4) & 3) - 2) & 0xFF
+                g = (g + ((op >> 2) & 3) - 2) & 0xFF
+                b = (b + (op & 3) - 2) & 0xFF
+            elif op >> 6 == 2:
+                dg = (op & 0x3F) - 32
+                second = data[pos]
+                pos += 1
+                r = (r + dg - 8 + (second >> 4)) & 0xFF
+                g = (g + dg) & 0xFF
+                b = (b + dg - 8 + (second & 0x0F)) & 0xFF
+            else:
+                run = op & 0x3F
+            index[(r * 3 + g * 5 + b * 7 + a * 11) % 64] = (r, g, b, a)
+        else:
+            raise ValueError("Truncated QOI image")
+        pixels[out:out + 4] = bytes((r, g, b, a))
+        out += 4
+
+    return width, height, bytes(pixels)
+
+
+def png_encode(width, height, rgba) -> bytes:
+    def chunk(kind, body):
+        return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", zlib.crc32(kind + body))
+
+    stride = width * 4
+    # filter type 0 on every row
+    raw = b"".join(b"\x00" + rgba[y * stride:(y + 1) * stride] for y in range(height))
+    return (
+        PNG_SIGNATURE
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def qoi_to_png(data) -> bytes:
+    return png_encode(*qoi_decode(data))
@@ -0,0 +1,287 @@
+"""
+Background transfer of print files to printers.
+
+upload_jobs_api spools the file to disk (parsing its metadata on the way) and
+queues an UploadJob, then returns right away. The worker here picks due jobs
+off the queue, keeps at most UPLOAD_MAX_PER_PRINTER transfers going per
+printer, and retries failed transfers with exponential backoff. A printer
+whose circuit is open (health.py) doesn't use up attempts, its jobs wait
+for the breaker's next probe instead.
+
+The worker runs as a thread in the web process (started on the first upload)
+or on its own via `manage.py run_upload_worker`. It also runs the dispatcher
+(dispatch.py) that turns uploads for a printer model or pool into UploadJobs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import logging
+import os
+from pathlib import Path
+import threading
+import uuid
+
+import requests
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .clients import get_client
+from .health import PrinterUnavailable
+from .content import (
+    ContentMismatch, lookup_content, needs_parsing, printer_has_content, record_pending_usage, record_printer_file,
+    remember_upload,
+)
+from .models import Printers, UploadJob
+from .uploads import UploadStream
+
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_SPOOL_DIR = Path(getattr(settings, "UPLOAD_SPOOL_DIR", settings.BASE_DIR / "spool"))
+# transfers running at once, overall and per printer
+UPLOAD_WORKERS = getattr(settings, "UPLOAD_WORKERS", 4)
+UPLOAD_MAX_PER_PRINTER = getattr(settings, "UPLOAD_MAX_PER_PRINTER", 1)
+# first retry after this many seconds, doubling every attempt
+UPLOAD_RETRY_BACKOFF = getattr(settings, "UPLOAD_RETRY_BACKOFF", 15)
+# start the in-process worker on the first queued upload
+UPLOAD_WORKER_AUTOSTART = getattr(settings, "UPLOAD_WORKER_AUTOSTART", True)
+# an "uploading" job nobody touched for this long belonged to a worker that died
+UPLOAD_STALLED_AFTER = timedelta(minutes=10)
+
+
+def spool_upload(filename, length, chunks, sha256=None):
+    """
+    Writes the incoming file to UPLOAD_SPOOL_DIR, returns
+    (remote_name, spool_path, size, content).
+    `sha256` is the hash the client says the file has: if we know that
+    content its metadata is reused instead of parsing the file again, and
+    ContentMismatch is raised if the bytes turn out not to match.
+    """
+    UPLOAD_SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    remote_name = Path(filename).name
+    spool_path = UPLOAD_SPOOL_DIR / f"{uuid.uuid4().hex}{Path(remote_name).suffix}"
+
+    known = lookup_content(sha256)
+    body = UploadStream(chunks, length, parse=needs_parsing(known))
+    size = body.spool_to(spool_path)
+
+    if sha256 and body.sha256 != sha256:
+        os.unlink(spool_path)
+        raise ContentMismatch(f"Expected sha256 {sha256}, got {body.sha256}")
+
+    content = remember_upload(known, body, size, remote_name)
+    return remote_name, spool_path, size, content
+
+
+def create_upload_job(printer, filename, spool_path, size, content) -> UploadJob:
+    usage = content.as_metadata()["filament"] if content is not None else {}
+    return UploadJob.objects.create(
+        printer=printer,
+        filename=filename,
+        remote_path=f"PRINT_QUEUE/{filename}",
+        spool_path=str(spool_path),
+        bytes_total=size,
+        content=content,
+        filament_mm=usage.get("mm"),
+        filament_g=usage.get("g"),
+        filament_cm3=usage.get("cm3"),
+    )
+
+
+def enqueue_upload(printer, filename, length, chunks, sha256=None):
+    """
+    Spools the incoming file to disk and queues it for `printer`,
+    see spool_upload() for `sha256`. Returns the UploadJob, or None if the
+    printer already has exactly this file (going by the hash we computed,
+    never the one the client sent) and there's nothing to transfer.
+    """
+    remote_name, spool_path, size, content = spool_upload(filename, length, chunks, sha256=sha256)
+    remote_path = f"PRINT_QUEUE/{remote_name}"
+    if printer_has_content(printer, remote_path, content):
+        os.unlink(spool_path)
+        record_pending_usage(printer, remote_path, content.as_metadata()["filament"])
+        return None
+    return create_upload_job(printer, remote_name, spool_path, size, content)
+
+
+def claim_next_job():
+    """
+    Marks the oldest due job whose printer still has a free upload slot as
+    uploading and returns it, or None if there's nothing to do right now.
+
+    Safe with several workers: claims for one printer are serialized on its
+    row, and the free slot is checked again in the UPDATE that claims.
+    """
+    busy_printers = (
+        UploadJob.objects.filter(status=UploadJob.UPLOADING)
+        .values("printer")
+        .annotate(running=Count("pk"))
+        .filter(running__gte=UPLOAD_MAX_PER_PRINTER)
+        .values("printer")
+    )
+    candidates = (
+        UploadJob.objects.filter(status=UploadJob.QUEUED, next_attempt_at__lte=timezone.now())
+        .exclude(printer__in=busy_printers)
+        .order_by("next_attempt_at", "pk")
+        .values_list("pk", "printer_id")[:10]
+    )
+
+    for pk, printer_id in candidates:
+        with transaction.atomic():
+            # another worker claiming for this printer waits here (no-op on sqlite,
+            # where the UPDATE below already runs under the database's write lock)
+            list(Printers.objects.select_for_update().filter(pk=printer_id).values_list("pk"))
+            # whoever flips the status first owns the job, unless the printer filled up meanwhile
+            claimed = UploadJob.objects.filter(pk=pk, status=UploadJob.QUEUED).exclude(
+                printer__in=busy_printers,
+            ).update(
+                status=UploadJob.UPLOADING,
+                attempts=F("attempts") + 1,
+                bytes_sent=0,
+                updated_at=timezone.now(),
+            )
+        if claimed:
+            return UploadJob.objects.select_related("printer", "content").get(pk=pk)
+
+    return None
+
+
+def requeue_stalled_jobs():
+    return UploadJob.objects.filter(
+        status=UploadJob.UPLOADING,
+        updated_at__lt=timezone.now() - UPLOAD_STALLED_AFTER,
+    ).update(status=UploadJob.QUEUED, next_attempt_at=timezone.now())
+
+
+def _save_progress(job, state, bytes_sent, bytes_total, **extra):
+    UploadJob.objects.filter(pk=job.pk).update(bytes_sent=bytes_sent, updated_at=timezone.now())
+
+
+def run_job(job):
+    """
+    Transfers one claimed job. On failure it goes back in the queue with
+    backoff until it runs out of attempts.
+    """
+    error = None
+    try:
+        with open(job.spool_path, "rb") as f:
+            body = UploadStream(iter(lambda: f.read(64 * 1024), b""), job.bytes_total,
+                                on_progress=lambda **progress: _save_progress(job, **progress))
+            # NO AUTOSTART, THEY MUST BE AT THE PRINTER
+            resp = get_client(job.printer).put_stream(body, job.remote_path, printAfterUpload=False, overwrite=True)
+        if not resp.ok:
+            error = f"Printer answered {resp.status_code}: {resp.text[:500]}"
+    except PrinterUnavailable as e:
+        # the circuit is open so the printer wasn't even tried, that's no attempt:
+        # give it back and come again when the breaker lets the next probe through
+        UploadJob.objects.filter(pk=job.pk).update(
+            status=UploadJob.QUEUED,
+            attempts=F("attempts") - 1,
+            error=str(e),
+            next_attempt_at=timezone.now() + timedelta(seconds=max(e.health["retry_in"], 1.0)),
+            updated_at=timezone.now(),
+        )
+        return False
+    except (requests.RequestException, OSError) as e:
+        error = str(e) or e.__class__.__name__
+
+    if error is None:
+        with transaction.atomic():
+            UploadJob.objects.filter(pk=job.pk).update(
+                status=UploadJob.DONE, bytes_sent=job.bytes_total, error="", updated_at=timezone.now(),
+            )
+            if job.content_id is not None:
+                record_printer_file(job.printer, job.remote_path, job.content)
+            record_pending_usage(
+                job.printer,
+                job.remote_path,
+                {"mm": job.filament_mm, "g": job.filament_g, "cm3": job.filament_cm3},
+            )
+        _remove_spool(job)
+        return True
+
+    if job.attempts >= job.max_attempts:
+        UploadJob.objects.filter(pk=job.pk).update(status=UploadJob.FAILED, error=error, updated_at=timezone.now())
+        _remove_spool(job)
+    else:
+        retry_in = timedelta(seconds=UPLOAD_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+        UploadJob.objects.filter(pk=job.pk).update(
+            status=UploadJob.QUEUED,
+            error=error,
+            next_attempt_at=timezone.now() + retry_in,
+            updated_at=timezone.now(),
+        )
+    return False
+
+
+def _remove_spool(job):
+    try:
+        os.unlink(job.spool_path)
+    except FileNotFoundError:
+        pass
+
+
+class UploadWorker:
+    """
+    Pulls jobs off the queue into a thread pool of UPLOAD_WORKERS.
+    """
+
+    def __init__(self, workers=None, poll_interval=1.0):
+        self.workers = workers or UPLOAD_WORKERS
+        self.poll_interval = poll_interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def ensure_running(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name="printer-upload-worker", daemon=True)
+                self._thread.start()
+        self.wake()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run_job(self, job):
+        try:
+            run_job(job)
+        except Exception:
+            logger.exception("upload job %s crashed", job.pk)
+        finally:
+            close_old_connections()
+            self.wake()
+
+    def run(self):
+        from .dispatch import dispatcher
+
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self._stop.is_set():
+                self._wake.clear()
+                try:
+                    requeue_stalled_jobs()
+                    # jobs queued for a model/pool become uploads here
+                    dispatcher.maybe_tick()
+                    running = {future for future in running if not future.done()}
+                    while len(running) < self.workers:
+                        job = claim_next_job()
+                        if job is None:
+                            break
+                        running.add(pool.submit(self._run_job, job))
+                except Exception:
+                    logger.exception("upload queue poll failed")
+                finally:
+                    close_old_connections()
+
+                self._wake.wait(self.poll_interval)
+
+
+worker = UploadWorker()
@@ -0,0 +1,275 @@
+"""
+Resumable uploads from the browser.
+
+  POST   api/upload-sessions/                 {filename, size, slug | model | pool, sha256}
+  PUT    api/upload-sessions/<key>/            a chunk, Upload-Offset: <where it starts>
+  GET    api/upload-sessions/<key>/            how far we got ("offset")
+  POST   api/upload-sessions/<key>/finalize/   hand it on, like upload_jobs_api
+  DELETE api/upload-sessions/<key>/            give up
+
+Chunks are written in order straight into a spool file: a PUT at any offset
+but the committed one gets told where to go on from. If a chunk breaks off
+halfway the bytes that made it are kept, the client asks for the offset and
+carries on from there instead of starting over.
+
+Every chunk also goes through an UploadStream (hash, metadata, thumbnails)
+as it arrives, so finalizing doesn't read the file again. That stream lives
+in this process; when a chunk lands somewhere else (another worker, after a
+restart) it's rebuilt from the spool file once. Finalizing turns the session
+into an UploadJob (or DispatchJob) pointing at the spool file, the upload
+worker takes it from there.
+"""
+from datetime import timedelta
+from functools import partial
+import os
+from pathlib import Path
+import secrets
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .content import (
+    ContentMismatch, lookup_content, needs_parsing, printer_has_content, record_pending_usage, remember_upload,
+)
+from .dispatch import create_dispatch_job
+from .models import UploadSession
+from .upload_queue import UPLOAD_SPOOL_DIR, create_upload_job
+from .uploads import UploadStream, set_upload_progress
+
+
+# sessions nobody sent anything to for this long are dropped with their file
+UPLOAD_SESSION_TTL = timedelta(hours=getattr(settings, "UPLOAD_SESSION_TTL_HOURS", 24))
+# chunk size we suggest to clients, bytes
+UPLOAD_SESSION_CHUNK_SIZE = getattr(settings, "UPLOAD_SESSION_CHUNK_SIZE", 8 * 1024 ** 2)
+
+
+class SessionClosed(Exception):
+    """The session was finalized or aborted already."""
+
+
+class SpoolLost(SessionClosed):
+    """The spool file is gone (cleaned up, another disk), the session is aborted and has to start over."""
+
+
+class OffsetMismatch(Exception):
+    """A chunk for somewhere other than where the file ends, `offset` is where it does."""
+
+    def __init__(self, offset):
+        self.offset = offset
+        super().__init__(f"Expected offset {offset}")
+
+
+class TooLarge(ValueError):
+    """More bytes than the session said the file has."""
+
+
+class Incomplete(Exception):
+    """Finalizing before every byte is in."""
+
+
+# session key -> UploadStream of what's in its spool file so far
+_streams = {}
+# session key -> lock, one chunk at a time per session
+_locks = {}
+_registry_lock = threading.Lock()
+
+
+def _lock_for(key):
+    with _registry_lock:
+        return _locks.setdefault(key, threading.Lock())
+
+
+def _forget(key):
+    with _registry_lock:
+        _streams.pop(key, None)
+        _locks.pop(key, None)
+
+
+def create_session(filename, size, printer=None, target_model="", pool=None, priority=0, sha256=None) -> UploadSession:
+    expire_sessions()
+    UPLOAD_SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    remote_name = Path(filename).name
+    spool_path = UPLOAD_SPOOL_DIR / f"{uuid.uuid4().hex}{Path(remote_name).suffix}"
+    spool_path.touch()
+
+    return UploadSession.objects.create(
+        key=secrets.token_hex(16),
+        printer=printer,
+        target_model=target_model if printer is None and pool is None else "",
+        pool=pool,
+        priority=priority,
+        filename=remote_name,
+        spool_path=str(spool_path),
+        bytes_total=size,
+        sha256=sha256 or "",
+    )
+
+
+def _stream(session) -> UploadStream:
+    """
+    The UploadStream of what the spool file holds, which is exactly
+    session.bytes_received bytes. Caller holds the session's lock.
+    """
+    with _registry_lock:
+        stream = _streams.get(session.key)
+    if stream is not None and stream.bytes_sent == session.bytes_received:
+        return stream
+
+    # content the client says we already know doesn't need parsing again
+    stream = UploadStream(
+        None, session.bytes_total,
+        on_progress=partial(set_upload_progress, session.key),
+        parse=needs_parsing(lookup_content(session.sha256)),
+    )
+    with open(session.spool_path, "rb") as f:
+        left = session.bytes_received
+        while left:
+            chunk = f.read(min(left, 1024 ** 2))
+            if not chunk:
+                break
+            stream.feed(chunk)
+            left -= len(chunk)
+
+    with _registry_lock:
+        _streams[session.key] = stream
+    return stream
+
+
+def _spool_lost(session):
+    _abort(session)
+    return SpoolLost("The uploaded data is gone, start a new upload session")
+
+
+def write_chunk(session, offset, chunks) -> int:
+    """
+    Appends a chunk (an iterable of bytes) at `offset`, returns the new
+    committed offset. Whatever part of the chunk arrived is kept even if the
+    rest doesn't. Raises OffsetMismatch, SessionClosed (SpoolLost) or TooLarge.
+    """
+    with _lock_for(session.key):
+        session.refresh_from_db(fields=["bytes_received", "status"])
+        if session.status != UploadSession.OPEN:
+            raise SessionClosed()
+        if offset != session.bytes_received:
+            raise OffsetMismatch(session.bytes_received)
+
+        try:
+            stream = _stream(session)
+            spool = open(session.spool_path, "r+b")
+        except FileNotFoundError:
+            raise _spool_lost(session) from None
+        written = 0
+        try:
+            with spool as f:
+                f.seek(offset)
+                for chunk in chunks:
+                    if offset + written + len(chunk) > session.bytes_total:
+                        raise TooLarge(f"File is {session.bytes_total} bytes")
+                    f.write(chunk)
+                    stream.feed(chunk)
+                    written += len(chunk)
+        finally:
+            if written:
+                committed = UploadSession.objects.filter(
+                    pk=session.pk, status=UploadSession.OPEN, bytes_received=offset,
+                ).update(bytes_received=offset + written, updated_at=timezone.now())
+                if committed:
+                    session.bytes_received = offset + written
+                else:
+                    # another process wrote there meanwhile, ours is worthless
+                    _forget(session.key)
+
+        return session.bytes_received
+
+
+def finalize_session(session) -> dict:
+    """
+    Hands a complete session on: an UploadJob for a printer, a DispatchJob
+    for a model or pool, or nothing if the printer already has the file.
+    Returns {"session", "content", "deduplicated"}. Finalizing twice is fine.
+    Raises Incomplete, SessionClosed (SpoolLost) or ContentMismatch (the
+    session is aborted then, resending it won't fix it).
+    """
+    with _lock_for(session.key):
+        session.refresh_from_db()
+        if session.status == UploadSession.FINALIZED:
+            deduplicated = session.upload_job_id is None and session.dispatch_job_id is None
+            return {"session": session, "content": None, "deduplicated": deduplicated}
+        if session.status != UploadSession.OPEN:
+            raise SessionClosed()
+        if session.bytes_received != session.bytes_total:
+            raise Incomplete(f"Have {session.bytes_received} of {session.bytes_total} bytes")
+
+        try:
+            stream = _stream(session)
+            # a retried chunk may have left bytes past the end
+            os.truncate(session.spool_path, session.bytes_total)
+        except FileNotFoundError:
+            raise _spool_lost(session) from None
+        stream.reader.close()
+        if session.sha256 and stream.sha256 != session.sha256:
+            _abort(session)
+            raise ContentMismatch(f"Expected sha256 {session.sha256}, got {stream.sha256}")
+
+        content = remember_upload(lookup_content(stream.sha256), stream, session.bytes_total, session.filename)
+        remote_path = f"PRINT_QUEUE/{session.filename}"
+
+        # the printer already has exactly this file, nothing to queue
+        deduplicated = session.printer_id is not None and printer_has_content(session.printer, remote_path, content)
+        if deduplicated:
+            record_pending_usage(session.printer, remote_path, content.as_metadata()["filament"])
+
+        with transaction.atomic():
+            if session.printer_id is not None:
+                if not deduplicated:
+                    session.upload_job = create_upload_job(
+                        session.printer, session.filename, session.spool_path, session.bytes_total, content,
+                    )
+            else:
+                session.dispatch_job = create_dispatch_job(
+                    session.filename, session.spool_path, session.bytes_total, content,
+                    target_model=session.target_model, pool=session.pool, priority=session.priority,
+                )
+            session.status = UploadSession.FINALIZED
+            session.save(update_fields=["status", "upload_job", "dispatch_job", "updated_at"])
+
+        if deduplicated:
+            os.unlink(session.spool_path)
+        stream.report("done", force=True)
+        _forget(session.key)
+        return {"session": session, "content": content, "deduplicated": deduplicated}
+
+
+def _abort(session):
+    UploadSession.objects.filter(pk=session.pk, status=UploadSession.OPEN).update(
+        status=UploadSession.ABORTED, updated_at=timezone.now(),
+    )
+    session.status = UploadSession.ABORTED
+    try:
+        os.unlink(session.spool_path)
+    except FileNotFoundError:
+        pass
+    _forget(session.key)
+
+
+def abort_session(session):
+    with _lock_for(session.key):
+        session.refresh_from_db(fields=["status"])
+        if session.status != UploadSession.OPEN:
+            raise SessionClosed()
+        _abort(session)
+
+
+def expire_sessions() -> int:
+    """
+    Aborts open sessions nobody sent anything to within UPLOAD_SESSION_TTL.
+    """
+    stale = list(UploadSession.objects.filter(
+        status=UploadSession.OPEN, updated_at__lt=timezone.now() - UPLOAD_SESSION_TTL,
+    ))
+    for session in stale:
+        _abort(session)
+    return len(stale)
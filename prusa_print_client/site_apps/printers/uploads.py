@@ -0,0 +1,142 @@
+"""
+Streaming uploads from the browser to a printer.
+
+The request body goes straight into the printer's PUT, chunk by chunk. On the
+way through each chunk is hashed, fed to the metadata reader (bgcode.py) and
+counted for progress, so the file is read exactly once.
+
+Only under WSGI is it never copied to disk: there the body comes off the
+socket as the printer takes it. Django's ASGIHandler spools the whole body to
+a temporary file before the view runs, so under asgi.py the upload lands on
+disk once and is streamed to the printer from there.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .bgcode import MetadataReader
+
+
+# size of the chunks pulled off the request and pushed to the printer
+UPLOAD_CHUNK_SIZE = getattr(settings, "UPLOAD_CHUNK_SIZE", 256 * 1024)
+
+UPLOAD_PROGRESS_KEY = "printers:upload:{upload_id}"
+# progress entries are kept around this long (seconds) after the last update
+UPLOAD_PROGRESS_TTL = 60 * 60
+# don't write progress to the cache more often than this (seconds)
+UPLOAD_PROGRESS_EVERY = 0.5
+
+
+def get_upload_progress(upload_id):
+    return cache.get(UPLOAD_PROGRESS_KEY.format(upload_id=upload_id))
+
+
+def set_upload_progress(upload_id, **progress):
+    # signature fits UploadStream(on_progress=partial(set_upload_progress, upload_id))
+    progress["updated_at"] = time.time()
+    cache.set(UPLOAD_PROGRESS_KEY.format(upload_id=upload_id), progress, timeout=UPLOAD_PROGRESS_TTL)
+
+
+def iter_request_body(request, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Yields the raw request body in chunks. Under WSGI that's straight off the
+    socket, under ASGI it's read back from the file Django spooled it to.
+    """
+    while True:
+        chunk = request.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class UploadStream:
+    """
+    Iterable body for PrinterClient.put_stream(), wraps the incoming chunks.
+    `on_progress(state=..., bytes_sent=..., bytes_total=..., **extra)` gets
+    called at most every UPLOAD_PROGRESS_EVERY seconds.
+
+    `length` has to be known up front (it becomes the Content-Length); if the
+    source ends up shorter or longer the printer rejects the upload.
+
+    parse=False skips the metadata reader, for content we already know (content.py).
+    """
+
+    def __init__(self, chunks, length, on_progress=None, parse=True):
+        self.chunks = chunks
+        self.length = length
+        self.on_progress = on_progress
+        self.bytes_sent = 0
+        self.reader = MetadataReader()
+        self.hash = hashlib.sha256()
+        self._reported_at = 0.0
+
+        if not parse:
+            self.reader.done = True
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        self.report("uploading", force=True)
+
+        for chunk in self.chunks:
+            self.feed(chunk)
+            yield chunk
+
+        self.reader.close()
+
+    def feed(self, chunk):
+        """
+        Takes one chunk that went past some other way (resumable uploads,
+        upload_sessions.py); call reader.close() after the last one.
+        """
+        if not self.reader.done:
+            self.reader.feed(chunk)
+        self.hash.update(chunk)
+        self.bytes_sent += len(chunk)
+        self.report("uploading")
+
+    def spool_to(self, path):
+        """
+        Consumes the stream into a local file instead of a printer, used when
+        the transfer happens later (upload queue). Returns the bytes written.
+        """
+        with open(path, "wb") as f:
+            for chunk in self:
+                f.write(chunk)
+        return self.bytes_sent
+
+    @property
+    def metadata(self) -> dict:
+        """
+        Same shape as bgcode.read_print_metadata(), complete once the stream
+        is consumed (for .bgcode usually after the first few chunks).
+        """
+        return self.reader.result()
+
+    @property
+    def thumbnails(self) -> list:
+        # MetadataReader.thumbnails, empty when parse=False
+        return self.reader.thumbnails
+
+    @property
+    def sha256(self) -> str:
+        # hex digest of everything streamed so far
+        return self.hash.hexdigest()
+
+    def report(self, state, force=False, **extra):
+        if self.on_progress is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._reported_at < UPLOAD_PROGRESS_EVERY:
+            return
+        self._reported_at = now
+
+        self.on_progress(
+            state=state,
+            bytes_sent=self.bytes_sent,
+            bytes_total=self.length,
+            **extra,
+        )
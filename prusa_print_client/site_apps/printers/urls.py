@@ -8,8 +8,27 @@ urlpatterns = [
     path('<slug:slug>', views.get_printer, name="get_printer"),
 
     # api calls
+    path("api/metrics/", views.metrics_api, name="metrics_api"),
     path("api/printers/status/", views.printers_status_api, name="printers_status_api"),
+    path("api/printers/snapshot/", views.printers_snapshot_api, name="printers_snapshot_api"),
+    path("api/printers/meta/", views.printers_meta_api, name="printers_meta_api"),
+    path("api/printers/previews/", views.printers_previews_api, name="printers_previews_api"),
+    path("api/printers/stream/", views.printers_stream_api, name="printers_stream_api"),
+    path("api/printers/<slug:slug>/telemetry/", views.printer_telemetry_api, name="printer_telemetry_api"),
+    path("api/printers/stats/", views.farm_stats_api, name="farm_stats_api"),
     path("api/printers/individual-printer/", views.individual_printer_api, name="individual_printer_api"),
     path('api/upload-bgcode/', views.upload_bgcode_api, name='upload_bgcode_api'),
+    path('api/upload-bgcode/broadcast/', views.upload_broadcast_api, name='upload_broadcast_api'),
+    path('api/upload-bgcode/check/', views.upload_check_api, name='upload_check_api'),
+    path('api/upload-bgcode/<str:upload_id>/progress/', views.upload_progress_api, name='upload_progress_api'),
+    path('api/thumbnails/<str:sha256>/', views.thumbnail_api, name='thumbnail_api'),
+    path('api/upload-jobs/', views.upload_jobs_api, name='upload_jobs_api'),
+    path('api/upload-jobs/<int:job_id>/', views.upload_job_status_api, name='upload_job_status_api'),
+    path('api/upload-sessions/', views.upload_sessions_api, name='upload_sessions_api'),
+    path('api/upload-sessions/<str:key>/', views.upload_session_api, name='upload_session_api'),
+    path('api/upload-sessions/<str:key>/finalize/', views.upload_session_finalize_api,
+         name='upload_session_finalize_api'),
+    path('api/dispatch-jobs/<int:dispatch_id>/', views.dispatch_job_status_api, name='dispatch_job_status_api'),
     path('api/printer-commands/', views.printer_commands_api, name='printer_commands_api'),
+    path('api/printer-commands/bulk/', views.printer_bulk_commands_api, name='printer_bulk_commands_api'),
 ]
\ No newline at end of file
@@ -1,4 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from django.conf import settings
+
+from .bgcode import read_print_metadata
+
+
+# hard cap on how long a farm-wide status sweep may take, in seconds
+PRINTER_STATUS_DEADLINE = getattr(settings, "PRINTER_STATUS_DEADLINE", 4.0)
+# max number of printers talked to at the same time
+PRINTER_POLL_WORKERS = getattr(settings, "PRINTER_POLL_WORKERS", 16)
+
+
 # used gpt to map the status flags
+# everything map_printer_status() can return
+PRINTER_STATUSES = ("operational", "paused", "printing", "error", "ready", "stopped", "busy")
+
+
 def map_printer_status(state: str) -> str:
     """
     Map raw printer state string -> one of:
@@ -38,118 +56,69 @@ def map_printer_status(state: str) -> str:
     # Unknown state: safest to call it busy
     return "busy"
 
-import re
 
+def get_printer_status(printer) -> dict:
+    """
+    Fetches a printer's /api/v1/status json through its shared client
+    (keep-alive, timeouts and retries live in clients.py).
+
+    Raises requests.RequestException / ValueError if it's unreachable or
+    answers with garbage.
+    """
+    from .clients import get_client
 
+    resp = get_client(printer).get_status()
+    resp.raise_for_status()  # raises for HTTP 4xx/5xx
+    return resp.json()
 
-def get_filament_usage_from_file(file_obj) -> dict:
+
+def fetch_printer_statuses(printers, deadline=None) -> dict:
     """
-    Given a Prusa sliced .bgcode file, extracts the filament usage of a print 
+    Asks every printer for its /api/v1/status at the same time instead of
+    one after another.
+
+    Each request has the client's timeout and the whole sweep gets `deadline`;
+    anything that errors or hasn't answered by then comes back as None (offline)
+    so a dead printer can't hold up the rest of the farm.
 
     Returns a dict like:
       {
-        "mm": 12345.67,
-        "g": 98.7,
-        "cm3": 12.34,
+        printer.pk: {...status json...} or None,
       }
     """
-    
-    FILAMENT_RE = re.compile(r";\s*filament used \[([^\]]+)\]\s*=\s*([0-9.+-eE]+)")
-    usage = {}
-
-    # reading only the first 100 lines to avoid slurping the whole file
-    for _ in range(100):
-        line = file_obj.readline()
-        if not line:
-            break  # EOF
-
-        try:
-            line_str = line.decode("utf-8", errors="ignore")
-        except AttributeError:
-            # already str
-            line_str = line
-
-        m = FILAMENT_RE.match(line_str.strip())
-        if m:
-            unit = m.group(1).strip()   # e.g. "mm", "g", "cm3"
-            value = float(m.group(2))
-            usage[unit] = value
-
-    # rewind so later code can re-read the file if needed
-    try:
-        file_obj.seek(0)
-    except Exception:
-        pass
-
-    return usage
-
-def estimate_filament_for_stopped_job(job_data, pending_usage):
-    """
-    pending_usage: PendingJobUsage instance with filament_mm / filament_g
-    """
-    job = job_data.get("job") or {}
-    progress = job.get("progress") or {}
+    printers = list(printers)
+    results = {printer.pk: None for printer in printers}
+    if not printers:
+        return results
 
-    completion = progress.get("completion")  # 0..100%
-    if completion is None:
-        return None, None, None
+    pool = ThreadPoolExecutor(max_workers=min(len(printers), PRINTER_POLL_WORKERS))
+    futures = {pool.submit(get_printer_status, printer): printer for printer in printers}
 
-    frac = completion / 100.0
+    try:
+        done, _ = wait(futures, timeout=deadline or PRINTER_STATUS_DEADLINE)
+        for future in done:
+            try:
+                results[futures[future].pk] = future.result()
+            except (requests.exceptions.RequestException, ValueError):
+                # unreachable, bad response or not json -> stays offline
+                pass
+    finally:
+        # don't sit around for the stragglers, their own timeout cleans them up
+        pool.shutdown(wait=False, cancel_futures=True)
 
-    used_mm = used_g = used_cm3 = None
-    if pending_usage.filament_mm is not None:
-        used_mm = pending_usage.filament_mm * frac
-    if pending_usage.filament_g is not None:
-        used_g = pending_usage.filament_g * frac
-    if pending_usage.filament_cm3 is not None:
-        used_cm3 = pending_usage.filament_cm3 * frac
+    return results
 
-    return used_mm, used_g, used_cm3
 
-def get_filament_usage_from_job(printer, job_data):
-    """
-    For a single printer (django object) + its /api/v1/job JSON:
-      - If the current job is FINISHED or STOPPED
-      - And we have a PendingJobUsage for its file
-      → add filament usage and delete the pending record
-      
-    Also, this func is a little jank, modded it to be used in views as 
-        well as commands with the OG use being the latter
+def get_filament_usage_from_file(file_obj) -> dict:
     """
-    
-    from .models import PendingJobUsage
-    
-    
-    job = job_data.get("job") or {}
-    state = (job.get("state") or "").upper()
-
-    if state not in ("FINISHED", "STOPPED"):
-        return None, None, None, None
-
-    file_info = job.get("file") or {}
-    refs = file_info.get("refs") or {}
-    download_path = refs.get("download")
-    if not download_path:
-        return None, None, None, None
-
-    pending = PendingJobUsage.objects.filter(
-        printer=printer,
-        remote_path=download_path,
-    ).first()
-
-    # if theres no pending record, we either:
-    # - never uploaded this via our app, or
-    # - already processed it
-    if not pending:
-        return None, None, None, None
-
-    # FINISHED vs STOPPED logic
-    if state == "FINISHED":
-        used_mm = pending.filament_mm or 0.0
-        used_g = pending.filament_g or 0.0
-        used_cm3 = pending.filament_cm3 or 0.0
-    else:  # STOPPED
-        used_mm, used_g, used_cm3 = estimate_filament_for_stopped_job(job_data, pending)
-        
-    return used_mm, used_g, used_cm3, pending
+    Given a Prusa sliced .bgcode (or plain .gcode) file, extracts the filament usage of a print.
+    See bgcode.py, only the metadata blocks / gcode summary get read, not the whole file.
 
+    Returns a dict like:
+      {
+        "mm": 12345.67,
+        "g": 98.7,
+        "cm3": 12.34,
+      }
+    """
+    return read_print_metadata(file_obj)["filament"]
@@ -1,57 +1,149 @@
+from datetime import timedelta
+from functools import partial
+import hashlib
 import json
-import os
 from pathlib import Path
-import tempfile
-import PrusaLinkPy
-
-from django.http import HttpResponseBadRequest, JsonResponse
+import re
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import (
+    FileResponse, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotModified, JsonResponse,
+    StreamingHttpResponse, UnreadablePostError,
+)
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.views.decorators.http import require_POST
-from django.shortcuts import get_object_or_404, render
+from django.shortcuts import aget_object_or_404, get_object_or_404, render
+from django.urls import reverse
 from django.views.generic.list import ListView
-from django.forms.models import model_to_dict
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
-from django.utils.formats import date_format
+from django.utils.dateparse import parse_date
+from django.utils.cache import patch_cache_control
 from django.utils import timezone
+from asgiref.sync import sync_to_async
 import requests
 
 from .utils import *
-from .models import Printers, PendingJobUsage
+from .models import DispatchJob, Printers, PrinterPool, PrinterFile, UploadJob, UploadSession
+from .broadcast import broadcast_upload
+from .async_clients import get_async_client
+from .clients import get_client
+from .commands import ACTIONS, NO_JOB, PRINTER_COMMAND_TIMEOUT, REJECTED, TIMEOUT, UNAVAILABLE, run_bulk, run_command
+from .dispatch import dispatcher, enqueue_dispatch
+from . import metrics
+from .content import (
+    ContentMismatch, lookup_content, needs_parsing, parse_sha256, printer_has_content, printer_previews,
+    record_pending_usage, record_printer_file, remember_upload,
+)
+from .jobs import current_job, job_stats
+from .stats import farm_stats
+from .telemetry import get_telemetry
+from .thumbnails import content_type, pick_variant, touch
+from .status_cache import STATUSES, StatusStream, aget_status, aget_statuses, get_snapshot
+from .upload_sessions import (
+    UPLOAD_SESSION_CHUNK_SIZE, Incomplete, OffsetMismatch, SessionClosed, SpoolLost, TooLarge, abort_session,
+    create_session, finalize_session, write_chunk,
+)
+from .upload_queue import UPLOAD_WORKER_AUTOSTART, enqueue_upload, worker as upload_worker
+from .uploads import UPLOAD_CHUNK_SIZE, UploadStream, get_upload_progress, iter_request_body, set_upload_progress
+
+
+UPLOAD_ID_RE = re.compile(r"^[\w-]{1,64}$")
+# seconds the dashboard's rendered printer list is kept, see _drop_printer_list_fragment
+PRINTER_LIST_CACHE_TIMEOUT = getattr(settings, "PRINTER_LIST_CACHE_TIMEOUT", 300)
+# seconds browsers may keep printers_meta_api without asking again
+PRINTER_META_MAX_AGE = 60 * 60
+# thumbnails never change under their hash, a missing one may show up with the next upload
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+THUMBNAIL_MISSING_MAX_AGE = 60
+# bulk commands can ask for a longer per-printer timeout, up to this
+PRINTER_COMMAND_MAX_TIMEOUT = 60.0
+# seconds browsers may keep printers_previews_api
+PRINTER_PREVIEWS_MAX_AGE = 30
 
 
 ########## Helper funcs ##########
 
-def pause_current_print(client):
+def incoming_upload(request):
+    """
+    Pulls (slug, filename, length, chunks) out of an upload request, either
+    the raw body flavour (?slug=, X-Filename header) or the old multipart
+    form (file + slug). Returns None if there's no file in it.
+    """
+    if request.content_type == "multipart/form-data":
+        # Django already parsed this one, just stream its chunks on
+        uploaded_file = request.FILES.get("file")
+        if uploaded_file is None:
+            return None
+        return request.POST.get("slug"), uploaded_file.name, uploaded_file.size, uploaded_file.chunks(UPLOAD_CHUNK_SIZE)
+
+    filename = unquote(request.headers.get("X-Filename", ""))
     try:
-        resp = client.pause_print()
-        return resp
-    except requests.RequestException as e:
-        print("Error pausing print:", e) # TODO: change this
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if not filename or not length:
+        return None
+    return request.GET.get("slug"), filename, length, iter_request_body(request)
 
-def resume_current_print(client):
-    try:
-        resp = client.resume_print(client)
-        return resp
-    except requests.RequestException as e:
-        print("Error resuming print:", e) # TODO: change this too 
 
-def stop_current_print(client):
-    try:
-        resp = client.stop_print()
-        return resp
-    except requests.RequestException as e:
-        print("Error stopping print:", e) # TODO: change this as well
+def etag_matches(request, etag) -> bool:
+    return etag in [tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")]
+
+
+def thumbnail_url(sha256, width=None) -> str:
+    url = reverse("printers:thumbnail_api", args=[sha256])
+    return f"{url}?w={width}" if width else url
+
+
+def conditional_json(request, data, cache_control=None):
+    """
+    JsonResponse with an ETag of its body, or an empty 304 if the client
+    already has exactly that (If-None-Match).
+    """
+    body = json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":"))
+    etag = '"%s"' % hashlib.md5(body.encode(), usedforsecurity=False).hexdigest()
+
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, content_type="application/json")
+    response["ETag"] = etag
+    patch_cache_control(response, **(cache_control or {}))
+    return response
 
 
 ########## Django views ##########
 
 class PrintersListView(ListView):
-    model = Printers
+    # only what the cards show, and the template caches what it renders so the
+    # queryset is usually never run at all
+    queryset = Printers.objects.only("pk", "slug", "name", "model")
     template_name = "printer_dashboard.html"
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["printer_list_timeout"] = PRINTER_LIST_CACHE_TIMEOUT
+        return context
+
+
+@receiver([post_save, post_delete], sender=Printers)
+def _drop_printer_list_fragment(sender, instance, **kwargs):
+    cache.delete(make_template_fragment_key("printer_list"))
+
 
 def get_printer(request, slug):
-    printer = get_object_or_404(Printers.objects.filter(slug=slug))
+    # no api_key/host/counters, the page gets the live bits from the APIs
+    printer = get_object_or_404(
+        Printers.objects.only("pk", "slug", "name", "model", "staff_notes", "last_maintenance"),
+        slug=slug,
+    )
 
     return render(
         request,
@@ -63,215 +155,843 @@ def get_printer(request, slug):
 
 ########## AJAX functions/API calls ##########
 
-def printers_status_api(request):
+async def printers_status_api(request):
+    # only reads what the background collector last saw, never hits the printers
+    statuses = await aget_statuses([printer async for printer in Printers.objects.only("pk", "slug")])
+
     data = []
+    for slug, entry in statuses.items():
+        data.append({
+            "slug": slug,
+            "status": entry["status"],
+            "stale": entry["stale"],
+            "age": entry["age"],
+            "last_seen": entry["last_seen"],
+            "error": entry["error"],
+        })
 
-    for printer in Printers.objects.all():
-        status = "offline"  # default if anything goes wrong
+    return JsonResponse(data, safe=False)
 
+
+def printers_snapshot_api(request):
+    """
+    Live state of every printer in one compact GET, for clients that poll.
+    ?since=<version> (from the previous answer) only returns printers that
+    changed since, and an unchanged answer is a 304 to If-None-Match.
+    Static fields live in printers_meta_api.
+    """
+    try:
+        since = int(request.GET["since"]) if request.GET.get("since") else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid since")
+
+    snapshot = get_snapshot(Printers.objects.only("pk", "slug", "host", "api_key"), since=since)
+    return conditional_json(request, snapshot, cache_control={"no_cache": True})
+
+
+def printers_meta_api(request):
+    """
+    The printer fields that hardly ever change (name, model, notes...),
+    cacheable for an hour, revalidated with an ETag after that.
+    """
+    model_names = dict(Printers.PRINTERS)
+    printers = Printers.objects.order_by("name").values(
+        "slug", "name", "model", "date_added", "last_maintenance", "staff_notes",
+    )
+    meta = {
+        printer["slug"]: {
+            **printer,
+            "model_name": model_names.get(printer["model"], printer["model"]),
+            "url": reverse("printers:get_printer", args=[printer["slug"]]),
+        }
+        for printer in printers
+    }
+    return conditional_json(request, meta, cache_control={"private": True, "max_age": PRINTER_META_MAX_AGE})
+
+
+def printers_previews_api(request):
+    """
+    {slug: {"url", "source"} or None}, the preview image of what each printer
+    is printing, or of the last file sent to it (source "printing"/"queued").
+    ?slug=<slug> (repeatable) narrows it down, ?w= is passed on to thumbnail_api.
+    """
+    printers = Printers.objects.values_list("pk", "slug")
+    slugs = request.GET.getlist("slug")
+    if slugs:
+        printers = printers.filter(slug__in=slugs)
+    try:
+        width = int(request.GET.get("w") or 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid width")
+
+    slugs = dict(printers)
+    previews = {slug: None for slug in slugs.values()}
+    for printer_pk, (sha256, source) in printer_previews(list(slugs)).items():
+        previews[slugs[printer_pk]] = {"url": thumbnail_url(sha256, width), "source": source}
+    return conditional_json(request, previews, cache_control={"private": True, "max_age": PRINTER_PREVIEWS_MAX_AGE})
+
+
+def thumbnail_api(request, sha256):
+    """
+    Preview image of some uploaded content (thumbnails.py), the narrowest
+    embedded size at least ?w= pixels wide. Cached for good by browsers and
+    proxies, the hash is in the URL.
+    """
+    try:
+        width = int(request.GET.get("w") or 0)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid width")
+
+    variant = pick_variant(sha256, width) if parse_sha256(sha256) == sha256 else None
+    if variant is not None:
+        image_width, image_height, path = variant
         try:
-            client = PrusaLinkPy.PrusaLinkPy(printer.host, api_key=printer.api_key)
+            image = open(path, "rb")
+        except OSError:
+            variant = None  # evicted in the meantime
+    if variant is None:
+        response = HttpResponse(status=404)
+        patch_cache_control(response, public=True, max_age=THUMBNAIL_MISSING_MAX_AGE)
+        return response
+
+    touch(sha256)
+    etag = f'"{sha256[:16]}-{image_width}x{image_height}"'
+    if etag_matches(request, etag):
+        image.close()
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(image, content_type=content_type(path))
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=THUMBNAIL_MAX_AGE, immutable=True)
+    return response
+
+
+async def printers_stream_api(request):
+    """
+    Server-Sent Events stream of live printer state, replaces polling the
+    two endpoints above. ?slug=<slug> (repeatable) narrows it to some printers.
+    """
+    printers = Printers.objects.only("pk", "slug")
+    slugs = request.GET.getlist("slug")
+    if slugs:
+        printers = printers.filter(slug__in=slugs)
+
+    stream = StatusStream([printer async for printer in printers])
+
+    # async iteration under asgi.py, plain iteration under wsgi.py
+    response = StreamingHttpResponse(
+        stream.__aiter__() if isinstance(request, ASGIRequest) else iter(stream),
+        content_type="text/event-stream",
+    )
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # don't let nginx buffer the stream
+    return response
 
-            resp = client.get_status()
-            resp.raise_for_status()  # raises for HTTP 4xx/5xx
 
-            status_json = resp.json()
-            raw_state = status_json.get("printer", {}).get("state")
+def printer_telemetry_api(request, slug):
+    """
+    Temperature/progress/state history for graphs, ?hours=24 by default.
+    Samples are [timestamp, resolution, nozzle, bed, nozzle max, progress, state, printing fraction].
+    """
+    printer_djobj = get_object_or_404(Printers.objects.only("pk", "slug"), slug=slug)
+    try:
+        hours = min(max(float(request.GET.get("hours", 24)), 0), 24 * 365)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid hours")
+
+    since = timezone.now() - timedelta(hours=hours)
+    samples = [
+        [ts.timestamp(), resolution, nozzle, bed, nozzle_max, progress, state, printing]
+        for ts, resolution, nozzle, bed, nozzle_max, progress, state, printing in get_telemetry(printer_djobj, since)
+    ]
+
+    return JsonResponse(
+        {
+            "slug": printer_djobj.slug,
+            "since": since,
+            "fields": ["timestamp", "resolution", "temp_nozzle", "temp_bed", "temp_nozzle_max",
+                       "progress", "state", "printing_fraction"],
+            "samples": samples,
+        }
+    )
 
-            if raw_state is not None:
-                status = map_printer_status(raw_state)
-            else:
-                # if for some reason there's no state, treat as busy/error-ish
-                status = "busy"
 
-        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
-            # Printer unreachable, bad response, or JSON shape not as expected
-            # status stays "offline"
-            # you can log e here if you want
-            pass
+def farm_stats_api(request):
+    """
+    Utilization, success rate, failures and filament per printer, per model and
+    for the whole farm. Window is the last ?days=30, or ?since=YYYY-MM-DD&until=YYYY-MM-DD.
+    Superusers only, served from the daily rollup (see stats.py).
+    """
+    if not request.user.is_superuser:
+        return JsonResponse({"error": "Forbidden"}, status=403)
 
-        data.append({
-            "slug": printer.slug,
-            "status": status,
-        })
+    try:
+        until = parse_date(request.GET["until"]) if request.GET.get("until") else timezone.localdate()
+        if request.GET.get("since"):
+            since = parse_date(request.GET["since"])
+        else:
+            days = min(max(int(request.GET.get("days", 30)), 1), 366 * 10)
+            since = until - timedelta(days=days - 1) if until else None
+    except (ValueError, TypeError):
+        return HttpResponseBadRequest("Invalid window")
+    if since is None or until is None or since > until:
+        return HttpResponseBadRequest("Invalid window")
 
-    return JsonResponse(data, safe=False)
+    return JsonResponse(farm_stats(since, until))
 
 
 @require_POST
-def individual_printer_api(request):
+async def individual_printer_api(request):
+    """
+    Live state of one printer (POST {"slug"}), for the printer page. Only
+    what changes: name, notes, maintenance and the like come from
+    printers_meta_api, and nothing here ever exposes host or api key.
+    """
     try:
         data = json.loads(request.body)
     except json.JSONDecodeError:
         return HttpResponseBadRequest("Invalid JSON")
     
-    printer_djobj = get_object_or_404(Printers.objects.filter(slug=data["slug"]))
-    printer_actual = PrusaLinkPy.PrusaLinkPy(str(printer_djobj.host), str(printer_djobj.api_key))
-    try:
-        resp = printer_actual.get_status()
-    except:
+    printer_djobj = await aget_object_or_404(Printers.objects.filter(slug=data["slug"]))
+    status = await aget_status(printer_djobj)  # cached, see status_cache.py
+    if not status["ok"]:
         return JsonResponse(
                 {
-                    "error": "Printer unavailable"
+                    "error": status["error"],
+                    "last_seen": status["last_seen"],
+                    "stale": status["stale"],
+                    "retry_in": status.get("retry_in"),
                 },
                 status=502,
             )
 
-    # resp = printer_actual.get_status()
-    status = resp.json()
-
-    printer_info = status.get("printer", {})
-    job_info     = status.get("job", {})
-
-    dt = printer_djobj.last_maintenance
-    dt = timezone.localtime(dt)  # optional: convert to local time?
+    printer_info = status["printer"]
+    job_info     = status["job"]
 
     nozzle_temp    = printer_info.get("temp_nozzle", 0)        # °C
     bed_temp       = printer_info.get("temp_bed", 0)           # °C
     progress       = job_info.get("progress", 0)               # percent (0–100)
     time_remaining = job_info.get("time_remaining", 0)        # seconds
     curr_status    = map_printer_status(printer_info["state"])
-    date_string    = date_format(dt, "Y-m-d")
-    usage_mm, usage_g, usage_cm3, _ = get_filament_usage_from_job(printer_djobj, job_info)
-    
+    # expected usage of the job on the printer, if we uploaded its file
+    job = await sync_to_async(current_job)(printer_djobj)
 
-    payload = model_to_dict(printer_djobj)
+    payload = {"slug": printer_djobj.slug}
     payload["nozzle_temp"]      = nozzle_temp
     payload["bed_temp"]         = bed_temp
     payload["progress"]         = progress
     payload["curr_status"]      = curr_status
-    payload["last_maintenance"] = date_string
+    payload["stale"]            = status["stale"]
+    payload["status_age"]       = status["age"]
 
     if (time_remaining / 60) > 100:
         payload["time_remaining"] = round(((time_remaining / 60) / 60), 2) # convert to hours if big
         payload["time_units"]     = " hours"
     else:
-        payload["time_remaining"] = (round(time_remaining / 60), 2) # convert to min
+        payload["time_remaining"] = round(time_remaining / 60, 2) # convert to min
         payload["time_units"]     = " minutes"    
         
-    if usage_mm:
-        payload["usage_mm"] = usage_mm
-    if usage_g:
-        payload["usage_g"] = usage_g
-    if usage_cm3:
-        payload["usage_cm3"] = usage_cm3
-
-    if request.user.is_superuser:
-        payload["success_rate"] = round(float(printer_djobj.successful_prints / printer_djobj.total_print_count), 2)
-        payload["total_prints"] = printer_djobj.total_print_count
-        payload["total_filament_usage_mm"] = printer_djobj.filament_usage_mm
-        payload["total_filament_usage_cm3"] = printer_djobj.filament_usage_cm3
-        payload["total_filament_usage_g"] = printer_djobj.filament_usage_g
+    preview = (await sync_to_async(printer_previews)([printer_djobj.pk])).get(printer_djobj.pk)
+    payload["thumbnail_url"] = thumbnail_url(preview[0]) if preview else None
+
+    if job is not None:
+        if job.expected_filament_mm:
+            payload["usage_mm"] = job.expected_filament_mm
+        if job.expected_filament_g:
+            payload["usage_g"] = job.expected_filament_g
+        if job.expected_filament_cm3:
+            payload["usage_cm3"] = job.expected_filament_cm3
+
+    if (await request.auser()).is_superuser:
+        # one aggregate over the printer's PrintJob rows
+        stats = await sync_to_async(job_stats)(printer_djobj)
+        payload["success_rate"] = stats["success_rate"]
+        payload["total_prints"] = stats["total_prints"]
+        payload["total_printing_hours"] = round((stats["printing_seconds"] or 0) / 3600, 2)
+        payload["total_filament_usage_mm"] = stats["filament_mm"]
+        payload["total_filament_usage_cm3"] = stats["filament_cm3"]
+        payload["total_filament_usage_g"] = stats["filament_g"]
 
     return JsonResponse(payload, safe=False)
 
 
 def upload_bgcode_api(request):
-    uploaded_file = request.FILES.get("file")
-    if uploaded_file is None:
+    """
+    Streams a print file to a printer's PRINT_QUEUE, without a temp copy
+    when served over WSGI (see uploads.py).
+
+    Preferred: raw file as the request body, ?slug=<printer>, and headers
+    X-Filename (url-encoded) + optional X-Upload-Id for upload_progress_api.
+    The old multipart form (file + slug) still works.
+
+    With X-Content-SHA256 known content isn't parsed again (see content.py).
+    """
+    upload_id = request.headers.get("X-Upload-Id") or request.GET.get("upload_id")
+    if upload_id and not UPLOAD_ID_RE.match(upload_id):
+        return JsonResponse({"error": "Invalid upload id"}, status=400)
+    sha256 = parse_sha256(request.headers.get("X-Content-SHA256"))
+
+    incoming = incoming_upload(request)
+    if incoming is None:
         return JsonResponse({"error": "No file uploaded"}, status=400)
+    slug, filename, length, chunks = incoming
 
-    slug = request.POST.get("slug")
     printer_djobj = get_object_or_404(Printers.objects.filter(slug=slug))
-    printer_actual = PrusaLinkPy.PrusaLinkPy(str(printer_djobj.host), str(printer_djobj.api_key))
-    
-    usage = get_filament_usage_from_file(uploaded_file)
-    filament_mm = usage.get("mm")
-    filament_g = usage.get("g")
-    filament_cm3 = usage.get("cm3")
-    
+    printer_actual = get_client(printer_djobj)
+
+    # remote path
+    remote_dir = "PRINT_QUEUE"
+    remote_name = Path(filename).name
+    remote_path = f"{remote_dir}/{remote_name}"
+
+    # the file goes straight on to the printer, so there's no hash of our own to dedup on before
+    known = lookup_content(sha256)
+    body = UploadStream(
+        chunks, length,
+        on_progress=partial(set_upload_progress, upload_id) if upload_id else None,
+        parse=needs_parsing(known),
+    )
+    try:
+        # NO AUTOSTART, THEY MUST BE AT THE PRINTER
+        resp = printer_actual.put_stream(
+            body,
+            remote_path,
+            printAfterUpload=False,
+            overwrite=True,
+        )
+    except requests.RequestException as e:
+        body.report("failed", force=True, error=str(e))
+        return JsonResponse({"error": "Printer unavailable"}, status=502)
 
+    if not resp.ok:
+        body.report("failed", force=True, error=resp.text)
+        return JsonResponse(
+            {
+                "error": "Printer upload failed",
+                "printer_status_code": resp.status_code,
+                "printer_body": resp.text,
+            },
+            status=502,
+        )
+
+    if sha256 and body.sha256 != sha256:
+        # it's on the printer, but we can't vouch for what it is
+        PrinterFile.objects.filter(printer=printer_djobj, remote_path=remote_path).delete()
+        body.report("failed", force=True, error="Content hash mismatch")
+        return JsonResponse({"error": "Content hash mismatch", "sha256": body.sha256}, status=400)
+    body.report("done", force=True)
+
+    content = remember_upload(known, body, body.bytes_sent, remote_name)
+    record_printer_file(printer_djobj, remote_path, content)
+    record_pending_usage(printer_djobj, remote_path, content.as_metadata()["filament"])
+
+    return JsonResponse(
+        {
+            "ok": True,
+            "filename": remote_name,
+            "remote_path": remote_path,
+            "bytes": body.bytes_sent,
+            "sha256": content.sha256,
+            "deduplicated": False,
+        }
+    )
+
+
+@require_POST
+def upload_broadcast_api(request):
+    """
+    One file to several printers: same body as upload_bgcode_api but with
+    ?slug= repeated for each target (or a list of "slug" fields in the
+    multipart form). The file is received and parsed once and sent to all
+    printers concurrently, the answer has a result per printer.
+    """
+    sha256 = parse_sha256(request.headers.get("X-Content-SHA256"))
+    incoming = incoming_upload(request)
+    if incoming is None:
+        return JsonResponse({"error": "No file uploaded"}, status=400)
+    _, filename, length, chunks = incoming
 
-    # Write to a temporary file ONLY so PrusaLinkPy can read it
-    suffix = Path(uploaded_file.name).suffix or ".bgcode"
-    tmp_path = None
+    slugs = request.POST.getlist("slug") if request.content_type == "multipart/form-data" else request.GET.getlist("slug")
+    printers = list(Printers.objects.filter(slug__in=slugs))
+    missing = set(slugs) - {printer.slug for printer in printers}
+    if not slugs or missing:
+        return JsonResponse({"error": "Unknown printers", "slugs": sorted(missing)}, status=400)
 
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-            for chunk in uploaded_file.chunks():
-                tmp.write(chunk)
-            tmp_path = tmp.name
+        sent = broadcast_upload(printers, filename, length, chunks, sha256=sha256)
+    except ContentMismatch as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    results = [{"slug": printer.slug, **result} for printer, result in sent["results"].items()]
+    return JsonResponse(
+        {
+            "filename": Path(filename).name,
+            "remote_path": sent["remote_path"],
+            "sha256": sent["content"].sha256,
+            "bytes": sent["content"].size,
+            "results": results,
+        },
+        # 502 only if no printer got it
+        status=200 if any(result["ok"] for result in results) else 502,
+    )
 
-        # remote path
-        remote_dir = "PRINT_QUEUE"
-        remote_name = uploaded_file.name
-        remote_path = f"{remote_dir}/{remote_name}"
 
-        # NO AUTOSTART, THEY MUST BE AT THE PRINTER
-        resp = printer_actual.put_gcode(
-            tmp_path,
-            remote_path,
-            printAfterUpload=False,
-            overwrite=True,
+def upload_check_api(request):
+    """
+    Preflight for an upload: ?sha256=<hex>[&slug=<printer>&filename=<name>].
+    Tells the browser whether we know that content, and whether the printer
+    already has it under that name. Only a hint: the upload itself is still
+    needed, whether it reaches the printer is decided on the hash of the
+    bytes we actually get.
+    """
+    sha256 = parse_sha256(request.GET.get("sha256"))
+    if sha256 is None:
+        return HttpResponseBadRequest("Invalid sha256")
+
+    content = lookup_content(sha256)
+    payload = {
+        "sha256": sha256,
+        "known": content is not None,
+        "metadata": content.as_metadata() if content else None,
+        "on_printer": None,
+    }
+
+    slug, filename = request.GET.get("slug"), request.GET.get("filename")
+    if slug and filename:
+        printer_djobj = get_object_or_404(Printers.objects.filter(slug=slug))
+        payload["on_printer"] = printer_has_content(printer_djobj, f"PRINT_QUEUE/{Path(filename).name}", content)
+
+    return JsonResponse(payload)
+
+
+@require_POST
+def upload_jobs_api(request):
+    """
+    Queues an upload instead of doing it inside the request. Takes the same
+    body (and X-Content-SHA256) as upload_bgcode_api and answers 202 with a
+    job id right away, the transfer itself happens in upload_queue.py.
+    A file the printer already has (by the hash of what we received) answers
+    200 without a job.
+
+    Instead of a slug it can take model=<core_one|mk4> or pool=<pool slug>
+    (and priority=<int> for staff), then the file waits for whichever of those
+    printers frees up first, see dispatch.py.
+    """
+    sha256 = parse_sha256(request.headers.get("X-Content-SHA256"))
+    incoming = incoming_upload(request)
+    if incoming is None:
+        return JsonResponse({"error": "No file uploaded"}, status=400)
+    slug, filename, length, chunks = incoming
+
+    params = request.POST if request.content_type == "multipart/form-data" else request.GET
+    if not slug and (params.get("model") or params.get("pool")):
+        return dispatch_upload(request, params, filename, length, chunks, sha256)
+
+    printer_djobj = get_object_or_404(Printers.objects.filter(slug=slug))
+
+    try:
+        job = enqueue_upload(printer_djobj, filename, length, chunks, sha256=sha256)
+    except ContentMismatch as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if job is None:
+        # the printer already has exactly this file, nothing to queue
+        return JsonResponse(
+            {
+                "job_id": None,
+                "status": UploadJob.DONE,
+                "filename": Path(filename).name,
+                "remote_path": f"PRINT_QUEUE/{Path(filename).name}",
+                "deduplicated": True,
+            }
         )
+    if UPLOAD_WORKER_AUTOSTART:
+        upload_worker.ensure_running()
+
+    return JsonResponse(
+        {
+            "job_id": job.pk,
+            "status": job.status,
+            "status_url": reverse("printers:upload_job_status_api", args=[job.pk]),
+            "deduplicated": False,
+        },
+        status=202,
+    )
 
-        if resp.status_code != 200:
-            return JsonResponse(
-                {
-                    "error": "Printer upload failed",
-                    "printer_status_code": resp.status_code,
-                    "printer_body": resp.text,
-                },
-                status=502,
-            )
-        
-        if filament_mm is not None or filament_g is not None or filament_cm3 is not None:
-            PendingJobUsage.objects.create(
-                printer=printer_djobj,
-                remote_path=remote_path,
-                filament_mm=filament_mm,
-                filament_g=filament_g,
-                filament_cm3=filament_cm3,
-            )
 
+def upload_target(request, params):
+    """
+    (target_model, pool, priority) out of model=/pool=/priority= params, or
+    a JsonResponse to answer with if they don't make sense.
+    """
+    pool, target_model = None, ""
+    if params.get("pool"):
+        pool = get_object_or_404(PrinterPool.objects.filter(slug=params["pool"]))
+    elif params["model"] in dict(Printers.PRINTERS):
+        target_model = params["model"]
+    else:
+        return JsonResponse({"error": "Unknown printer model"}, status=400)
+
+    priority = 0
+    if params.get("priority") and request.user.is_staff:
+        try:
+            priority = int(params["priority"])
+        except (TypeError, ValueError):
+            return JsonResponse({"error": "Invalid priority"}, status=400)
+
+    return target_model, pool, priority
+
+
+def dispatch_upload(request, params, filename, length, chunks, sha256):
+    # the model/pool half of upload_jobs_api
+    target = upload_target(request, params)
+    if isinstance(target, JsonResponse):
+        return target
+    target_model, pool, priority = target
+
+    try:
+        job = enqueue_dispatch(filename, length, chunks, target_model=target_model, pool=pool,
+                               priority=priority, sha256=sha256)
+    except ContentMismatch as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    if UPLOAD_WORKER_AUTOSTART:
+        upload_worker.ensure_running()
+
+    return JsonResponse(
+        {
+            "dispatch_id": job.pk,
+            "status": job.status,
+            "status_url": reverse("printers:dispatch_job_status_api", args=[job.pk]),
+            "deduplicated": False,
+        },
+        status=202,
+    )
+
+
+def upload_session_json(session):
+    return {
+        "session": session.key,
+        "url": reverse("printers:upload_session_api", args=[session.key]),
+        "finalize_url": reverse("printers:upload_session_finalize_api", args=[session.key]),
+        "status": session.status,
+        "offset": session.bytes_received,
+        "size": session.bytes_total,
+        "chunk_size": UPLOAD_SESSION_CHUNK_SIZE,
+    }
+
+
+@require_POST
+def upload_sessions_api(request):
+    """
+    Starts a resumable upload, see upload_sessions.py. JSON body with
+    filename, size, slug (or model/pool/priority like upload_jobs_api) and
+    optionally sha256. Whether the printer already has the file is only
+    known at finalize, once we've hashed what was sent.
+    """
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    filename = Path(str(data.get("filename") or "")).name
+    size = data.get("size")
+    if not filename or type(size) is not int or size <= 0:
+        return JsonResponse({"error": "filename and size are required"}, status=400)
+    sha256 = parse_sha256(data.get("sha256"))
+
+    printer_djobj, target_model, pool, priority = None, "", None, 0
+    if data.get("slug"):
+        printer_djobj = get_object_or_404(Printers.objects.filter(slug=data["slug"]))
+    elif data.get("model") or data.get("pool"):
+        target = upload_target(request, data)
+        if isinstance(target, JsonResponse):
+            return target
+        target_model, pool, priority = target
+    else:
+        return JsonResponse({"error": "No printer, model or pool given"}, status=400)
+
+    session = create_session(
+        filename, size, printer=printer_djobj, target_model=target_model, pool=pool, priority=priority,
+        sha256=sha256,
+    )
+    return JsonResponse(upload_session_json(session), status=201)
+
+
+def upload_session_api(request, key):
+    """
+    GET how far a session got, PUT the next chunk (Upload-Offset header says
+    where it starts, raw body), DELETE to give up on it.
+    """
+    session = get_object_or_404(UploadSession.objects.filter(key=key))
+
+    if request.method == "GET":
+        return JsonResponse(upload_session_json(session))
+
+    if request.method == "DELETE":
+        try:
+            abort_session(session)
+        except SessionClosed:
+            return JsonResponse({"error": "Upload session is closed", "status": session.status}, status=410)
+        return HttpResponse(status=204)
+
+    if request.method != "PUT":
+        return HttpResponseNotAllowed(["GET", "PUT", "DELETE"])
+
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return JsonResponse({"error": "Upload-Offset header is required"}, status=400)
+
+    try:
+        committed = write_chunk(session, offset, iter_request_body(request))
+    except OffsetMismatch as e:
+        return JsonResponse({"error": str(e), "offset": e.offset}, status=409)
+    except SpoolLost as e:
+        return JsonResponse({"error": str(e), "status": session.status}, status=410)
+    except SessionClosed:
+        return JsonResponse({"error": "Upload session is closed", "status": session.status}, status=410)
+    except TooLarge as e:
+        return JsonResponse({"error": str(e), "offset": session.bytes_received}, status=413)
+    except UnreadablePostError:
+        # the client went away mid-chunk, what arrived is kept
+        return JsonResponse({"error": "Chunk broke off", "offset": session.bytes_received}, status=400)
+
+    return JsonResponse({"offset": committed, "size": session.bytes_total})
+
+
+@require_POST
+def upload_session_finalize_api(request, key):
+    """
+    Hands a complete session on, answers like upload_jobs_api: 202 with a
+    job_id (or dispatch_id for a model/pool), 200 if the printer already
+    has the file. Finalizing again answers the same.
+    """
+    session = get_object_or_404(UploadSession.objects.filter(key=key))
+    try:
+        result = finalize_session(session)
+    except Incomplete as e:
+        return JsonResponse({"error": str(e), "offset": session.bytes_received}, status=409)
+    except SpoolLost as e:
+        return JsonResponse({"error": str(e), "status": session.status}, status=410)
+    except SessionClosed:
+        return JsonResponse({"error": "Upload session is closed", "status": session.status}, status=410)
+    except ContentMismatch as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    if result["deduplicated"]:
         return JsonResponse(
             {
-                "ok": True,
-                "filename": uploaded_file.name,
-                "remote_path": remote_path,
+                "job_id": None,
+                "status": UploadJob.DONE,
+                "filename": session.filename,
+                "remote_path": f"PRINT_QUEUE/{session.filename}",
+                "deduplicated": True,
             }
         )
 
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.unlink(tmp_path)
-            except PermissionError:
-                pass
-            
-def printer_commands_api(request):
+    if UPLOAD_WORKER_AUTOSTART:
+        upload_worker.ensure_running()
+
+    if session.upload_job_id is not None:
+        return JsonResponse(
+            {
+                "job_id": session.upload_job_id,
+                "status": session.upload_job.status,
+                "status_url": reverse("printers:upload_job_status_api", args=[session.upload_job_id]),
+                "deduplicated": False,
+            },
+            status=202,
+        )
+    return JsonResponse(
+        {
+            "dispatch_id": session.dispatch_job_id,
+            "status": session.dispatch_job.status,
+            "status_url": reverse("printers:dispatch_job_status_api", args=[session.dispatch_job_id]),
+            "deduplicated": False,
+        },
+        status=202,
+    )
+
+
+def dispatch_job_status_api(request, dispatch_id):
+    job = get_object_or_404(
+        DispatchJob.objects.select_related("pool", "printer", "upload_job"), pk=dispatch_id,
+    )
+    upload = job.upload_job
+
+    return JsonResponse(
+        {
+            "dispatch_id": job.pk,
+            "filename": job.filename,
+            "target_model": job.target_model or None,
+            "pool": job.pool.slug if job.pool else None,
+            "priority": job.priority,
+            "status": job.status,
+            "position": dispatcher.position(job) if job.status == DispatchJob.WAITING else None,
+            "estimated_time": job.estimated_time,
+            "printer": job.printer.slug if job.printer else None,
+            "upload": {
+                "job_id": upload.pk,
+                "status": upload.status,
+                "status_url": reverse("printers:upload_job_status_api", args=[upload.pk]),
+            } if upload else None,
+            "error": job.error,
+            "created_at": job.created_at,
+            "assigned_at": job.assigned_at,
+        }
+    )
+
+
+def upload_job_status_api(request, job_id):
+    job = get_object_or_404(UploadJob.objects.select_related("printer"), pk=job_id)
+
+    return JsonResponse(
+        {
+            "job_id": job.pk,
+            "printer": job.printer.slug,
+            "filename": job.filename,
+            "remote_path": job.remote_path,
+            "status": job.status,
+            "bytes_sent": job.bytes_sent,
+            "bytes_total": job.bytes_total,
+            "attempts": job.attempts,
+            "max_attempts": job.max_attempts,
+            "next_attempt_at": job.next_attempt_at if job.status == UploadJob.QUEUED else None,
+            "error": job.error,
+        }
+    )
+
+
+def metrics_api(request):
+    """
+    Prometheus scrape endpoint, see metrics.py. Open to METRICS_ALLOWED_IPS and superusers.
+    """
+    if request.META.get("REMOTE_ADDR") not in metrics.METRICS_ALLOWED_IPS and not request.user.is_superuser:
+        return HttpResponse("Forbidden", status=403, content_type="text/plain")
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def upload_progress_api(request, upload_id):
+    progress = get_upload_progress(upload_id)
+    if progress is None:
+        return JsonResponse({"error": "Unknown upload"}, status=404)
+    return JsonResponse(progress)
+
+
+async def printer_commands_api(request):
     try:
         data = json.loads(request.body)
     except json.JSONDecodeError:
         return HttpResponseBadRequest("Invalid JSON")
     
-    if request.user.is_superuser:
-        printer_djobj = get_object_or_404(Printers.objects.filter(slug=data["slug"]))
+    if (await request.auser()).is_superuser:
+        printer_djobj = await aget_object_or_404(Printers.objects.filter(slug=data["slug"]))
         printer_action = data["action"]
-        printer_actual = PrusaLinkPy.PrusaLinkPy(str(printer_djobj.host), str(printer_djobj.api_key))
-        try:
-            resp = printer_actual.get_status()
-        except:
+        if printer_action not in ACTIONS:
+            return HttpResponseBadRequest("Invalid action")
+
+        # no thread held while the printer thinks about it, see commands.py
+        result = await run_command(printer_djobj, printer_action)
+        if result["outcome"] in (UNAVAILABLE, TIMEOUT):
+            # fails right away if the printer's circuit is open, see health.py
+            health = get_async_client(printer_djobj).health.snapshot()
             return JsonResponse(
                     {
-                        "error": "Printer unavailable"
+                        "error": "Printer unavailable",
+                        "reason": result["error"],
+                        "last_seen": health["last_seen"],
+                        "retry_in": health["retry_in"],
                     },
                     status=502,
                 )
-
-        if printer_action is "stop":
-            resp = stop_current_print(printer_actual)
-        elif printer_action is "resume":
-            resp = resume_current_print(printer_actual)
-        else:
-            resp = pause_current_print(printer_actual)
-            
-        if resp.status_code and resp.text:
+        if result["outcome"] == NO_JOB:
+            return JsonResponse({"error": "No active print"}, status=409)
+        if result["outcome"] == REJECTED:
             return JsonResponse(
                 {
                     "error": f"Printer action {printer_action.upper()}",
-                    "printer_status_code": resp.status_code,
-                    "printer_body": resp.text,
+                    "printer_status_code": result["status_code"],
+                    "printer_body": result["error"],
                 },
+                status=502,
             )
+        return JsonResponse({"ok": True, "action": printer_action})
+
+    return JsonResponse({"error": "Forbidden"}, status=403)
+
 
+@require_POST
+async def printer_bulk_commands_api(request):
+    """
+    Pause/resume/stop many printers at once, for emergencies. JSON body:
+      {"action": "stop", "slugs": ["mk4-1", "mk4-2"]}
+      {"action": "pause", "model": "mk4", "pool": "petg", "state": "printing"}
+      {"action": "stop", "all": true}
+    Filters combine, `state` (one or a list, as in printers_status_api) comes
+    from the status cache. `all` has to be said out loud to hit the whole farm,
+    an unknown model, pool or state is a 400 rather than a command to nobody.
+    Every printer runs concurrently with its own `timeout` (seconds, default
+    PRINTER_COMMAND_TIMEOUT), the answer has each printer's outcome.
+    """
+    if not (await request.auser()).is_superuser:
+        return JsonResponse({"error": "Forbidden"}, status=403)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return HttpResponseBadRequest("Invalid JSON")
+    if not isinstance(data, dict) or data.get("action") not in ACTIONS:
+        return HttpResponseBadRequest("Invalid action")
+
+    slugs, model, pool, state = data.get("slugs"), data.get("model"), data.get("pool"), data.get("state")
+    if isinstance(slugs, str):
+        slugs = [slugs]
+    if slugs is not None and not (isinstance(slugs, list) and all(isinstance(slug, str) for slug in slugs)):
+        return HttpResponseBadRequest("slugs must be a list of printer slugs")
+    # a typo must not look like a stop that hit nothing
+    if model is not None and not (isinstance(model, str) and model in dict(Printers.PRINTERS)):
+        return HttpResponseBadRequest("Unknown printer model")
+    if pool is not None and not (isinstance(pool, str) and await PrinterPool.objects.filter(slug=pool).aexists()):
+        return HttpResponseBadRequest("Unknown pool")
+    if isinstance(state, str):
+        state = [state]
+    if state is not None:
+        if not (isinstance(state, list) and all(isinstance(value, str) for value in state)):
+            return HttpResponseBadRequest("Invalid state")
+        state = [value.lower() for value in state]
+        if not set(state) <= set(STATUSES):
+            return HttpResponseBadRequest(f"Unknown state, one of: {', '.join(STATUSES)}")
+    if not (slugs or model or pool or state or data.get("all") is True):
+        return HttpResponseBadRequest("Say which printers (slugs, model, pool, state) or all")
+    try:
+        timeout = min(max(float(data.get("timeout") or PRINTER_COMMAND_TIMEOUT), 1.0), PRINTER_COMMAND_MAX_TIMEOUT)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("Invalid timeout")
+
+    printers = Printers.objects.only("pk", "slug", "host", "api_key")
+    unknown = []
+    if slugs:
+        printers = printers.filter(slug__in=slugs)
+        known = {slug async for slug in Printers.objects.filter(slug__in=slugs).values_list("slug", flat=True)}
+        unknown = sorted(set(slugs) - known)
+    if model:
+        printers = printers.filter(model=model)
+    if pool:
+        printers = printers.filter(pools__slug=pool)
+    printers = [printer async for printer in printers.order_by("slug")]
+
+    if state:
+        states = set(state)
+        statuses = await aget_statuses(printers)
+        printers = [printer for printer in printers if statuses[printer.slug]["status"] in states]
+
+    results = await run_bulk(printers, data["action"], timeout=timeout)
+    summary = {}
+    for result in results.values():
+        summary[result["outcome"]] = summary.get(result["outcome"], 0) + 1
+
+    return JsonResponse({
+        "action": data["action"],
+        "printers": len(results),
+        "summary": summary,
+        "unknown": unknown,  # slugs that aren't printers at all
+        "results": results,
+    })